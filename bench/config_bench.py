@@ -0,0 +1,65 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Benchmark the configuration overhead of each task.
+
+Every task builds a Cartutils and an ArchiveRequests, both read
+several options from get_config. Before the configuration was cached
+each call parsed the config file again, which is what read_config
+does, so the uncached numbers patch get_config to always call it.
+
+Run from the top of the repository with
+``PYTHONPATH=. python bench/config_bench.py``.
+"""
+from time import perf_counter
+from argparse import ArgumentParser
+import mock
+from pacifica.cartd import config
+from pacifica.cartd.utils import Cartutils
+from pacifica.cartd.archive_requests import ArchiveRequests
+
+
+def uncached_config():
+    """Return a newly read configuration like get_config used to."""
+    return config.read_config(
+        [config.getenv(env, default) for _section, _option, env, default in config.CONFIG_OPTIONS])
+
+
+def task_setup():
+    """Do the configuration work of one task."""
+    Cartutils()
+    ArchiveRequests()
+    config.get_config().getsize('cartd', 'transfer_size')
+
+
+def run(count):
+    """Return the microseconds per get_config and per task setup."""
+    start = perf_counter()
+    for _i in range(count):
+        config.get_config()
+    per_get = (perf_counter() - start) / count * 10**6
+    start = perf_counter()
+    for _i in range(count):
+        task_setup()
+    per_task = (perf_counter() - start) / count * 10**6
+    return per_get, per_task
+
+
+def main():
+    """Run the benchmark."""
+    parser = ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--count', type=int, default=2000, help='calls to time')
+    args = parser.parse_args()
+    print('{:<12} {:>16} {:>16}'.format('config', 'us/get_config', 'us/task setup'))
+    with mock.patch('pacifica.cartd.config.get_config', uncached_config), \
+            mock.patch('pacifica.cartd.utils.get_config', uncached_config), \
+            mock.patch('pacifica.cartd.archive_requests.get_config', uncached_config):
+        per_get, per_task = run(args.count)
+    print('{:<12} {:>16.1f} {:>16.1f}'.format('uncached', per_get, per_task))
+    config.reload_config()
+    per_get, per_task = run(args.count)
+    print('{:<12} {:>16.1f} {:>16.1f}'.format('cached', per_get, per_task))
+
+
+if __name__ == '__main__':
+    main()
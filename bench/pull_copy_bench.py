@@ -0,0 +1,159 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Benchmark the copy loop of a pull.
+
+A local HTTP server sends --size megabytes and the file is pulled
+through requests and urllib3 like ArchiveRequests does. Three loops
+are compared, a new bytes object read for every chunk, the readinto
+of the urllib3 response and ArchiveRequests._copy_stream, which reads
+into its buffers through the http.client response.
+
+The bytes the reads allocate are measured with tracemalloc, the peak
+traced memory of every read call less the traced memory before it is
+added up. That needs Python 3.9 or later for tracemalloc.reset_peak.
+The MB/s come from a run without tracing, the server runs in the same
+process so it takes some of the time.
+
+Run from the top of the repository with
+``PYTHONPATH=. python bench/pull_copy_bench.py --size 2048``.
+"""
+import os
+import hashlib
+import threading
+import tracemalloc
+from time import perf_counter
+from argparse import ArgumentParser
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
+import mock
+import requests
+from pacifica.cartd.config import reload_config
+from pacifica.cartd.archive_requests import ArchiveRequests
+
+BLOCK = os.urandom(1024 * 1024)
+
+
+class SourceHandler(BaseHTTPRequestHandler):
+    """Send the number of megabytes in the path."""
+
+    protocol_version = 'HTTP/1.1'
+
+    # pylint: disable=invalid-name
+    def do_GET(self):
+        """Send the megabytes."""
+        size = int(self.path.strip('/'))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(size * len(BLOCK)))
+        self.end_headers()
+        for _i in range(size):
+            self.wfile.write(BLOCK)
+    # pylint: enable=invalid-name
+
+    def log_message(self, *_args):
+        """Don't log the requests."""
+
+
+class SourceServer(ThreadingMixIn, HTTPServer):
+    """Threaded server for the source."""
+
+    daemon_threads = True
+
+
+# pylint: disable=too-few-public-methods
+class ReadAllocs:
+    """Wrap a read and add up the bytes traced while it runs."""
+
+    def __init__(self, read):
+        """Wrap the read."""
+        self.read = read
+        self.allocated = 0
+
+    def __call__(self, arg):
+        """Read and add the traced peak above the memory before the read."""
+        if not tracemalloc.is_tracing():
+            return self.read(arg)
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        result = self.read(arg)
+        self.allocated += tracemalloc.get_traced_memory()[1] - before
+        return result
+# pylint: enable=too-few-public-methods
+
+
+def copy_bytes(resp, myfile, myhash, xfer_size, allocs):
+    """Copy with a new bytes object for every chunk."""
+    read = allocs(resp.raw.read)
+    buf = read(xfer_size)
+    while buf:
+        myfile.write(buf)
+        myhash.update(buf)
+        buf = read(xfer_size)
+    return read
+
+
+def copy_urllib3(resp, myfile, myhash, xfer_size, allocs):
+    """Copy through the reused buffers with the urllib3 readinto."""
+    read = allocs(resp.raw.readinto)
+    with mock.patch.object(ArchiveRequests, '_stream_readinto', staticmethod(lambda stream: read)):
+        # pylint: disable=protected-access
+        ArchiveRequests()._copy_stream(resp.raw, myfile, myhash, xfer_size)
+        # pylint: enable=protected-access
+    return read
+
+
+def copy_buffers(resp, myfile, myhash, xfer_size, allocs):
+    """Copy through the reused buffers like a pull does."""
+    # pylint: disable=protected-access
+    read = allocs(ArchiveRequests._stream_readinto(resp.raw))
+    with mock.patch.object(ArchiveRequests, '_stream_readinto', staticmethod(lambda stream: read)):
+        ArchiveRequests()._copy_stream(resp.raw, myfile, myhash, xfer_size)
+    # pylint: enable=protected-access
+    return read
+
+
+# pylint: disable=too-many-arguments
+def run(copy, url, size, xfer_size, hashtype, trace):
+    """Return the MB/s and the MB allocated by the reads of one pull."""
+    with requests.get('{}/{}'.format(url, size), stream=True) as resp, open(os.devnull, 'wb') as myfile:
+        if trace:
+            tracemalloc.start()
+        start = perf_counter()
+        read = copy(resp, myfile, hashlib.new(hashtype), xfer_size, ReadAllocs)
+        seconds = perf_counter() - start
+        if trace:
+            tracemalloc.stop()
+    return size * 1.048576 / seconds, read.allocated / 10**6
+# pylint: enable=too-many-arguments
+
+
+def main():
+    """Run the benchmark."""
+    parser = ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--size', type=int, default=2048, help='megabytes to pull')
+    parser.add_argument('--trace-size', type=int, default=256, help='megabytes to pull with tracemalloc on')
+    parser.add_argument('--transfer-size', type=int, default=4, help='megabytes per chunk')
+    parser.add_argument('--hash', default='sha1', help='hash type of the file')
+    parser.add_argument('--depths', default='0,4', help='pull pipeline depths to run')
+    args = parser.parse_args()
+    server = SourceServer(('127.0.0.1', 0), SourceHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    xfer_size = args.transfer_size * 1024 * 1024
+    cases = [('bytes per chunk', copy_bytes, '0')]
+    for depth in args.depths.split(','):
+        cases.append(('urllib3 depth {}'.format(depth), copy_urllib3, depth))
+        cases.append(('http.client depth {}'.format(depth), copy_buffers, depth))
+    print('{:<22} {:>10} {:>16} {:>16}'.format('loop', 'MB/s', 'read MB alloced', 'of MB pulled'))
+    for name, copy, depth in cases:
+        with mock.patch.dict(os.environ, {'PULL_PIPELINE_DEPTH': depth}):
+            reload_config()
+            mbps, _allocated = run(copy, url, args.size, xfer_size, args.hash, False)
+            _mbps, allocated = run(copy, url, args.trace_size, xfer_size, args.hash, True)
+        print('{:<22} {:>10.1f} {:>16.1f} {:>16.1f}'.format(name, mbps, allocated, args.trace_size * 1.048576))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
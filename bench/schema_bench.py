@@ -0,0 +1,112 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Benchmark the Cartutils queries before and after the schema 2.4 indexes.
+
+A sqlite database of --carts carts with --files files each is built
+without the indexes added in schema 2.4 and the queries behind the
+REST calls, prepare_bundle and eviction are timed. The
+OrmSync.update_2_3_to_2_4 migration is then run and the queries are
+timed again.
+
+Run from the top of the repository with
+``PYTHONPATH=. python bench/schema_bench.py --carts 100000 --files 10``.
+"""
+import os
+import random
+import datetime
+from tempfile import mkdtemp
+from time import perf_counter
+from argparse import ArgumentParser
+from peewee import chunked
+from playhouse.migrate import SchemaMigrator, migrate
+from pacifica.cartd.orm import DB, OrmSync, CartSystem, Cart, File, CartTasks, SpaceReservation
+from pacifica.cartd.utils import Cartutils
+
+
+def build(path, carts, files):
+    """Create the database with the carts and files and none of the 2.4 indexes."""
+    DB.init(path)
+    DB.create_tables([CartSystem, Cart, File, CartTasks, SpaceReservation])
+    migrator = SchemaMigrator(DB)
+    migrate(
+        migrator.drop_index('cart', 'cart_cart_uid_deleted_date_creation_date'),
+        migrator.drop_index('cart', 'cart_deleted_date_accessed_date'),
+        migrator.drop_index('file', 'file_cart_id_status')
+    )
+    random.seed(0)
+    now = datetime.datetime.now()
+    cart_rows = []
+    for index in range(carts):
+        created = now - datetime.timedelta(minutes=random.randrange(10**6))
+        deleted = random.random() < 0.5
+        cart_rows.append({
+            'cart_uid': str(index % (carts // 2) if carts > 1 else index),
+            'status': 'deleted' if deleted else random.choice(['ready', 'ready', 'staging', 'error']),
+            'creation_date': created,
+            'updated_date': created,
+            'accessed_date': created + datetime.timedelta(minutes=random.randrange(1000)),
+            'deleted_date': created if deleted else None
+        })
+    with DB.atomic():
+        for batch in chunked(cart_rows, 1000):
+            # pylint: disable=no-value-for-parameter
+            Cart.insert_many(batch).execute()
+            # pylint: enable=no-value-for-parameter
+        for batch in chunked(range(carts * files), 1000):
+            # pylint: disable=no-value-for-parameter
+            File.insert_many([
+                {
+                    'cart': index // files + 1,
+                    'file_name': str(index),
+                    'bundle_path': '{}.txt'.format(index),
+                    'status': 'staging' if index % files == 0 else 'staged'
+                }
+                for index in batch
+            ]).execute()
+            # pylint: enable=no-value-for-parameter
+
+
+def run(count, carts):
+    """Return the milliseconds per call of each query."""
+    cart_utils = Cartutils()
+    uids = [str(random.randrange(carts // 2 or 1)) for _i in range(count)]
+    cartids = [random.randrange(carts) + 1 for _i in range(count)]
+    queries = [
+        ('cart_status', lambda index: cart_utils.cart_status(uids[index])),
+        ('prepare_bundle', lambda index: cart_utils.prepare_bundle(cartids[index])),
+        ('evict_candidates', lambda _index: cart_utils.evict_candidates().first()),
+    ]
+    timings = []
+    for name, query in queries:
+        start = perf_counter()
+        for index in range(count):
+            query(index)
+        timings.append((name, (perf_counter() - start) / count * 1000))
+    return timings
+
+
+def main():
+    """Run the benchmark."""
+    parser = ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--carts', type=int, default=100000, help='carts in the database')
+    parser.add_argument('--files', type=int, default=10, help='files in each cart')
+    parser.add_argument('--count', type=int, default=200, help='calls of each query to time')
+    args = parser.parse_args()
+    path = os.path.join(mkdtemp(), 'bench.sqlite3')
+    build(path, args.carts, args.files)
+    before = run(args.count, args.carts)
+    start = perf_counter()
+    OrmSync.update_2_3_to_2_4()
+    migrate_seconds = perf_counter() - start
+    after = run(args.count, args.carts)
+    print('{:<18} {:>12} {:>12}'.format('query', 'ms before', 'ms after'))
+    for (name, before_ms), (_name, after_ms) in zip(before, after):
+        print('{:<18} {:>12.3f} {:>12.3f}'.format(name, before_ms, after_ms))
+    print('migration took {:.1f} s'.format(migrate_seconds))
+    DB.close()
+    os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Benchmark sending a bundled cart tar to a socket.
+
+Compares reading the tar through Python in chunks, as
+cherrypy.lib.static.serve_file does, with os.sendfile, which is what
+the web server does when bundle_offload hands it the file. The CPU
+time is that of the sending thread only.
+
+Run from the top of the repository with
+``PYTHONPATH=. python bench/serve_bundle_bench.py --size 2048``.
+"""
+import os
+import socket
+import threading
+from tempfile import mkstemp
+from time import perf_counter, thread_time
+from argparse import ArgumentParser
+
+
+def drain(sock):
+    """Read everything sent to the socket."""
+    buf = bytearray(1024 * 1024)
+    while sock.recv_into(buf):
+        pass
+
+
+def send_python(sock, myfile, size, chunk_size):
+    """Send the file by reading it in chunks."""
+    left = size
+    while left:
+        buf = myfile.read(min(chunk_size, left))
+        sock.sendall(buf)
+        left -= len(buf)
+
+
+def send_sendfile(sock, myfile, size, _chunk_size):
+    """Send the file with os.sendfile."""
+    offset = 0
+    while offset < size:
+        offset += os.sendfile(sock.fileno(), myfile.fileno(), offset, size - offset)
+
+
+def run(send, path, size, chunk_size):
+    """Return the MB/s and sender CPU seconds per GB of one send."""
+    sender, receiver = socket.socketpair()
+    reader = threading.Thread(target=drain, args=(receiver,))
+    reader.start()
+    with open(path, 'rb') as myfile:
+        start, cpu_start = perf_counter(), thread_time()
+        send(sender, myfile, size, chunk_size)
+        seconds, cpu = perf_counter() - start, thread_time() - cpu_start
+    sender.close()
+    reader.join()
+    receiver.close()
+    return size / 10**6 / seconds, cpu / (size / 10**9)
+
+
+def main():
+    """Run the benchmark."""
+    parser = ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--size', type=int, default=2048, help='megabytes in the tar')
+    parser.add_argument('--chunk-size', type=int, default=65536, help='bytes read per chunk by Python')
+    args = parser.parse_args()
+    size = args.size * 1024 * 1024
+    fd, path = mkstemp(suffix='.tar')
+    with os.fdopen(fd, 'wb') as myfile:
+        block = os.urandom(1024 * 1024)
+        for _i in range(args.size):
+            myfile.write(block)
+    print('{:<12} {:>10} {:>12}'.format('send', 'MB/s', 'CPU s/GB'))
+    try:
+        for name, send in [('python', send_python), ('sendfile', send_sendfile)]:
+            mbps, cpu = run(send, path, size, args.chunk_size)
+            print('{:<12} {:>10.1f} {:>12.3f}'.format(name, mbps, cpu))
+    finally:
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -19,6 +19,7 @@ from peewee import OperationalError, PeeweeException
 from .orm import File, OrmSync, CartSystem, SCHEMA_MAJOR, SCHEMA_MINOR
 from .rest import CartRoot, error_page_default
 from .globals import CHERRYPY_CONFIG, CONFIG_FILE
+from .config import reload_config
 from .fixit import fixit
 from .utils import Cartutils
 from .tasks import CART_APP
@@ -82,6 +83,9 @@ def main(*argv):
         'server.socket_host': args.address,
         'server.socket_port': args.port
     })
+    if hasattr(cherrypy.engine, 'signal_handler'):
+        # read the configuration again on SIGHUP instead of restarting
+        cherrypy.engine.signal_handler.handlers['SIGHUP'] = reload_config
     cherrypy.quickstart(CartRoot(), '/', args.cpconfig)
 
 
@@ -116,6 +120,10 @@ def cmd(*argv):
         '--cartid', dest='cartids', nargs='+', default=set(),
         help='Cart IDs to try and fix'
     )
+    fixit_parser.add_argument(
+        '--jobs', dest='jobs', type=int, default=1,
+        help='number of files to fix at the same time'
+    )
     fixit_parser.set_defaults(func=fixit)
     dump_parser = subparsers.add_parser(
         'dump',
@@ -2,13 +2,197 @@
 # -*- coding: utf-8 -*-
 """Module that is used by the cart to send requests to the archive interface."""
 from __future__ import absolute_import
-from time import sleep
+from os import getpid, unlink, stat
+from os.path import isfile
+from time import sleep, perf_counter
 from json import dumps
+from functools import partial
+from http.client import HTTPException
+from collections import OrderedDict
+from queue import Queue
+from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor
+import logging
 import hashlib
 import requests
-from .utils import parse_size
+from requests.adapters import HTTPAdapter
+import urllib3
+from urllib3.util.retry import Retry
 from .config import get_config
 
+SESSIONS = {}
+LOGGER = logging.getLogger(__name__)
+
+
+def new_session():
+    """Return a new archive interface session with its own connection pool."""
+    pool_size = get_config().getint('archiveinterface', 'pool_size')
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=Retry(
+            total=get_config().getint('archiveinterface', 'retries'),
+            backoff_factor=get_config().getfloat('archiveinterface', 'retry_backoff')
+        )
+    )
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session():
+    """
+    Return the archive interface session for this process.
+
+    Sessions are kept per process id so forked workers do not
+    share the connection pool of their parent.
+    """
+    pid = getpid()
+    if pid not in SESSIONS:
+        session = new_session()
+        SESSIONS.clear()
+        SESSIONS[pid] = session
+    return SESSIONS[pid]
+
+
+def unshare_file(filepath):
+    """
+    Remove a cart file that is hard linked to other paths.
+
+    Files linked from the content store share their data with the
+    store and other carts, writing to them in place would change
+    every copy.
+    """
+    try:
+        if stat(filepath).st_nlink > 1:
+            unlink(filepath)
+    except FileNotFoundError:
+        pass
+
+
+class PipelineStage(Thread):
+    """
+    One stage of a pipelined pull.
+
+    Chunks put to the stage are worked on in its own thread, or
+    right away in the caller when the depth is zero, then handed to
+    done. An error in the thread is added to errors and the rest of
+    the chunks are only handed to done so the reader never blocks on
+    a full queue.
+    """
+
+    def __init__(self, work, depth, errors, done):
+        """Set the work done on every chunk and how deep the queue is."""
+        super().__init__()
+        self.daemon = True
+        self.work = work
+        self.done = done
+        self.chunks = Queue(depth) if depth > 0 else None
+        self.errors = errors
+        self.stats = {'bytes': 0, 'seconds': 0.0}
+
+    def begin(self):
+        """Start the thread if there is a queue."""
+        if self.chunks is not None:
+            self.start()
+
+    def put(self, buf):
+        """Queue the chunk or work on it now."""
+        if self.chunks is None:
+            try:
+                self.timed(buf)
+            finally:
+                self.done(buf)
+        else:
+            self.chunks.put(buf)
+
+    def finish(self):
+        """Wait for the queued chunks to be done."""
+        if self.chunks is not None:
+            self.chunks.put(None)
+            self.join()
+
+    def timed(self, buf):
+        """Do the work on the chunk and add it to the stats."""
+        start = perf_counter()
+        self.work(buf)
+        self.stats['seconds'] += perf_counter() - start
+        self.stats['bytes'] += len(buf)
+
+    def run(self):
+        """Work on the chunks until a None is queued."""
+        buf = self.chunks.get()
+        while buf is not None:
+            if not self.errors:
+                try:
+                    self.timed(buf)
+                # any error has to get back to the reader or it would
+                # wait forever on a queue no thread empties
+                # pylint: disable=broad-except
+                except Exception as ex:
+                    self.errors.append(ex)
+                # pylint: enable=broad-except
+            self.done(buf)
+            buf = self.chunks.get()
+
+
+class BufferPool:
+    """
+    Reusable buffers for reading a pull into.
+
+    Every buffer is shared by a number of stages and goes back to the
+    free queue once they have all released their view of it, so a pull
+    allocates count buffers no matter how large the file is.
+    """
+
+    def __init__(self, count, size, users):
+        """Allocate count buffers of size bytes used by users stages."""
+        self.free = Queue()
+        for _i in range(count):
+            self.free.put(bytearray(size))
+        self.users = users
+        self._pending = {}
+        self._lock = Lock()
+
+    def get(self):
+        """Wait for a free buffer."""
+        return self.free.get()
+
+    def release(self, view):
+        """Release one view of a buffer, freeing it after the last one."""
+        buf = view.obj
+        with self._lock:
+            left = self._pending.pop(id(buf), self.users) - 1
+            if left:
+                self._pending[id(buf)] = left
+                return
+        view.release()
+        self.free.put(buf)
+
+
+# pylint: disable=too-few-public-methods
+class TarSlot:
+    """
+    Space for a file inside a tar written to like a file.
+
+    Writing more than the size of the slot would overwrite the next
+    member so it is an error.
+    """
+
+    def __init__(self, myfile, size):
+        """Write to myfile, already at the start of the slot, up to size bytes."""
+        self.myfile = myfile
+        self.left = size
+
+    def write(self, buf):
+        """Write to the slot."""
+        if len(buf) > self.left:
+            raise ValueError('File is larger than its size in the tar')
+        self.left -= len(buf)
+        return self.myfile.write(buf)
+# pylint: enable=too-few-public-methods
+
 
 class ArchiveRequests:
     """Class that supports all the requests to the archive interface."""
@@ -16,24 +200,37 @@ class ArchiveRequests:
     default_retry_count = 5
     default_retry_sleep = 1
 
-    def __init__(self):
-        """Constructor for setting the AI URL."""
+    def __init__(self, session=None):
+        """Constructor for setting the AI URL, the process session is used without a session."""
         self._url = get_config().get('archiveinterface', 'url')
+        self._session = session or get_session()
+        self._progress = None
+        self.pull_stats = {}
 
     # pylint: disable=too-many-arguments
-    def pull_file(self, archive_filename, cart_filepath, hashval, hashtype, retry=None):
+    def pull_file(self, archive_filename, cart_filepath, hashval, hashtype, retry=None, tar_slot=None,
+                  progress=None):
         """
         Pull file from AI.
 
         Performs a request that will attempt to write
         the contents of a file from the archive interface
-        to the specified cart filepath
+        to the specified cart filepath. With a tar slot of
+        (offset, size) the cart filepath is a tar and the file is
+        written into the slot at that offset. The progress function
+        is called after every chunk read.
         """
         if retry is None:
             retry = self.default_retry_count
+        self._progress = progress
+        pull_method = self._pull_file
+        if tar_slot:
+            pull_method = partial(self._pull_slot, offset=tar_slot[0], size=tar_slot[1])
+        elif get_config().getint('cartd', 'parallel_pull_streams') > 1:
+            pull_method = self._pull_file_parallel
         while retry:
             try:
-                self._pull_file(archive_filename, cart_filepath, hashval, hashtype)
+                pull_method(archive_filename, cart_filepath, hashval, hashtype)
                 retry = 0
             except (requests.exceptions.RequestException, ValueError) as ex:
                 if retry == 1:
@@ -42,26 +239,255 @@ class ArchiveRequests:
                 retry -= 1
     # pylint: enable=too-many-arguments
 
+    @staticmethod
+    def _hash_partial(cart_filepath, myhash, xfer_size):
+        """Hash what an earlier try left in the cart file and return the size."""
+        if not isfile(cart_filepath):
+            return 0
+        offset = 0
+        with open(cart_filepath, 'rb') as myfile:
+            buf = myfile.read(xfer_size)
+            while buf:
+                myhash.update(buf)
+                offset += len(buf)
+                buf = myfile.read(xfer_size)
+        return offset
+
     def _pull_file(self, archive_filename, cart_filepath, hashval, hashtype):
-        xfer_size = parse_size(get_config().get('cartd', 'transfer_size'))
-        resp = requests.get(str(self._url + archive_filename), stream=True)
-        if int(resp.status_code/100) == 5:
-            raise requests.exceptions.RequestException('Status code is 500')
-        myfile = open(cart_filepath, 'wb+')
-        buf = resp.raw.read(xfer_size)
+        """
+        Pull the file resuming after any bytes already in the cart file.
+
+        The bytes on disk are hashed again and only the rest of the
+        file is asked for with a Range header. If the archive sends
+        the whole file instead the cart file is started over.
+        """
+        xfer_size = get_config().getsize('cartd', 'transfer_size')
+        myhash = hashlib.new(hashtype)
+        self.pull_stats = {}
+        unshare_file(cart_filepath)
+        offset = self._hash_partial(cart_filepath, myhash, xfer_size)
+        headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+        with self._session.get(str(self._url + archive_filename), stream=True, headers=headers) as resp:
+            if int(resp.status_code/100) == 5:
+                raise requests.exceptions.RequestException('Status code is 500')
+            # 416 means there is nothing after what is already on disk
+            if resp.status_code != 416:
+                if resp.status_code != 206:
+                    myhash = hashlib.new(hashtype)
+                with open(cart_filepath, 'ab' if resp.status_code == 206 else 'wb') as myfile:
+                    try:
+                        self._copy_stream(resp.raw, myfile, myhash, xfer_size)
+                    except urllib3.exceptions.HTTPError as ex:
+                        # keep the partial file for the next try to resume
+                        raise requests.exceptions.ConnectionError(str(ex))
+        self._check_hash(cart_filepath, myhash, hashval)
+        self._log_pull_stats(archive_filename)
+
+    # pylint: disable=too-many-locals
+    def _copy_stream(self, stream, myfile, myhash, xfer_size):
+        """
+        Copy the stream to the cart file and hash it.
+
+        With pull_pipeline_depth above zero the writes and the hashing
+        each run in a thread fed by a queue that many chunks deep, so
+        reading, writing and hashing overlap (hashlib releases the GIL
+        for large chunks). The stream is read into a pool of buffers
+        allocated up front and the stages share views of them. See
+        _stream_readinto for when reading allocates nothing per chunk.
+        The bytes, busy seconds and MB/s of every stage are kept in
+        pull_stats.
+        """
+        depth = get_config().getint('cartd', 'pull_pipeline_depth')
+        readinto = self._stream_readinto(stream)
+        errors = []
+        # a buffer for each queued chunk, one being read and one being worked on
+        pool = BufferPool(depth + 2, xfer_size, 2)
+        stages = OrderedDict([
+            ('write', PipelineStage(myfile.write, depth, errors, pool.release)),
+            ('hash', PipelineStage(myhash.update, depth, errors, pool.release))
+        ])
+        read_stats = {'bytes': 0, 'seconds': 0.0}
+        for stage in stages.values():
+            stage.begin()
+        try:
+            while not errors:
+                buf = pool.get()
+                start = perf_counter()
+                size = readinto(buf)
+                read_stats['seconds'] += perf_counter() - start
+                if not size:
+                    break
+                read_stats['bytes'] += size
+                if self._progress:
+                    self._progress()
+                view = memoryview(buf)[:size]
+                for stage in stages.values():
+                    stage.put(view)
+        finally:
+            for stage in stages.values():
+                stage.finish()
+        self._set_pull_stats(read_stats, stages)
+        if errors:
+            raise errors[0]
+    # pylint: enable=too-many-locals
+
+    @staticmethod
+    def _stream_readinto(stream):
+        """
+        Return the readinto to read the stream with.
+
+        The readinto of a urllib3 response reads a new bytes object and
+        copies it into the buffer. When the body isn't content encoded
+        the http.client response under it is read from instead, it
+        reads straight into the buffer. Its errors are raised as the
+        urllib3 ProtocolError urllib3 would have raised. http.client
+        returns no bytes when the connection closes before the
+        Content-Length is read, that is raised too like urllib3 does
+        so the partial file is resumed.
+        """
+        # pylint: disable=protected-access
+        body = getattr(stream, '_fp', None)
+        # pylint: enable=protected-access
+        if body is None or not hasattr(body, 'readinto') or stream.headers.get('content-encoding'):
+            return stream.readinto
+
+        def readinto(buf):
+            """Read into the buffer from the http.client response."""
+            try:
+                size = body.readinto(buf)
+            except (HTTPException, OSError) as ex:
+                raise urllib3.exceptions.ProtocolError(str(ex))
+            if not size and buf and body.length:
+                raise urllib3.exceptions.ProtocolError(
+                    'Connection closed with {} bytes of the body left'.format(body.length))
+            return size
+        return readinto
+
+    def _set_pull_stats(self, read_stats, stages):
+        """Keep the stats of the reads and every stage with their MB/s."""
+        self.pull_stats = {'read': read_stats}
+        self.pull_stats.update({name: stage.stats for name, stage in stages.items()})
+        for stats in self.pull_stats.values():
+            stats['MBps'] = stats['bytes'] / 10**6 / stats['seconds'] if stats['seconds'] else 0.0
+
+    def _log_pull_stats(self, archive_filename):
+        """Log the bytes and MB/s of every stage of the pull."""
+        if self.pull_stats:
+            LOGGER.debug('Pulled %s %s', archive_filename, ', '.join(
+                '{} {} bytes {:.2f} MB/s'.format(name, stats['bytes'], stats['MBps'])
+                for name, stats in self.pull_stats.items()))
+
+    # pylint: disable=too-many-arguments
+    def _pull_slot(self, archive_filename, tar_path, hashval, hashtype, offset, size):
+        """Pull the file into its slot in the tar, from the start every time."""
+        xfer_size = get_config().getsize('cartd', 'transfer_size')
         myhash = hashlib.new(hashtype)
-        while buf:
-            myfile.write(buf)
-            myhash.update(buf)
-            buf = resp.raw.read(xfer_size)
-        myfile.close()
+        with self._session.get(str(self._url + archive_filename), stream=True) as resp:
+            if int(resp.status_code/100) == 5:
+                raise requests.exceptions.RequestException('Status code is 500')
+            with open(tar_path, 'r+b') as myfile:
+                myfile.seek(offset)
+                slot = TarSlot(myfile, size)
+                try:
+                    self._copy_stream(resp.raw, slot, myhash, xfer_size)
+                except urllib3.exceptions.HTTPError as ex:
+                    raise requests.exceptions.ConnectionError(str(ex))
+        if slot.left:
+            raise ValueError('File is smaller than its size in the tar')
+        if myhash.hexdigest() != hashval:
+            raise ValueError('File hash does not match provided hash')
+        self._log_pull_stats(archive_filename)
+    # pylint: enable=too-many-arguments
+
+    @staticmethod
+    def _check_hash(cart_filepath, myhash, hashval):
+        """Raise ValueError and remove the cart file if the hash is wrong."""
         myhashval = myhash.hexdigest()
         if myhashval != hashval:
+            # never resume from bytes that do not hash correctly
+            unlink(cart_filepath)
             raise ValueError('File hash does not match provided hash')
 
+    def _file_size(self, archive_filename):
+        """Get the size of the archive file from a status request, None if it isn't sent."""
+        resp = self._session.head(str(self._url + archive_filename))
+        if int(resp.status_code/100) == 5:
+            raise requests.exceptions.RequestException('Status code is 500')
+        try:
+            return int(resp.headers['x-content-length'])
+        except (KeyError, ValueError):
+            return None
+
+    def _pull_file_parallel(self, archive_filename, cart_filepath, hashval, hashtype):
+        """Pull the file as byte ranges if it is at least parallel_pull_threshold."""
+        filesize = self._file_size(archive_filename)
+        if filesize is None or filesize < get_config().getsize('cartd', 'parallel_pull_threshold'):
+            self._pull_file(archive_filename, cart_filepath, hashval, hashtype)
+            return
+        self._pull_file_ranges(
+            archive_filename, cart_filepath, hashval, hashtype,
+            filesize=filesize, streams=get_config().getint('cartd', 'parallel_pull_streams'))
+
+    # pylint: disable=too-many-arguments
+    def _pull_file_ranges(self, archive_filename, cart_filepath, hashval, hashtype, filesize, streams):
+        """
+        Pull the file as streams byte ranges at the same time.
+
+        The cart file is made filesize long first and every range is
+        written in place. The hash is checked after all the ranges are
+        done. If the archive does not support ranges or the file is
+        smaller than a byte per stream the file is pulled as a single
+        stream instead.
+        """
+        if filesize < streams:
+            self._pull_file(archive_filename, cart_filepath, hashval, hashtype)
+            return
+        xfer_size = get_config().getsize('cartd', 'transfer_size')
+        url = str(self._url + archive_filename)
+        unshare_file(cart_filepath)
+        with open(cart_filepath, 'wb') as myfile:
+            myfile.truncate(filesize)
+        part_size = -(-filesize // streams)
+        with ThreadPoolExecutor(max_workers=streams) as executor:
+            ranged = list(executor.map(
+                lambda start: self._pull_range(url, cart_filepath, start, min(start + part_size, filesize), xfer_size),
+                range(0, filesize, part_size)
+            ))
+        if not all(ranged):
+            unlink(cart_filepath)
+            self._pull_file(archive_filename, cart_filepath, hashval, hashtype)
+            return
+        myhash = hashlib.new(hashtype)
+        self._hash_partial(cart_filepath, myhash, xfer_size)
+        self._check_hash(cart_filepath, myhash, hashval)
+    # pylint: enable=too-many-arguments
+
+    # pylint: disable=too-many-arguments
+    def _pull_range(self, url, cart_filepath, start, end, xfer_size):
+        """Write the bytes from start up to end of the archive file in place."""
+        headers = {'Range': 'bytes={}-{}'.format(start, end - 1)}
+        with self._session.get(url, stream=True, headers=headers) as resp:
+            if int(resp.status_code/100) == 5:
+                raise requests.exceptions.RequestException('Status code is 500')
+            if resp.status_code != 206:
+                return False
+            with open(cart_filepath, 'r+b') as myfile:
+                myfile.seek(start)
+                try:
+                    buf = resp.raw.read(xfer_size)
+                    while buf:
+                        myfile.write(buf)
+                        if self._progress:
+                            self._progress()
+                        buf = resp.raw.read(xfer_size)
+                except urllib3.exceptions.HTTPError as ex:
+                    raise requests.exceptions.ConnectionError(str(ex))
+        return True
+    # pylint: enable=too-many-arguments
+
     def stage_file(self, file_name):
         """Send a post to the archive interface telling it to stage the file."""
-        resp = requests.post(str(self._url + file_name))
+        resp = self._session.post(str(self._url + file_name))
         if str(resp.status_code) == '500':
             raise requests.exceptions.RequestException(str(dumps(resp.text)))
 
@@ -80,5 +506,5 @@ class ArchiveRequests:
 
     def status_file(self, file_name):
         """Get a status from the  archive interface via Head and returns response."""
-        resp = requests.head(str(self._url + file_name))
+        resp = self._session.head(str(self._url + file_name))
         return dumps(self._status_dict(resp.headers, file_name))
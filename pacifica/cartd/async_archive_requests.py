@@ -0,0 +1,146 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Module that is used by the cart to send concurrent requests to the archive interface."""
+from __future__ import absolute_import
+import asyncio
+from json import dumps
+import hashlib
+import requests
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover only without the async extra
+    aiohttp = None
+from .archive_requests import ArchiveRequests, unshare_file
+from .config import get_config
+
+
+class AsyncArchiveRequests:
+    """
+    Class that supports concurrent requests to the archive interface.
+
+    This is the asyncio version of ArchiveRequests and must be used
+    as an async context manager. The number of open connections to
+    the archive interface is limited to the concurrency given.
+    Failed and timed out requests raise
+    requests.exceptions.RequestException so callers can handle errors
+    the same as the synchronous requests. Requests have no total time
+    limit, only async_read_timeout seconds between reads.
+    """
+
+    default_retry_count = ArchiveRequests.default_retry_count
+    default_retry_sleep = ArchiveRequests.default_retry_sleep
+
+    def __init__(self, concurrency=None):
+        """Constructor for setting the AI URL and concurrency."""
+        if aiohttp is None:  # pragma: no cover only without the async extra
+            raise ImportError('aiohttp is required, install pacifica-cartd[async]')
+        self._url = get_config().get('archiveinterface', 'url')
+        if concurrency is None:
+            concurrency = get_config().getint('archiveinterface', 'async_concurrency')
+        self._concurrency = concurrency
+        self._session = None
+
+    async def __aenter__(self):
+        """Open the session to the archive interface."""
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self._concurrency),
+            timeout=aiohttp.ClientTimeout(
+                total=None, sock_read=get_config().getint('archiveinterface', 'async_read_timeout')))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        """Close the session to the archive interface."""
+        await self._session.close()
+
+    # pylint: disable=too-many-arguments
+    async def pull_file(self, archive_filename, cart_filepath, hashval, hashtype, retry=None, progress=None):
+        """
+        Pull file from AI.
+
+        Performs a request that will attempt to write
+        the contents of a file from the archive interface
+        to the specified cart filepath. The progress function is
+        called after every chunk read.
+        """
+        if retry is None:
+            retry = self.default_retry_count
+        while retry:
+            try:
+                await self._pull_file(archive_filename, cart_filepath, hashval, hashtype, progress)
+                retry = 0
+            except (requests.exceptions.RequestException, ValueError) as ex:
+                if retry == 1:
+                    raise ex
+                await asyncio.sleep(self.default_retry_sleep)
+                retry -= 1
+    # pylint: enable=too-many-arguments
+
+    @staticmethod
+    def _write_chunk(myfile, myhash, buf):
+        """Write and hash a chunk of the file."""
+        myfile.write(buf)
+        myhash.update(buf)
+
+    # pylint: disable=too-many-arguments
+    async def _pull_file(self, archive_filename, cart_filepath, hashval, hashtype, progress):
+        """
+        Pull the file resuming after any bytes already in the cart file.
+
+        Like the synchronous pull the bytes on disk are hashed again and
+        only the rest of the file is asked for with a Range header.
+        Writing and hashing run in the default executor to keep the loop
+        free.
+        """
+        xfer_size = get_config().getsize('cartd', 'transfer_size')
+        myhash = hashlib.new(hashtype)
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, unshare_file, cart_filepath)
+        # pylint: disable=protected-access
+        offset = await loop.run_in_executor(None, ArchiveRequests._hash_partial, cart_filepath, myhash, xfer_size)
+        # pylint: enable=protected-access
+        headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+        try:
+            async with self._session.get(str(self._url + archive_filename), headers=headers) as resp:
+                if int(resp.status/100) == 5:
+                    raise requests.exceptions.RequestException('Status code is 500')
+                # 416 means there is nothing after what is already on disk
+                if resp.status != 416:
+                    if resp.status != 206:
+                        myhash = hashlib.new(hashtype)
+                    myfile = await loop.run_in_executor(
+                        None, open, cart_filepath, 'ab' if resp.status == 206 else 'wb')
+                    try:
+                        async for buf in resp.content.iter_chunked(xfer_size):
+                            await loop.run_in_executor(None, self._write_chunk, myfile, myhash, buf)
+                            if progress:
+                                progress()
+                    finally:
+                        await loop.run_in_executor(None, myfile.close)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+            # keep the partial file for the next try to resume
+            raise requests.exceptions.RequestException(str(ex) or 'Timed out waiting for the archive interface')
+        # pylint: disable=protected-access
+        await loop.run_in_executor(None, ArchiveRequests._check_hash, cart_filepath, myhash, hashval)
+        # pylint: enable=protected-access
+    # pylint: enable=too-many-arguments
+
+    async def stage_file(self, file_name):
+        """Send a post to the archive interface telling it to stage the file."""
+        try:
+            async with self._session.post(str(self._url + file_name)) as resp:
+                if str(resp.status) == '500':
+                    raise requests.exceptions.RequestException(str(dumps(await resp.text())))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+            raise requests.exceptions.RequestException(str(ex) or 'Timed out waiting for the archive interface')
+
+    async def status_file(self, file_name):
+        """Get a status from the  archive interface via Head and returns response."""
+        try:
+            async with self._session.head(str(self._url + file_name)) as resp:
+                if int(resp.status/100) == 5:
+                    raise requests.exceptions.RequestException('Status code is 500')
+                # pylint: disable=protected-access
+                return dumps(ArchiveRequests._status_dict(resp.headers, file_name))
+                # pylint: enable=protected-access
+        except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+            raise requests.exceptions.RequestException(str(ex) or 'Timed out waiting for the archive interface')
@@ -0,0 +1,269 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Module that compresses cart downloads using more than one core."""
+from __future__ import absolute_import
+import os
+import time
+import struct
+import tarfile
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+try:
+    import zstandard
+except ImportError:  # pragma: no cover only without the zstd extra
+    zstandard = None
+from .tar_stream import TarStream
+
+# download formats and the extension of their file names
+FORMATS = {
+    'tar': '.tar',
+    'tar.gz': '.tar.gz',
+    'tar.zst': '.tar.zst',
+    'zip': '.zip',
+    'zip-stored': '.zip'
+}
+GZIP_BLOCK_SIZE = 1024 * 1024
+# members, sizes and offsets past this need zip64 records
+ZIP64_LIMIT = zipfile.ZIP64_LIMIT
+ZIP64_VERSION = 45
+# sizes in a data descriptor after the data and utf-8 names
+ZIP_FLAGS = 0x08 | 0x800
+
+
+def available_formats():
+    """Return the formats that can be made with the installed modules."""
+    return [fmt for fmt in FORMATS if fmt != 'tar.zst' or zstandard is not None]
+
+
+def _reblock(chunks, block_size):
+    """Yield the data of chunks in blocks of block_size."""
+    block = bytearray()
+    for chunk in chunks:
+        block += chunk
+        while len(block) >= block_size:
+            yield bytes(block[:block_size])
+            del block[:block_size]
+    if block:
+        yield bytes(block)
+
+
+def _ordered_map(executor, func, items, ahead):
+    """Map func over items in the executor yielding results in order."""
+    futures = deque()
+    for item in items:
+        futures.append(executor.submit(func, item))
+        if len(futures) >= ahead:
+            yield futures.popleft().result()
+    while futures:
+        yield futures.popleft().result()
+
+
+def _deflate_block(level, block):
+    """Compress a block as raw deflate ending on a byte boundary."""
+    compobj = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compobj.compress(block) + compobj.flush(zlib.Z_SYNC_FLUSH)
+
+
+def _deflate_blocks(executor, workers, blocks, level):
+    """
+    Yield one raw deflate stream of the blocks compressed by the workers.
+
+    Every block is sync flushed so the blocks join into one deflate
+    stream (as pigz does), an empty final block ends the stream.
+    """
+    for compressed in _ordered_map(executor, partial(_deflate_block, level), blocks, workers * 2):
+        if compressed:
+            yield compressed
+    yield zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS).flush(zlib.Z_FINISH)
+
+
+def _checked_blocks(chunks, block_size, totals):
+    """Yield the data of chunks in blocks keeping the checksum and size of the data."""
+    for block in _reblock(chunks, block_size):
+        totals['crc'] = zlib.crc32(block, totals['crc'])
+        totals['size'] += len(block)
+        yield block
+
+
+def gzip_stream(chunks, workers, level=6):
+    """
+    Compress the chunks to a gzip stream.
+
+    The data is cut into blocks compressed at the same time by the
+    workers and joined into one deflate stream that any gzip reader
+    can read.
+    """
+    totals = {'crc': 0, 'size': 0}
+    yield b'\x1f\x8b\x08\x00' + struct.pack('<I', int(time.time())) + b'\x00\xff'
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        yield from _deflate_blocks(executor, workers, _checked_blocks(chunks, GZIP_BLOCK_SIZE, totals), level)
+    yield struct.pack('<II', totals['crc'], totals['size'] & 0xffffffff)
+
+
+def zstd_stream(chunks, workers, level=3):
+    """Compress the chunks to a zstd stream with workers threads."""
+    compobj = zstandard.ZstdCompressor(level=level, threads=workers).compressobj()
+    for chunk in chunks:
+        compressed = compobj.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compobj.flush()
+
+
+def _dos_time(mtime):
+    """Return the MS-DOS time and date of the mtime for a zip header."""
+    year, month, day, hour, minute, second = max(time.localtime(mtime)[:6], (1980, 1, 1, 0, 0, 0))
+    return hour << 11 | minute << 5 | second // 2, (year - 1980) << 9 | month << 5 | day
+
+
+def _open_chunks(opener, xfer_size):
+    """Yield the data of a member."""
+    with opener() as src:
+        buf = src.read(xfer_size)
+        while buf:
+            yield buf
+            buf = src.read(xfer_size)
+
+
+# pylint: disable=too-many-locals
+def _zip_central_directory(entries, cd_offset):
+    """
+    Yield the central directory and the end of the zip.
+
+    Sizes and offsets past ZIP64_LIMIT go in a zip64 extra field and
+    the zip gets the zip64 end records when it needs them.
+    """
+    cd_size = 0
+    for name, version, compress_type, dostime, dosdate, crc, compress_size, size, offset in entries:
+        fields = []
+        if size > ZIP64_LIMIT:
+            fields.append(size)
+            size = 0xffffffff
+        if compress_size > ZIP64_LIMIT:
+            fields.append(compress_size)
+            compress_size = 0xffffffff
+        if offset > ZIP64_LIMIT:
+            fields.append(offset)
+            offset = 0xffffffff
+        extra = struct.pack('<HH' + 'Q' * len(fields), 1, 8 * len(fields), *fields) if fields else b''
+        if fields:
+            version = ZIP64_VERSION
+        record = struct.pack(
+            '<IBBBBHHHHIIIHHHHHII', 0x02014b50, version, 3, version, 0, ZIP_FLAGS, compress_type,
+            dostime, dosdate, crc, compress_size, size, len(name), len(extra), 0, 0, 0, 0o100644 << 16, offset
+        ) + name + extra
+        cd_size += len(record)
+        yield record
+    count = len(entries)
+    if count >= 0xffff or cd_size > ZIP64_LIMIT or cd_offset > ZIP64_LIMIT:
+        yield struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, ZIP64_VERSION, ZIP64_VERSION, 0, 0,
+                          count, count, cd_size, cd_offset)
+        yield struct.pack('<IIQI', 0x07064b50, 0, cd_offset + cd_size, 1)
+    yield struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, min(count, 0xffff), min(count, 0xffff),
+                      min(cd_size, 0xffffffff), min(cd_offset, 0xffffffff), 0)
+
+
+def zip_stream(members, compress_type, xfer_size, workers, level=6):
+    """
+    Write the members to a zip stream.
+
+    Members are tuples of the name, mtime, size and a function
+    opening the data. The zip is streamed with data descriptors after
+    every member since it can't seek back to the headers. Deflated
+    members are cut into blocks compressed at the same time by the
+    workers like gzip_stream does.
+    """
+    entries = []
+    offset = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for arcname, mtime, size, opener in members:
+            name = arcname.encode('utf-8')
+            # the size is only known after the data, zipfile guesses the same way
+            zip64 = size * 1.05 > ZIP64_LIMIT
+            version = ZIP64_VERSION if zip64 else 20
+            dostime, dosdate = _dos_time(mtime)
+            extra = struct.pack('<HHQQ', 1, 16, 0, 0) if zip64 else b''
+            header = struct.pack(
+                '<IBBHHHHIIIHH', 0x04034b50, version, 0, ZIP_FLAGS, compress_type, dostime, dosdate,
+                0, 0xffffffff if zip64 else 0, 0xffffffff if zip64 else 0, len(name), len(extra)
+            ) + name + extra
+            yield header
+            totals = {'crc': 0, 'size': 0}
+            data = _checked_blocks(_open_chunks(opener, xfer_size), xfer_size, totals)
+            if compress_type == zipfile.ZIP_DEFLATED:
+                data = _deflate_blocks(executor, workers, _reblock(data, GZIP_BLOCK_SIZE), level)
+            compress_size = 0
+            for chunk in data:
+                compress_size += len(chunk)
+                yield chunk
+            descriptor = struct.pack(
+                '<IIQQ' if zip64 else '<IIII', 0x08074b50, totals['crc'], compress_size, totals['size'])
+            yield descriptor
+            entries.append((name, version, compress_type, dostime, dosdate, totals['crc'],
+                            compress_size, totals['size'], offset))
+            offset += len(header) + compress_size + len(descriptor)
+    yield from _zip_central_directory(entries, offset)
+# pylint: enable=too-many-locals
+
+
+def dir_members(path, arcname):
+    """Yield the zip members of the files in a directory in sorted order."""
+    for name in sorted(os.listdir(path)):
+        filepath = os.path.join(path, name)
+        if os.path.isdir(filepath):
+            yield from dir_members(filepath, os.path.join(arcname, name))
+        elif os.path.isfile(filepath):
+            stat = os.stat(filepath)
+            yield os.path.join(arcname, name), stat.st_mtime, stat.st_size, partial(open, filepath, 'rb')
+
+
+def tar_members(tar_path, arcname):
+    """
+    Yield the zip members of the files in a tar.
+
+    The directory at the top of the tar is named arcname in the zip
+    like the files of a streamed cart. Hard links to a file earlier in
+    the tar, like two files of a cart linked from the same file in the
+    store, have the data of the file they link to.
+    """
+    sizes = {}
+    with tarfile.open(tar_path) as mytar:
+        for member in mytar:
+            name = os.path.join(arcname, *member.name.split('/')[1:])
+            if member.isreg():
+                sizes[member.name] = member.size
+                yield name, member.mtime, member.size, partial(mytar.extractfile, member)
+            elif member.islnk() and member.linkname in sizes:
+                yield name, member.mtime, sizes[member.linkname], partial(mytar.extractfile, member)
+
+
+def file_chunks(path, xfer_size):
+    """Yield the data of a file."""
+    with open(path, 'rb') as myfile:
+        buf = myfile.read(xfer_size)
+        while buf:
+            yield buf
+            buf = myfile.read(xfer_size)
+
+
+def compress_cart(fmt, cart_path, arcname, xfer_size, workers):
+    """
+    Return chunks of the cart in a compressed format.
+
+    The cart path is either the directory of a streamed cart or the
+    tar of a bundled cart.
+    """
+    if fmt.startswith('zip'):
+        members = dir_members(cart_path, arcname) if os.path.isdir(cart_path) else tar_members(cart_path, arcname)
+        return zip_stream(
+            members, zipfile.ZIP_STORED if fmt == 'zip-stored' else zipfile.ZIP_DEFLATED, xfer_size, workers)
+    if os.path.isdir(cart_path):
+        chunks = iter(TarStream(cart_path, arcname, xfer_size))
+    else:
+        chunks = file_chunks(cart_path, xfer_size)
+    if fmt == 'tar.zst':
+        return zstd_stream(chunks, workers)
+    return gzip_stream(chunks, workers)
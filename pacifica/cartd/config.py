@@ -1,47 +1,122 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
-"""Configuration reading and validation module."""
-from os import getenv
+"""
+Configuration reading and validation module.
+
+The configuration is read once and cached until the config file
+changes or reload_config is called. The modification time of the
+file is checked at most every CONFIG_CHECK_INTERVAL seconds.
+"""
+from os import getenv, stat
+from time import monotonic
+from functools import lru_cache
 import logging
 from configparser import ConfigParser as SafeConfigParser
 from .globals import CONFIG_FILE
 
+# section, option, environment variable and default of every option
+CONFIG_OPTIONS = [
+    ('cartd', 'transfer_size', 'TRANSFER_SIZE', '4 Mb'),
+    ('cartd', 'volume_path', 'VOLUME_PATH', '/tmp/'),
+    ('cartd', 'lru_buffer_time', 'LRU_BUFFER_TIME', '0'),
+    ('cartd', 'lru_purge', 'LRU_PURGE', 'on'),
+    ('cartd', 'evict_high_watermark', 'EVICT_HIGH_WATERMARK', '90'),
+    ('cartd', 'evict_low_watermark', 'EVICT_LOW_WATERMARK', '80'),
+    ('cartd', 'evict_batch_size', 'EVICT_BATCH_SIZE', '10'),
+    ('cartd', 'evict_interval', 'EVICT_INTERVAL', '60'),
+    ('cartd', 'bundle_task', 'BUNDLE_TASK', 'off'),
+    ('cartd', 'status_poll_interval', 'STATUS_POLL_INTERVAL', '10'),
+    ('cartd', 'status_poll_max', 'STATUS_POLL_MAX', '600'),
+    ('cartd', 'status_poll_timeout', 'STATUS_POLL_TIMEOUT', '604800'),
+    ('cartd', 'stage_chunk_size', 'STAGE_CHUNK_SIZE', '1'),
+    ('cartd', 'async_mode', 'ASYNC_MODE', 'off'),
+    ('cartd', 'parallel_pull_streams', 'PARALLEL_PULL_STREAMS', '1'),
+    ('cartd', 'parallel_pull_threshold', 'PARALLEL_PULL_THRESHOLD', '1 Gb'),
+    ('cartd', 'pull_pipeline_depth', 'PULL_PIPELINE_DEPTH', '0'),
+    ('cartd', 'content_store', 'CONTENT_STORE', 'off'),
+    ('cartd', 'pull_lease_time', 'PULL_LEASE_TIME', '3600'),
+    ('cartd', 'bundle_offload', 'BUNDLE_OFFLOAD', 'off'),
+    ('cartd', 'bundle_offload_prefix', 'BUNDLE_OFFLOAD_PREFIX', '/cartd-bundles/'),
+    ('cartd', 'compress_workers', 'COMPRESS_WORKERS', '0'),
+    ('cartd', 'bundle_direct', 'BUNDLE_DIRECT', 'off'),
+    ('database', 'peewee_url', 'PEEWEE_URL', 'sqliteext:///db.sqlite3'),
+    ('database', 'debug_logging', 'DATABASE_DEBUG_LOGGING', 'False'),
+    ('database', 'connect_attempts', 'DATABASE_CONNECT_ATTEMPTS', '10'),
+    ('database', 'connect_wait', 'DATABASE_CONNECT_WAIT', '20'),
+    ('archiveinterface', 'url', 'ARCHIVE_INTERFACE_URL', 'http://127.0.0.1:8080/'),
+    ('archiveinterface', 'pool_size', 'ARCHIVE_INTERFACE_POOL_SIZE', '10'),
+    ('archiveinterface', 'retries', 'ARCHIVE_INTERFACE_RETRIES', '3'),
+    ('archiveinterface', 'retry_backoff', 'ARCHIVE_INTERFACE_RETRY_BACKOFF', '0.5'),
+    ('archiveinterface', 'async_concurrency', 'ARCHIVE_INTERFACE_ASYNC_CONCURRENCY', '32'),
+    ('archiveinterface', 'async_read_timeout', 'ARCHIVE_INTERFACE_ASYNC_READ_TIMEOUT', '300'),
+    ('celery', 'broker_url', 'BROKER_URL', 'pyamqp://'),
+    ('celery', 'backend_url', 'BACKEND_URL', 'rpc://'),
+]
+CONFIG_CHECK_INTERVAL = 5
+CONFIG_CACHE = {}
 
-def get_config():
-    """Return the ConfigParser object with defaults set."""
-    configparser = SafeConfigParser()
-    configparser.add_section('cartd')
-    configparser.set('cartd', 'transfer_size', getenv(
-        'TRANSFER_SIZE', '4 Mb'))
-    configparser.set('cartd', 'volume_path', getenv(
-        'VOLUME_PATH', '/tmp/'))
-    configparser.set('cartd', 'lru_buffer_time', getenv(
-        'LRU_BUFFER_TIME', '0'))
-    configparser.set('cartd', 'lru_purge', getenv(
-        'LRU_PURGE', 'on'))
-    configparser.set('cartd', 'bundle_task', getenv(
-        'BUNDLE_TASK', 'off'))
-    configparser.add_section('database')
-    configparser.set('database', 'peewee_url', getenv(
-        'PEEWEE_URL', 'sqliteext:///db.sqlite3'))
-    configparser.set('database', 'debug_logging', getenv(
-        'DATABASE_DEBUG_LOGGING', 'False'))
-    configparser.set('database', 'connect_attempts', getenv(
-        'DATABASE_CONNECT_ATTEMPTS', '10'))
-    configparser.set('database', 'connect_wait', getenv(
-        'DATABASE_CONNECT_WAIT', '20'))
-    configparser.add_section('archiveinterface')
-    configparser.set('archiveinterface', 'url', getenv(
-        'ARCHIVE_INTERFACE_URL', 'http://127.0.0.1:8080/'))
-    configparser.add_section('celery')
-    configparser.set('celery', 'broker_url', getenv(
-        'BROKER_URL', 'pyamqp://'))
-    configparser.set('celery', 'backend_url', getenv(
-        'BACKEND_URL', 'rpc://'))
+
+def parse_size(size):
+    """Parse size string to integer."""
+    units = {
+        'B': 1, 'KB': 10**3, 'MB': 10**6, 'GB': 10**9, 'TB': 10**12,
+        'b': 1, 'Kb': 1024, 'Mb': 1024**2, 'Gb': 1024**3, 'Tb': 1024**4
+    }
+    number, unit = [string.strip() for string in size.split()]
+    return int(float(number)*units[unit])
+
+
+def read_config(values):
+    """
+    Return a new ConfigParser with the values set and the config file read.
+
+    The values are in the order of CONFIG_OPTIONS, getsize returns
+    sizes like transfer_size parsed to bytes, each size is only parsed
+    once.
+    """
+    configparser = SafeConfigParser(converters={'size': lru_cache(maxsize=None)(parse_size)})
+    for (section, option, _env, _default), value in zip(CONFIG_OPTIONS, values):
+        if not configparser.has_section(section):
+            configparser.add_section(section)
+        configparser.set(section, option, value)
     configparser.read(CONFIG_FILE)
     return configparser
 
 
+def _config_mtime():
+    """Return the modification time of the config file or None."""
+    try:
+        return stat(CONFIG_FILE).st_mtime_ns
+    except OSError:
+        return None
+
+
+def get_config():
+    """
+    Return the ConfigParser object with defaults set.
+
+    The object is shared, callers must not change it. Environment
+    variables are only read when the configuration is read again.
+    """
+    # the parser, the mtime it was read at and when the mtime was checked
+    cached = CONFIG_CACHE.get('config')
+    now = monotonic()
+    if cached and now - cached[2] < CONFIG_CHECK_INTERVAL:
+        return cached[0]
+    mtime = _config_mtime()
+    if cached and cached[1] == mtime:
+        configparser = cached[0]
+    else:
+        configparser = read_config([getenv(env, default) for _section, _option, env, default in CONFIG_OPTIONS])
+    CONFIG_CACHE['config'] = (configparser, mtime, now)
+    return configparser
+
+
+def reload_config(*_args):
+    """Drop the cached configuration so it is read again."""
+    CONFIG_CACHE.clear()
+
+
 if get_config().getboolean('database', 'debug_logging'):  # pragma: no cover used for debugging
     LOGGER = logging.getLogger('peewee')
     LOGGER.setLevel(logging.DEBUG)
@@ -2,15 +2,74 @@
 # -*- coding: utf-8 -*-
 """Handle fixing broken carts with admin functions."""
 from os import utime
-from tqdm import trange
+from os.path import getsize
+from time import time, sleep
+from threading import local
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tqdm import tqdm, trange
 from .orm import Cart, File
 from .utils import Cartutils
-from .archive_requests import ArchiveRequests
+from .archive_requests import ArchiveRequests, new_session
+from .config import get_config
+
+# the archive session of each fixit thread
+THREAD_SESSION = local()
+
+
+def thread_session():
+    """Return the archive session of this thread, created on first use."""
+    if not hasattr(THREAD_SESSION, 'session'):
+        THREAD_SESSION.session = new_session()
+    return THREAD_SESSION.session
+
+
+def fix_file(file_id):
+    """
+    Stage and pull one file of the cart, return the bytes pulled.
+
+    Each call runs in a thread of the pool so it loads its own file
+    and cart and uses the archive session of its thread. The archive is asked for
+    the status every status_poll_interval seconds until the file is
+    ready.
+    """
+    try:
+        cart_utils = Cartutils()
+        archive_request = ArchiveRequests(thread_session())
+        c_file = File.get(File.id == file_id)
+        cart_obj = Cart.get(Cart.id == c_file.cart_id)
+        cart_utils.set_file_status(c_file, cart_obj, 'staging', False)
+        archive_request.stage_file(c_file.file_name)
+        while True:
+            response = archive_request.status_file(c_file.file_name)
+            ready = cart_utils.check_file_ready_pull(response, c_file, cart_obj)
+            if isinstance(ready, int) and ready < 0:
+                raise ValueError(c_file.error)
+            if ready:
+                break
+            sleep(get_config().getint('cartd', 'status_poll_interval'))
+        archive_request.pull_file(
+            c_file.file_name, ready['filepath'], c_file.hash_value, c_file.hash_type)
+        modtime = ready['modtime']
+        utime(ready['filepath'], (int(float(modtime)), int(float(modtime))))
+        size = getsize(ready['filepath'])
+        cart_utils.bundle_file(cart_obj, ready['filepath'])
+        cart_utils.set_file_status(c_file, cart_obj, 'staged', False)
+        return size
+    finally:
+        # each thread has its own connection
+        Cart.database_close()
 
 
-@Cart.atomic()
 def fixit(args):
-    """Entrypoint for admin command to fix cartids."""
+    """
+    Entrypoint for admin command to fix cartids.
+
+    Files are fixed by args.jobs threads at once and each file
+    saves its own progress, the files and bytes per second are
+    reported as the files finish. The first file to fail stops the
+    files not started yet and its error is raised.
+    """
+    jobs = getattr(args, 'jobs', 1)
     for cart_index in trange(len(args.cartids), desc='Total Carts'):
         cart_id = args.cartids[cart_index]
         cart_obj = (Cart
@@ -22,25 +81,20 @@ def fixit(args):
                     .get())
         cart_obj.status = 'staging'
         cart_obj.save()
-        cart_utils = Cartutils()
-        archive_request = ArchiveRequests()
-        file_list = list(File.select().where(File.cart == cart_obj.id).execute())
-        for file_index in trange(len(file_list), desc='Number of Files'):
-            c_file = file_list[file_index]
-            if c_file.status == 'staged':
-                continue
-            cart_utils.set_file_status(c_file, cart_obj, 'staging', False)
-            ready = False
-            while not ready:
-                archive_request.stage_file(c_file.file_name)
-                response = archive_request.status_file(c_file.file_name)
-                ready = cart_utils.check_file_ready_pull(response, c_file, cart_obj)
-                if isinstance(ready, int) and ready < 0:  # pragma: no cover hard to get here with error
-                    raise c_file.error
-                if ready:
-                    archive_request.pull_file(
-                        c_file.file_name, ready['filepath'], c_file.hash_value, c_file.hash_type)
-                    cart_utils.set_file_status(c_file, cart_obj, 'staged', False)
-                    modtime = ready['modtime']
-                    utime(ready['filepath'], (int(float(modtime)), int(float(modtime))))
-        cart_utils.prepare_bundle(cart_obj.id)
+        file_ids = [c_file.id for c_file in File.select(File.id).where(
+            (File.cart == cart_obj.id) & (File.status != 'staged'))]
+        start_time = time()
+        total_bytes = 0
+        with ThreadPoolExecutor(max_workers=jobs) as executor, \
+                tqdm(total=len(file_ids), desc='Number of Files') as progress:
+            futures = [executor.submit(fix_file, file_id) for file_id in file_ids]
+            try:
+                for future in as_completed(futures):
+                    total_bytes += future.result()
+                    progress.update()
+                    progress.set_postfix(MBps='{:.2f}'.format(total_bytes / 10**6 / max(time() - start_time, 1e-6)))
+            finally:
+                # don't start the files left after a failure
+                for future in futures:
+                    future.cancel()
+        Cartutils().prepare_bundle(cart_obj.id)
@@ -10,7 +10,7 @@ Using PeeWee to implement the ORM.
 # pylint: disable=invalid-name
 import datetime
 import time
-from peewee import AutoField, IntegerField, CharField, DateTimeField
+from peewee import AutoField, IntegerField, BigIntegerField, CharField, DateTimeField
 from peewee import ForeignKeyField, TextField, BooleanField
 from peewee import Model, OperationalError
 from playhouse.migrate import SchemaMigrator, migrate
@@ -18,7 +18,7 @@ from playhouse.db_url import connect
 from .config import get_config
 
 SCHEMA_MAJOR = 2
-SCHEMA_MINOR = 0
+SCHEMA_MINOR = 5
 DB = connect(get_config().get('database', 'peewee_url'))
 
 
@@ -56,7 +56,12 @@ class OrmSync:
     versions = [
         (0, 1),
         (1, 0),
-        (2, 0)
+        (2, 0),
+        (2, 1),
+        (2, 2),
+        (2, 3),
+        (2, 4),
+        (2, 5)
     ]
 
     @staticmethod
@@ -77,7 +82,7 @@ class OrmSync:
     @staticmethod
     def create_tables():
         """Create the tables if they don't exist."""
-        for cls in [CartSystem, Cart, File, CartTasks]:
+        for cls in [CartSystem, Cart, File, CartTasks, SpaceReservation]:
             if not cls.table_exists():
                 cls.create_table()
         return CartSystem.get_or_create_version()
@@ -99,6 +104,58 @@ class OrmSync:
         """Update by adding the boolean column."""
         CartTasks.create_table()
 
+    @classmethod
+    def update_2_0_to_2_1(cls):
+        """Update by adding the space reservation table."""
+        SpaceReservation.create_table()
+
+    @classmethod
+    def update_2_1_to_2_2(cls):
+        """Update by adding the cart access time column, carts were last accessed when updated."""
+        migrator = SchemaMigrator(DB)
+        migrate(
+            migrator.add_column(
+                'cart',
+                'accessed_date',
+                DateTimeField(default=datetime.datetime.now, null=True)
+            )
+        )
+        # pylint: disable=no-value-for-parameter
+        Cart.update(accessed_date=Cart.updated_date).execute()
+        # pylint: enable=no-value-for-parameter
+
+    @classmethod
+    def update_2_2_to_2_3(cls):
+        """Update by adding the file and cart size columns."""
+        migrator = SchemaMigrator(DB)
+        migrate(
+            migrator.add_column('cart', 'size', BigIntegerField(default=0, null=True)),
+            migrator.add_column('cart', 'staged_size', BigIntegerField(default=0, null=True)),
+            migrator.add_column('file', 'size', BigIntegerField(default=0, null=True))
+        )
+        # pylint: disable=no-value-for-parameter
+        Cart.update(size=0, staged_size=0).execute()
+        File.update(size=0).execute()
+        # pylint: enable=no-value-for-parameter
+
+    @classmethod
+    def update_2_3_to_2_4(cls):
+        """Update by adding the indexes for looking up carts and their files."""
+        migrator = SchemaMigrator(DB)
+        migrate(
+            migrator.add_index('cart', ('cart_uid', 'deleted_date', 'creation_date'), False),
+            migrator.add_index('cart', ('deleted_date', 'accessed_date'), False),
+            migrator.add_index('file', ('cart_id', 'status'), False)
+        )
+
+    @classmethod
+    def update_2_4_to_2_5(cls):
+        """Update by adding the index for looking up files by hash."""
+        migrator = SchemaMigrator(DB)
+        migrate(
+            migrator.add_index('file', ('hash_type', 'hash_value'), False)
+        )
+
     @classmethod
     def update_tables(cls):
         """Update the database to the current version."""
@@ -155,6 +212,8 @@ class CartBase(Model):
         """Meta object containing the database connection."""
 
         database = DB  # This model uses the pacifica_cart database.
+        # sizes are added to in the database, only write what was changed
+        only_save_dirty = True
 
     def reload(self):
         """Reload my current state from the DB."""
@@ -215,12 +274,23 @@ class Cart(CartBase):
     cart_uid = CharField(default=1)
     bundle_path = CharField(default='')
     bundle = BooleanField(default=False, null=True)
+    size = BigIntegerField(default=0, null=True)
+    staged_size = BigIntegerField(default=0, null=True)
     creation_date = DateTimeField(default=datetime.datetime.now)
     updated_date = DateTimeField(default=datetime.datetime.now)
+    accessed_date = DateTimeField(default=datetime.datetime.now, null=True)
     deleted_date = DateTimeField(null=True)
     status = TextField(default='waiting')
     error = TextField(default='')
 
+    class Meta:
+        """Indexes for carts by uid and for eviction."""
+
+        indexes = (
+            (('cart_uid', 'deleted_date', 'creation_date'), False),
+            (('deleted_date', 'accessed_date'), False),
+        )
+
 
 class CartTasks(CartBase):
     """List of tasks based on a cart ID."""
@@ -238,5 +308,29 @@ class File(CartBase):
     bundle_path = CharField(default='')
     hash_type = CharField(null=True)
     hash_value = CharField(null=True)
+    size = BigIntegerField(default=0, null=True)
     status = TextField(default='waiting')
     error = TextField(default='')
+
+    class Meta:
+        """Index for the files of a cart by status and the files with a hash."""
+
+        indexes = (
+            (('cart', 'status'), False),
+            (('hash_type', 'hash_value'), False),
+        )
+
+
+class SpaceReservation(CartBase):
+    """
+    Space on the volume held for a file being pulled.
+
+    Each file pulled reserves its size before the pull starts and
+    releases it when it is staged or fails, so concurrent pulls don't
+    count the same free space.
+    """
+
+    file = ForeignKeyField(File, primary_key=True, backref='reservation')
+    cart = ForeignKeyField(Cart, index=True)
+    size = BigIntegerField(default=0)
+    reserved_date = DateTimeField(default=datetime.datetime.now)
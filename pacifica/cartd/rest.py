@@ -6,16 +6,16 @@ Class for the cart interface.
 Allows API to file interactions.
 """
 import os
-from threading import Thread
 from datetime import datetime
-from sys import stderr
-from tarfile import TarFile
 from json import dumps
+from urllib.parse import quote
 from jsonschema import validate
 import cherrypy
-from cherrypy.lib import static
+from cherrypy.lib import static, httputil
 from .tasks import stage_files, CART_APP
-from .utils import Cartutils, parse_size
+from .utils import Cartutils
+from .tar_stream import TarStream
+from .compress import FORMATS, available_formats, compress_cart
 from .orm import Cart, CartTasks
 from .config import get_config
 
@@ -75,12 +75,15 @@ class CartRoot:
     # pylint: disable=invalid-name
     @staticmethod
     def GET(uid=None, **kwargs):
-        """Download the tar file created by the cart."""
+        """Download the tar file created by the cart, or a compressed format of it."""
         if not uid:
             cherrypy.response.headers['Content-Type'] = 'application/json'
             return bytes(dumps({'message': 'Pacifica Cartd Interface Up and Running'}), 'utf8')
+        fmt = kwargs.get('format', 'tar')
+        if fmt not in available_formats():
+            raise cherrypy.HTTPError(400, 'Unsupported format {}'.format(fmt))
         rtn_name = kwargs.get(
-            'filename', 'data_' + datetime.now().strftime('%Y_%m_%d_%H_%M_%S') + '.tar')
+            'filename', 'data_' + datetime.now().strftime('%Y_%m_%d_%H_%M_%S') + FORMATS[fmt])
         # get the bundle path if available
         cart_utils = Cartutils()
         Cart.database_connect()
@@ -94,47 +97,88 @@ class CartRoot:
             # cart not found
             raise cherrypy.HTTPError(
                 404, 'The cart does not exist or has already been deleted')
+        if fmt != 'tar' and os.path.exists(cart_path):
+            return CartRoot._compress_cart(cart_path, rtn_name, fmt)
         if os.path.isdir(cart_path):
-            # give back bundle here
-            stderr.flush()
-            # want to stream the tar file out
-            (rpipe, wpipe) = os.pipe()
-            rfd = os.fdopen(rpipe, 'rb')
-            wfd = os.fdopen(wpipe, 'wb')
-
-            def do_work():
-                """The child thread writes the data to the pipe."""
-                mytar = TarFile.open(fileobj=wfd, mode='w|')
-                mytar.add(cart_path, arcname=rtn_name.replace('.tar', ''))
-                mytar.close()
-                wfd.close()
-            # open the pipe as a file
-            wthread = Thread(target=do_work)
-            wthread.daemon = True
-            wthread.start()
-            cherrypy.response.stream = True
-            cherrypy.response.headers['Content-Type'] = 'application/octet-stream'
-            cherrypy.response.headers['Content-Disposition'] = 'attachment; filename={}'.format(
-                rtn_name)
-
-            xfer_size = parse_size(get_config().get('cartd', 'transfer_size'))
-
-            def read():
-                """read some size from rfd."""
-                buf = rfd.read(xfer_size)
-                while buf:
-                    yield buf
-                    buf = rfd.read(xfer_size)
-                wthread.join()
-            return read()
+            return CartRoot._stream_cart(cart_path, rtn_name)
         if os.path.isfile(cart_path):
+            return CartRoot._serve_bundle(cart_path, rtn_name)
+        raise cherrypy.HTTPError(404, 'Not Found')
+
+    @staticmethod
+    def _compress_cart(cart_path, rtn_name, fmt):
+        """
+        Stream the cart compressed as it is sent.
+
+        The size isn't known until the end so these downloads have no
+        Content-Length or ranges.
+        """
+        arcname = rtn_name[:-len(FORMATS[fmt])] if rtn_name.endswith(FORMATS[fmt]) else rtn_name
+        workers = get_config().getint('cartd', 'compress_workers') or os.cpu_count()
+        xfer_size = get_config().getsize('cartd', 'transfer_size')
+        cherrypy.response.stream = True
+        cherrypy.response.headers['Content-Type'] = 'application/octet-stream'
+        cherrypy.response.headers['Content-Disposition'] = 'attachment; filename={}'.format(
+            rtn_name)
+        return compress_cart(fmt, cart_path, arcname, xfer_size, workers)
+
+    @staticmethod
+    def _serve_bundle(cart_path, rtn_name):
+        """
+        Send the bundled tar file of a cart.
+
+        With bundle_offload set the web server in front of the cart
+        sends the file itself (with sendfile) from the path in the
+        X-Sendfile or X-Accel-Redirect header, otherwise it is read
+        through CherryPy.
+        """
+        offload = get_config().get('cartd', 'bundle_offload')
+        if offload == 'x-sendfile':
+            cherrypy.response.headers['X-Sendfile'] = cart_path
+        elif offload == 'x-accel-redirect':
+            vol_path = get_config().get('cartd', 'volume_path')
+            cherrypy.response.headers['X-Accel-Redirect'] = '{}{}'.format(
+                get_config().get('cartd', 'bundle_offload_prefix'),
+                quote(os.path.relpath(cart_path, vol_path).replace(os.path.sep, '/')))
+        else:
             return static.serve_file(
                 cart_path,
                 'application/octet-stream',
                 'attachment',
                 rtn_name
             )
-        raise cherrypy.HTTPError(404, 'Not Found')
+        cherrypy.response.headers['Content-Type'] = 'application/octet-stream'
+        cherrypy.response.headers['Content-Disposition'] = 'attachment; filename="{}"'.format(
+            rtn_name)
+        return b''
+
+    @staticmethod
+    def _stream_cart(cart_path, rtn_name):
+        """
+        Stream the cart directory as a tar file.
+
+        A single byte range of the tar is sent if the client asks for
+        one, several ranges get the whole tar.
+        """
+        xfer_size = get_config().getsize('cartd', 'transfer_size')
+        tar_stream = TarStream(cart_path, rtn_name.replace('.tar', ''), xfer_size)
+        start, stop = 0, tar_stream.size
+        ranges = httputil.get_ranges(cherrypy.request.headers.get('Range'), tar_stream.size)
+        if ranges == []:
+            cherrypy.response.headers['Content-Range'] = 'bytes */{}'.format(tar_stream.size)
+            raise cherrypy.HTTPError(416, 'Requested Range Not Satisfiable')
+        if ranges and len(ranges) == 1:
+            start, stop = ranges[0][0], min(ranges[0][1], tar_stream.size)
+            cherrypy.response.status = '206 Partial Content'
+            cherrypy.response.headers['Content-Range'] = 'bytes {}-{}/{}'.format(
+                start, stop - 1, tar_stream.size)
+        cherrypy.response.stream = True
+        cherrypy.response.headers['Accept-Ranges'] = 'bytes'
+        cherrypy.response.headers['Content-Type'] = 'application/octet-stream'
+        cherrypy.response.headers['Content-Disposition'] = 'attachment; filename={}'.format(
+            rtn_name)
+        cherrypy.response.headers['Content-Length'] = str(stop - start)
+        return tar_stream.iter_range(start, stop)
 
     # Cherrypy requires these named methods.
     # pylint: disable=invalid-name
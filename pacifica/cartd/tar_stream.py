@@ -0,0 +1,92 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Module that streams a cart directory as a tar file."""
+from __future__ import absolute_import
+import io
+import os
+import tarfile
+from bisect import bisect_right
+
+
+class TarStream:
+    """
+    Tar file of a directory as a stream of chunks.
+
+    The tar headers of every member are made before streaming by
+    walking the directory the same as TarFile.add, so the size of the
+    tar and the offset of every member are known up front. Iterating
+    yields each header followed by the file data read in chunks of
+    xfer_size, any byte range of the tar can be streamed by seeking
+    straight to the member it starts in. Nothing runs in another
+    thread, so a client going away closes the iterator and the open
+    file with it.
+    """
+
+    def __init__(self, path, arcname, xfer_size):
+        """Walk the directory to get the members and size of the tar."""
+        self.xfer_size = xfer_size
+        self.members = []
+        mytar = tarfile.open(fileobj=io.BytesIO(), mode='w')
+        self._add_members(mytar, path, arcname)
+        self.offsets = []
+        offset = 0
+        for header, _path, size in self.members:
+            self.offsets.append(offset)
+            offset += len(header) + size + len(self._padding(size, tarfile.BLOCKSIZE))
+        # two empty blocks end the tar, filled out to a full record
+        offset += tarfile.BLOCKSIZE * 2
+        self.end = bytes(tarfile.BLOCKSIZE * 2) + self._padding(offset, tarfile.RECORDSIZE)
+        self.size = offset - tarfile.BLOCKSIZE * 2 + len(self.end)
+
+    def _add_members(self, mytar, path, arcname):
+        """Add the header, path and data size of path and everything under it."""
+        tarinfo = mytar.gettarinfo(path, arcname)
+        if tarinfo is None:  # pragma: no cover sockets and such are skipped by tarfile too
+            return
+        header = tarinfo.tobuf(mytar.format, mytar.encoding, mytar.errors)
+        self.members.append((header, path, tarinfo.size if tarinfo.isreg() else 0))
+        if tarinfo.isdir():
+            for name in sorted(os.listdir(path)):
+                self._add_members(mytar, os.path.join(path, name), os.path.join(arcname, name))
+
+    @staticmethod
+    def _padding(size, block):
+        """Return the bytes needed to fill size out to a full block."""
+        return bytes((block - size % block) % block)
+
+    @staticmethod
+    def _slice(data, offset, start, stop):
+        """Yield the part of data at offset in the tar between start and stop."""
+        part = data[max(start - offset, 0):max(stop - offset, 0)]
+        if part:
+            yield part
+
+    def _file_chunks(self, path, first, last):
+        """Yield the data of a file from first up to last."""
+        with open(path, 'rb') as myfile:
+            myfile.seek(first)
+            left = last - first
+            while left:
+                buf = myfile.read(min(self.xfer_size, left))
+                if not buf:
+                    raise OSError('unexpected end of data in {}'.format(path))
+                left -= len(buf)
+                yield buf
+
+    def iter_range(self, start, stop):
+        """Yield the bytes of the tar from start up to stop."""
+        index = max(bisect_right(self.offsets, start) - 1, 0)
+        for offset, (header, path, size) in zip(self.offsets[index:], self.members[index:]):
+            if offset >= stop:
+                return
+            yield from self._slice(header, offset, start, stop)
+            offset += len(header)
+            if size and offset + size > start and offset < stop:
+                yield from self._file_chunks(path, max(start - offset, 0), min(stop - offset, size))
+            offset += size
+            yield from self._slice(self._padding(size, tarfile.BLOCKSIZE), offset, start, stop)
+        yield from self._slice(self.end, self.size - len(self.end), start, stop)
+
+    def __iter__(self):
+        """Yield the tar file in chunks."""
+        return self.iter_range(0, self.size)
@@ -3,13 +3,18 @@
 """Module that contains all the amqp tasks that support the cart infrastructure."""
 from __future__ import absolute_import
 from os import utime
+from time import time
+import asyncio
 import datetime
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 import requests
 from celery import Celery
-from peewee import DoesNotExist
+from peewee import DoesNotExist, chunked
 from .orm import Cart, File, CartTasks
 from .utils import Cartutils
 from .archive_requests import ArchiveRequests
+from .async_archive_requests import AsyncArchiveRequests
 from .config import get_config
 
 
@@ -18,6 +23,12 @@ CART_APP = Celery(
     broker=get_config().get('celery', 'broker_url'),
     backend=get_config().get('celery', 'backend_url')
 )
+CART_APP.conf.beat_schedule = {
+    'evict-carts': {
+        'task': 'pacifica.cartd.tasks.evict_task',
+        'schedule': get_config().getint('cartd', 'evict_interval')
+    }
+}
 
 
 @CART_APP.task(ignore_result=True)
@@ -45,18 +56,66 @@ def stage_files(file_ids, mycart_id):
 
 @CART_APP.task(ignore_result=True)
 def get_files_locally(cartid):
-    """Pull the files to the local system from the backend."""
+    """
+    Pull the files to the local system from the backend.
+
+    Files are staged one task per file or, if stage_chunk_size is
+    more than one, one task per chunk of files. The task ids are
+    then saved to the cart tasks in bulk. In async mode a single
+    task handles every file of the cart.
+    """
     # tell each file to be pulled
     Cart.database_connect()
-    for cart_file in File.select().where(File.cart == cartid):
-        get_file_task = CartTasks(
-            celery_task_id=str(stage_file_task.delay(cart_file.id)),
-            cart_id=cartid
-        )
-        get_file_task.save()
+    if get_config().getboolean('cartd', 'async_mode'):
+        CartTasks.create(celery_task_id=str(async_cart_task.delay(cartid)), cart_id=cartid)
+        Cart.database_close()
+        return
+    chunk_size = get_config().getint('cartd', 'stage_chunk_size')
+    file_ids = [cart_file.id for cart_file in File.select(File.id).where(File.cart == cartid)]
+    if chunk_size > 1:
+        task_ids = [str(stage_file_chunk_task.delay(file_chunk)) for file_chunk in chunked(file_ids, chunk_size)]
+    else:
+        task_ids = [str(stage_file_task.delay(file_id)) for file_id in file_ids]
+    task_ids.append(str(status_cart_task.apply_async(
+        (cartid,), countdown=get_config().getint('cartd', 'status_poll_interval'))))
+    with Cart.atomic():
+        for batch in chunked(task_ids, Cartutils.insert_chunk_size):
+            # pylint: disable=no-value-for-parameter
+            CartTasks.insert_many(
+                [{'celery_task_id': task_id, 'cart_id': cartid} for task_id in batch]
+            ).execute()
+            # pylint: enable=no-value-for-parameter
     Cart.database_close()
 
 
+@CART_APP.task(ignore_result=True)
+def stage_file_chunk_task(file_ids):
+    """Stage a chunk of files from the archive, the cart poller gets their status."""
+    Cart.database_connect()
+    cart_utils = Cartutils()
+    archive_request = ArchiveRequests()
+    bundle_carts = set()
+    cart_files = list(File.select(File, Cart).join(Cart).where(File.id << file_ids))
+    cart_utils.set_files_status(cart_files, 'staging')
+    for cart_file in cart_files:
+        mycart = cart_file.cart
+        # make sure cart wasnt deleted before pulling file
+        if mycart.deleted_date:
+            continue
+        if cart_utils.link_from_store(cart_file, mycart):
+            bundle_carts.add(mycart.id)
+            continue
+        try:
+            archive_request.stage_file(cart_file.file_name)
+        except requests.exceptions.RequestException as ex:
+            error_msg = 'Failed to stage with error: ' + str(ex)
+            cart_utils.set_file_status(cart_file, mycart, 'error', error_msg)
+            bundle_carts.add(mycart.id)
+    Cart.database_close()
+    for cartid in bundle_carts:
+        cart_utils.prepare_bundle(cartid)
+
+
 @CART_APP.task(ignore_result=True)
 def stage_file_task(file_id):
     """Stage the file from the archive, then call status."""
@@ -73,6 +132,10 @@ def stage_file_task(file_id):
     except DoesNotExist:
         Cart.database_close()
         return
+    if cart_utils.link_from_store(cart_file, mycart):
+        Cart.database_close()
+        cart_utils.prepare_bundle(mycart.id)
+        return
     archive_request = ArchiveRequests()
     try:
         archive_request.stage_file(cart_file.file_name)
@@ -97,7 +160,7 @@ def status_file_task(file_id):
     Cart.database_connect()
     cart_file = File.get(File.id == file_id)
     mycart = cart_file.cart
-    cart_utils = Cartutils()
+    cart_utils = Cartutils(evict_task.delay)
     # make sure cart wasnt deleted before pulling file
     if mycart.deleted_date:
         Cart.database_close()
@@ -116,32 +179,303 @@ def status_file_task(file_id):
 
     ready = cart_utils.check_file_ready_pull(response, cart_file, mycart)
 
-    # Check to see if ready to pull.  If not recall this to check again
-    # error on less then 0. No coverage on recall since it just calls the method again
+    # Check to see if ready to pull.  If not the cart poller checks again
+    # error on less then 0.
     if isinstance(ready, int) and ready < 0:
         Cart.database_close()
         cart_utils.prepare_bundle(mycart.id)
         return
-    if not ready:  # pragma: no cover
-        statusfile_task = CartTasks(
-            celery_task_id=str(status_file_task.delay(file_id)),
-            cart_id=mycart.id
-        )
-        statusfile_task.save()
+    if not ready or not cart_utils.claim_file_pull(cart_file, mycart):
         Cart.database_close()
         return
     # ready so try to pull file
     pullfile_task = CartTasks(
-        celery_task_id=str(pull_file.delay(file_id, ready['filepath'], ready['modtime'], False)),
+        celery_task_id=str(pull_file.delay(*_pull_args(cart_utils, cart_file, mycart, ready))),
         cart_id=mycart.id
     )
     pullfile_task.save()
     Cart.database_close()
 
 
+def _pull_args(cart_utils, cart_file, mycart, ready):
+    """
+    Return the arguments to pull a ready file.
+
+    With bundle_direct on, files of bundled carts get a slot in the
+    cart tar to be pulled into.
+    """
+    if mycart.bundle and get_config().getboolean('cartd', 'bundle_direct'):
+        bundle_tar, tar_slot = cart_utils.reserve_tar_slot(mycart, cart_file, ready['filesize'], ready['modtime'])
+        return (cart_file.id, bundle_tar, ready['modtime'], False, tar_slot)
+    return (cart_file.id, ready['filepath'], ready['modtime'], False)
+
+
+def _poll_delay(attempts):
+    """Return the seconds to wait before checking a file again."""
+    interval = get_config().getint('cartd', 'status_poll_interval')
+    return min(interval * 2 ** attempts, get_config().getint('cartd', 'status_poll_max'))
+
+
+def _status_cart_file(cart_utils, archive_request, cart_file, mycart):
+    """Check one file for the cart poller and start the pull if ready."""
+    try:
+        response = archive_request.status_file(cart_file.file_name)
+    except requests.exceptions.RequestException as ex:
+        error_msg = 'Failed to status file with error: ' + str(ex)
+        cart_utils.set_file_status(cart_file, mycart, 'error', error_msg)
+        return 'error'
+    ready = cart_utils.check_file_ready_pull(response, cart_file, mycart)
+    if isinstance(ready, int) and ready < 0:
+        return 'error'
+    if not ready:
+        return 'waiting'
+    if cart_utils.claim_file_pull(cart_file, mycart):
+        pullfile_task = CartTasks(
+            celery_task_id=str(pull_file.delay(*_pull_args(cart_utils, cart_file, mycart, ready))),
+            cart_id=mycart.id
+        )
+        pullfile_task.save()
+    return 'pulling'
+
+
+def _status_due_files(cart_utils, mycart, cart_files, polls, now):
+    """
+    Check the staging files that are due for the cart poller.
+
+    Returns the attempts and due time of the files to check again,
+    the time the poller is due next, None if nothing is left to check,
+    and whether a file failed.
+    """
+    archive_request = ArchiveRequests()
+    file_error = False
+    next_polls = {}
+    # waiting files are checked again after the poll interval
+    due_times = []
+    for cart_file in cart_files:
+        if cart_file.status == 'waiting':
+            due_times.append(now + get_config().getint('cartd', 'status_poll_interval'))
+            continue
+        attempts, due = polls.get(str(cart_file.id), (0, now))
+        if due <= now:
+            status = _status_cart_file(cart_utils, archive_request, cart_file, mycart)
+            file_error = file_error or status == 'error'
+            if status != 'waiting':
+                continue
+            attempts, due = attempts + 1, now + _poll_delay(attempts)
+        next_polls[str(cart_file.id)] = (attempts, due)
+        due_times.append(due)
+    return next_polls, min(due_times) if due_times else None, file_error
+
+
 @CART_APP.task(ignore_result=True)
-def pull_file(file_id, filepath, modtime, record_error):
-    """Pull a file from the archive."""
+def status_cart_task(cartid, polls=None, started=None):
+    """
+    Get the status of all the files in a cart still on the archive.
+
+    One task checks the staging files in the cart and reschedules
+    itself until there is nothing left to check. polls maps the id of
+    every file checked so far to its attempts and the time it is due
+    again, the wait of a file doubles with each check it isn't ready
+    and only files that are due are checked. Files still waiting to
+    be staged aren't checked and start at the first attempt once they
+    are. Files still waiting or staging status_poll_timeout seconds
+    after the first round are set to error.
+    """
+    Cart.database_connect()
+    try:
+        mycart = Cart.get(Cart.id == cartid)
+    except DoesNotExist:
+        Cart.database_close()
+        return
+    if mycart.deleted_date:
+        Cart.database_close()
+        return
+    now = time()
+    started = started or now
+    polls = polls or {}
+    cart_utils = Cartutils(evict_task.delay)
+    cart_files = list(File.select().where(
+        (File.cart == cartid) & (File.status << ['waiting', 'staging'])))
+    if cart_files and now - started > get_config().getint('cartd', 'status_poll_timeout'):
+        for cart_file in cart_files:
+            cart_utils.set_file_status(cart_file, mycart, 'error', 'Timed out waiting for the archive')
+        next_polls, next_due, file_error = {}, None, True
+    else:
+        next_polls, next_due, file_error = _status_due_files(cart_utils, mycart, cart_files, polls, now)
+    if next_due is not None:
+        statuscart_task = CartTasks(
+            celery_task_id=str(status_cart_task.apply_async(
+                (cartid, next_polls, started), countdown=max(next_due - now, 0))),
+            cart_id=cartid
+        )
+        statuscart_task.save()
+    Cart.database_close()
+    if file_error:
+        cart_utils.prepare_bundle(cartid)
+
+
+def _stage_pulled_file(cart_utils, cart_file, mycart, ready):
+    """Set the time of a file pulled by the async task, store and bundle it."""
+    utime(ready['filepath'], (int(float(ready['modtime'])), int(float(ready['modtime']))))
+    cart_utils.add_to_store(cart_file, ready['filepath'])
+    cart_utils.bundle_file(mycart, ready['filepath'])
+    cart_utils.set_file_status(cart_file, mycart, 'staged', False)
+
+
+async def _async_cart_file(run_db, cart_utils, archive_request, cart_file, mycart):
+    """
+    Stage, wait for and pull one file with the asyncio archive client.
+
+    Database and disk calls are made with run_db so they don't block
+    the other files of the cart.
+    """
+    await run_db(cart_utils.set_file_status, cart_file, mycart, 'staging', False)
+    if await run_db(cart_utils.link_from_store, cart_file, mycart):
+        return
+    error_msg = 'Failed to stage with error: '
+    try:
+        await archive_request.stage_file(cart_file.file_name)
+        error_msg = 'Failed to status file with error: '
+        attempts = 0
+        ready = False
+        deadline = time() + get_config().getint('cartd', 'status_poll_timeout')
+        while not ready:
+            response = await archive_request.status_file(cart_file.file_name)
+            ready = await run_db(cart_utils.check_file_ready_pull, response, cart_file, mycart)
+            if isinstance(ready, int) and ready < 0:
+                return
+            if not ready:
+                if time() >= deadline:
+                    await run_db(cart_utils.set_file_status, cart_file, mycart, 'error',
+                                 'Timed out waiting for the archive')
+                    return
+                await asyncio.sleep(min(_poll_delay(attempts), deadline - time()))
+                attempts += 1
+        await run_db(cart_utils.set_file_status, cart_file, mycart, 'pulling', False)
+        error_msg = 'Failed to pull with error: '
+        lease = await run_db(cart_utils.acquire_pull_lease, cart_file)
+        waits = 0
+        while lease is False:
+            # another pull of the same file is running, use its copy
+            if await run_db(cart_utils.link_from_store, cart_file, mycart):
+                return
+            if waits >= _max_lease_waits():
+                lease = None
+                break
+            await asyncio.sleep(get_config().getint('cartd', 'status_poll_interval'))
+            waits += 1
+            lease = await run_db(cart_utils.acquire_pull_lease, cart_file)
+        try:
+            await archive_request.pull_file(
+                cart_file.file_name, ready['filepath'], cart_file.hash_value, cart_file.hash_type,
+                progress=cart_utils.pull_lease_keeper(lease, cart_file, mycart, ready['filepath']))
+        finally:
+            await run_db(cart_utils.release_pull_lease, lease)
+    except (requests.exceptions.RequestException, ValueError) as ex:
+        await run_db(cart_utils.set_file_status, cart_file, mycart, 'error', error_msg + str(ex))
+        return
+    await run_db(_stage_pulled_file, cart_utils, cart_file, mycart, ready)
+
+
+async def _async_cart_files(cart_utils, cart_files, mycart):
+    """
+    Run all the files of a cart at once sharing one archive client.
+
+    The database calls of every file are made in one thread with its
+    own connection. A file failing in an unexpected way is set to
+    error without stopping the other files.
+    """
+    loop = asyncio.get_event_loop()
+    with ThreadPoolExecutor(1) as db_executor:
+        def run_db(func, *args):
+            """Run the call in the database thread."""
+            return loop.run_in_executor(db_executor, partial(func, *args))
+        try:
+            async with AsyncArchiveRequests() as archive_request:
+                results = await asyncio.gather(*[
+                    _async_cart_file(run_db, cart_utils, archive_request, cart_file, mycart)
+                    for cart_file in cart_files
+                ], return_exceptions=True)
+            for cart_file, result in zip(cart_files, results):
+                if isinstance(result, Exception):
+                    await run_db(cart_utils.set_file_status, cart_file, mycart, 'error',
+                                 'Failed with error: ' + str(result))
+        finally:
+            await run_db(Cart.database_close)
+
+
+@CART_APP.task(ignore_result=True)
+def async_cart_task(cartid):
+    """
+    Stage, status and pull all the files of a cart concurrently.
+
+    The asyncio archive client keeps at most async_concurrency
+    requests open to the archive interface, so one worker moves
+    many files at the same time.
+    """
+    Cart.database_connect()
+    try:
+        mycart = Cart.get(Cart.id == cartid)
+    except DoesNotExist:
+        Cart.database_close()
+        return
+    if mycart.deleted_date:
+        Cart.database_close()
+        return
+    cart_utils = Cartutils(evict_task.delay)
+    cart_files = list(File.select().where(
+        (File.cart == cartid) & (File.status << ['waiting', 'staging'])))
+    Cart.database_close()
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(_async_cart_files(cart_utils, cart_files, mycart))
+    finally:
+        loop.close()
+    cart_utils.prepare_bundle(cartid)
+
+
+def _max_lease_waits():
+    """
+    Return the times to wait for another pull of a file before pulling it anyway.
+
+    The waits add up to a bit more than pull_lease_time.
+    """
+    interval = max(get_config().getint('cartd', 'status_poll_interval'), 1)
+    return get_config().getint('cartd', 'pull_lease_time') // interval + 1
+
+
+def _wait_for_pull(cart_utils, cart_file, mycart, pull_args):
+    """
+    Use the copy of a file another worker is pulling.
+
+    The file is linked from the store or left alone if the other pull
+    is done, otherwise the pull is tried again after
+    status_poll_interval.
+    """
+    if cart_utils.link_from_store(cart_file, mycart) or File.get(File.id == cart_file.id).status == 'staged':
+        Cart.database_close()
+        cart_utils.prepare_bundle(mycart.id)
+        return
+    pull_file_task = CartTasks(
+        celery_task_id=str(pull_file.apply_async(
+            pull_args, countdown=get_config().getint('cartd', 'status_poll_interval'))),
+        cart_id=mycart.id
+    )
+    pull_file_task.save()
+    Cart.database_close()
+
+
+# pylint: disable=too-many-arguments
+@CART_APP.task(ignore_result=True)
+def pull_file(file_id, filepath, modtime, record_error, tar_slot=None, waits=0):
+    """
+    Pull a file from the archive.
+
+    With a tar slot the filepath is the cart tar and the file is
+    pulled into the slot. Otherwise the pull takes the lease of the
+    file, waits is the number of times it found another pull holding
+    it. After _max_lease_waits the file is pulled without the lease.
+    """
     Cart.database_connect()
     try:
         cart_file = File.get(File.id == file_id)
@@ -154,13 +488,24 @@ def pull_file(file_id, filepath, modtime, record_error):
     except DoesNotExist:
         Cart.database_close()
         return
+    # files pulled into a tar aren't put in the store
+    lease = None
+    if not tar_slot and waits < _max_lease_waits():
+        lease = cart_utils.acquire_pull_lease(cart_file)
+    if lease is False:
+        _wait_for_pull(cart_utils, cart_file, mycart, (file_id, filepath, modtime, record_error, None, waits + 1))
+        return
 
     archive_request = ArchiveRequests()
     try:
         archive_request.pull_file(
-            cart_file.file_name, filepath, cart_file.hash_value, cart_file.hash_type)
+            cart_file.file_name, filepath, cart_file.hash_value, cart_file.hash_type, tar_slot=tar_slot,
+            progress=cart_utils.pull_lease_keeper(lease, cart_file, mycart, None if tar_slot else filepath))
+        if not tar_slot:
+            utime(filepath, (int(float(modtime)), int(float(modtime))))
+            cart_utils.add_to_store(cart_file, filepath)
+            cart_utils.bundle_file(mycart, filepath)
         cart_utils.set_file_status(cart_file, mycart, 'staged', False)
-        utime(filepath, (int(float(modtime)), int(float(modtime))))
         Cart.database_close()
     except requests.exceptions.RequestException as ex:
         # if request fails...try a second time, if that fails write error
@@ -171,8 +516,11 @@ def pull_file(file_id, filepath, modtime, record_error):
             cart_utils.prepare_bundle(mycart.id)
 
         else:
+            # let the second try take the lease
+            cart_utils.release_pull_lease(lease)
+            lease = None
             pull_file_task = CartTasks(
-                celery_task_id=str(pull_file.delay(file_id, filepath, modtime, True)),
+                celery_task_id=str(pull_file.delay(file_id, filepath, modtime, True, tar_slot)),
                 cart_id=mycart.id
             )
             pull_file_task.save()
@@ -184,4 +532,21 @@ def pull_file(file_id, filepath, modtime, record_error):
         Cart.database_close()
         cart_utils.prepare_bundle(mycart.id)
 
+    finally:
+        cart_utils.release_pull_lease(lease)
+
     cart_utils.prepare_bundle(mycart.id)
+# pylint: enable=too-many-arguments
+
+
+@CART_APP.task(ignore_result=True)
+def evict_task(size_needed=0):
+    """
+    Delete the least recently accessed carts if the volume is too full.
+
+    Celery beat runs this every evict_interval seconds and files that
+    don't fit on the volume start it with the bytes they need.
+    """
+    Cart.database_connect()
+    Cartutils().evict_carts(size_needed)
+    Cart.database_close()
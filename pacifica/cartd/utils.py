@@ -2,39 +2,50 @@
 # -*- coding: utf-8 -*-
 """Module that has the utility functionality for the cart."""
 from __future__ import absolute_import
+import io
 import os
 import json
 import datetime
+import time
 import errno
+import hashlib
 import tarfile
 from math import floor
 import shutil
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:  # pragma: no cover windows has no fcntl
+    fcntl = None
 import psutil
-from peewee import DoesNotExist
-from .orm import Cart, File, CartTasks
-from .config import get_config
+from peewee import DoesNotExist, chunked, fn
+from .orm import Cart, File, CartTasks, SpaceReservation
+# parse_size was defined here, keep it importable from this module
+from .config import get_config, parse_size  # noqa: F401 pylint: disable=unused-import
 
 
-def parse_size(size):
-    """Parse size string to integer."""
-    units = {
-        'B': 1, 'KB': 10**3, 'MB': 10**6, 'GB': 10**9, 'TB': 10**12,
-        'b': 1, 'Kb': 1024, 'Mb': 1024**2, 'Gb': 1024**3, 'Tb': 1024**4
-    }
-    number, unit = [string.strip() for string in size.split()]
-    return int(float(number)*units[unit])
-
-# pylint: disable=too-many-public-methods
+# pylint: disable=too-many-public-methods,too-many-lines
 
 
 class Cartutils:
     """Class used to provide utility functions for the cart to use."""
 
-    def __init__(self):
-        """Default constructor setting environment variable defaults."""
+    # rows per insert, sqlite allows 999 variables per statement
+    insert_chunk_size = 100
+
+    def __init__(self, evict_func=None):
+        """
+        Default constructor setting environment variable defaults.
+
+        The evict_func is called with the bytes needed when a file
+        doesn't fit on the volume, the default evicts carts right away.
+        """
         self._vol_path = get_config().get('cartd', 'volume_path')
         self._lru_buff = get_config().get('cartd', 'lru_buffer_time')
         self._lru_purge = get_config().getboolean('cartd', 'lru_purge')
+        self._evict_func = evict_func or self.evict_carts
+        self._content_store = get_config().getboolean('cartd', 'content_store')
+        self._pull_lease_time = get_config().getint('cartd', 'pull_lease_time')
 
     ###########################################################################
     #
@@ -75,6 +86,197 @@ class Cartutils:
 
         return True
 
+    def cart_bundle_path(self, mycart):
+        """Return the directory the files of the cart are pulled to."""
+        return os.path.join(self._vol_path, str(mycart.id), mycart.cart_uid)
+
+    def cart_file_path(self, mycart, cart_file):
+        """Return the path the file is pulled to in the cart."""
+        return os.path.join(
+            self._vol_path, str(mycart.id), mycart.cart_uid, cart_file.bundle_path)
+
+    ###########################################################################
+    #
+    # Helper methods for the content addressed store shared by carts
+    #
+    ###########################################################################
+
+    def store_path(self, hash_type, hash_value):
+        """
+        Return the path of a file in the store by its hash.
+
+        None is returned if the store is off or the hash can't be
+        used as a path.
+        """
+        if not self._content_store or not hash_value or not str(hash_value).isalnum():
+            return None
+        if hash_type not in hashlib.algorithms_available:
+            return None
+        return os.path.join(self._vol_path, 'store', hash_type, hash_value[:2], hash_value)
+
+    def link_from_store(self, cart_file, mycart):
+        """
+        Hard link a file already in the store into the cart.
+
+        The file is set to staged and True returned if it was linked.
+        Files in the store have been pulled and their hash checked.
+        """
+        blob = self.store_path(cart_file.hash_type, cart_file.hash_value)
+        if not blob or not os.path.isfile(blob):
+            return False
+        filepath = self.cart_file_path(mycart, cart_file)
+        if not self.create_download_path(cart_file, mycart, filepath):
+            return False
+        try:
+            if os.path.lexists(filepath):
+                os.unlink(filepath)
+            os.link(blob, filepath)
+        except OSError:
+            # released since we looked or linking is not supported
+            return False
+        self.set_file_size(cart_file, mycart, os.path.getsize(blob))
+        self.bundle_file(mycart, filepath)
+        self.set_file_status(cart_file, mycart, 'staged', False)
+        return True
+
+    def add_to_store(self, cart_file, filepath):
+        """Hard link a pulled file into the store for other carts."""
+        blob = self.store_path(cart_file.hash_type, cart_file.hash_value)
+        if not blob:
+            return
+        try:
+            self.create_bundle_directories(os.path.dirname(blob))
+            os.link(filepath, blob)
+        except OSError:
+            # already there from another cart or linking is not supported
+            pass
+
+    def pull_lease_path(self, cart_file):
+        """
+        Return the path of the lease to pull a file.
+
+        With the content store on the lease is next to the stored file
+        so one pull of the file runs for every cart asking for it,
+        otherwise it only keeps two pulls of the same cart file from
+        writing to it at once.
+        """
+        blob = self.store_path(cart_file.hash_type, cart_file.hash_value)
+        if blob:
+            return '{}.pull'.format(blob)
+        return os.path.join(self._vol_path, 'leases', '{}.pull'.format(cart_file.id))
+
+    def acquire_pull_lease(self, cart_file):
+        """
+        Take the lease to pull a file.
+
+        The lease is a file created only if it doesn't exist, so one
+        worker on any host sharing the volume pulls the file. Returns
+        the lease path or False if another pull holds it. The holder
+        keeps the lease fresh with pull_lease_keeper, leases not
+        touched for pull_lease_time are left by a crashed worker and
+        are taken over.
+        """
+        lease = self.pull_lease_path(cart_file)
+        self.create_bundle_directories(os.path.dirname(lease))
+        for _attempt in range(2):
+            try:
+                os.close(os.open(lease, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return lease
+            except FileExistsError:
+                if not self._remove_stale_lease(lease):
+                    return False
+        return False
+
+    def _remove_stale_lease(self, lease):
+        """
+        Remove the lease if it is stale, return True if it is gone.
+
+        Workers finding the same stale lease race to create a marker
+        named after its inode and time, only the one that does removes
+        it. A lease taken again since has another inode or time and is
+        left alone.
+        """
+        try:
+            stale = os.stat(lease)
+        except FileNotFoundError:
+            return True
+        if stale.st_mtime + self._pull_lease_time > time.time():
+            return False
+        marker = '{}.{}-{}'.format(lease, stale.st_ino, stale.st_mtime_ns)
+        try:
+            os.close(os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            return False
+        try:
+            current = os.stat(lease)
+            if (current.st_ino, current.st_mtime_ns) != (stale.st_ino, stale.st_mtime_ns):
+                return False
+            os.unlink(lease)
+        except FileNotFoundError:
+            pass
+        finally:
+            os.unlink(marker)
+        return True
+
+    def pull_lease_keeper(self, lease, cart_file=None, mycart=None, filepath=None):
+        """
+        Return a function to call as a pull moves along to keep its lease.
+
+        The time of the lease and the space reserved for the cart file
+        are refreshed at most every quarter of pull_lease_time so long
+        pulls aren't taken over and their space isn't given away. The
+        reservation shrinks to the bytes not yet written to filepath.
+        """
+        if not lease and not cart_file:
+            return None
+        refresh_time = self._pull_lease_time / 4
+        last = [time.time()]
+
+        def keep():
+            """Touch the lease and the reservation if they are due."""
+            now = time.time()
+            if now - last[0] >= refresh_time:
+                last[0] = now
+                if cart_file:
+                    self.refresh_space(cart_file, mycart, filepath)
+                if not lease:
+                    return
+                try:
+                    os.utime(lease)
+                except FileNotFoundError:
+                    pass
+        return keep
+
+    @staticmethod
+    def release_pull_lease(lease):
+        """Release a lease taken by acquire_pull_lease."""
+        if not lease:
+            return
+        try:
+            os.unlink(lease)
+        except FileNotFoundError:
+            pass
+
+    def release_store_files(self, cartid):
+        """
+        Remove the files of a cart from the store no other cart has.
+
+        The store counts references with the link count of the files,
+        a file only linked from the store is used by no cart.
+        """
+        hashes = (File
+                  .select(File.hash_type, File.hash_value)
+                  .where(File.cart == cartid)
+                  .distinct()
+                  .tuples())
+        for hash_type, hash_value in hashes:
+            blob = self.store_path(hash_type, hash_value)
+            try:
+                if blob and os.stat(blob).st_nlink == 1:
+                    os.unlink(blob)
+            except FileNotFoundError:
+                pass
+
     ###########################################################################
     #
     # Helper methods that determine space available/size
@@ -103,15 +305,16 @@ class Cartutils:
         """
         Check to make sure there is enough space available on disk for the file to be downloaded.
 
-        Note it will recursively call itself if there isnt enough
-        space. It will delete a cart first, then call  itself
-        until either there is enough space or there is no carts to delete
+        The space of the file is reserved until it is staged or fails.
+        If it doesn't fit and there are carts to evict the eviction is
+        started and None returned, the file should be checked again
+        later so pulls don't wait on carts being deleted.
         """
         if not self._lru_purge:
             return True
         try:
             # available space is in bytes
-            available_space = int(psutil.disk_usage(self._vol_path).free)
+            usage = psutil.disk_usage(self._vol_path)
         except psutil.Error as ex:
             cart_file.status = 'error'
             cart_file.error = """Failed to get available file
@@ -121,11 +324,11 @@ class Cartutils:
             mycart.save()
             return False
 
-        if size_needed > available_space:
-            if deleted_flag:
-                cart_deleted = self.lru_cart_delete(mycart)
-                return self.check_space_requirements(cart_file, mycart,
-                                                     size_needed, cart_deleted)
+        size_needed = self.space_left(mycart, size_needed, self.cart_file_path(mycart, cart_file))
+        if not self.reserve_space(cart_file, mycart, size_needed, int(usage.free)):
+            if deleted_flag and size_needed < usage.total and self.evict_candidates().exists():
+                self._queue_eviction(size_needed)
+                return None
             cart_file.status = 'error'
             cart_file.error = 'Not enough space to download file'
             cart_file.save()
@@ -136,17 +339,74 @@ class Cartutils:
         # there is enough space so return true
         return True
 
-    @classmethod
-    def get_path_size(cls, source):
-        """Return the size of a specific directory, including all subdirectories and files."""
-        total_size = os.path.getsize(source)
-        for item in os.listdir(source):
-            itempath = os.path.join(source, item)
-            if os.path.isfile(itempath):
-                total_size += os.path.getsize(itempath)
-            elif os.path.isdir(itempath):
-                total_size += cls.get_path_size(itempath)
-        return total_size
+    def reserve_space(self, cart_file, mycart, size_needed, available_space):
+        """
+        Reserve space for a file if it fits with the other reservations.
+
+        The reservation is written before the space is compared with
+        all the outstanding reservations, so of two files racing for
+        the last of the space at least one sees the other. Pulls
+        running keep their reservations to the bytes they have left
+        with refresh_space, reservations older than pull_lease_time
+        were left by a crashed worker and aren't counted. Returns
+        False, without the reservation, if the file doesn't fit.
+        """
+        if size_needed > available_space:
+            self.release_space(cart_file)
+            return False
+        with Cart.atomic():
+            self.release_space(cart_file)
+            SpaceReservation.create(file=cart_file.id, cart=mycart.id, size=size_needed)
+        if self.reserved_space() > available_space:
+            self.release_space(cart_file)
+            return False
+        return True
+
+    def reserved_space(self):
+        """Return the bytes reserved by files being pulled."""
+        stale_time = datetime.datetime.now() - datetime.timedelta(seconds=self._pull_lease_time)
+        return (SpaceReservation
+                .select(fn.SUM(SpaceReservation.size))
+                .where(SpaceReservation.reserved_date > stale_time)
+                .scalar()) or 0
+
+    @staticmethod
+    def release_space(cart_file):
+        """Release the space reserved for a file."""
+        SpaceReservation.delete().where(SpaceReservation.file == cart_file.id).execute()
+
+    def refresh_space(self, cart_file, mycart, filepath=None):
+        """Refresh the space reserved for a file being pulled to what it has left."""
+        (SpaceReservation
+         .update(size=self.space_left(mycart, cart_file.size or 0, filepath),
+                 reserved_date=datetime.datetime.now())
+         .where(SpaceReservation.file == cart_file.id)
+         .execute())
+
+    def space_left(self, mycart, size, filepath):
+        """
+        Return the bytes a file pulled to filepath still needs on the volume.
+
+        Bytes of a partial pull are already out of the free space. With
+        the content store on, files of bundled carts stay in the store
+        after they are copied into the tar so they need their size
+        twice, files pulled straight into a tar slot have no filepath
+        and aren't stored.
+        """
+        left = max(size - self.partial_size(filepath), 0)
+        if filepath and self._content_store and mycart.bundle:
+            left += size
+        return left
+
+    @staticmethod
+    def partial_size(filepath):
+        """Return the bytes already pulled to filepath."""
+        if not filepath:
+            return 0
+        try:
+            return os.stat(filepath).st_size
+        except FileNotFoundError:
+            return 0
 
     ###########################################################################
     #
@@ -191,15 +451,18 @@ class Cartutils:
         if size_needed < 0 or mod_time < 0:
             return -1
         # set up saving path and return dictionary
-        abs_cart_file_path = os.path.join(
-            self._vol_path, str(mycart.id), mycart.cart_uid, cart_file.bundle_path)
+        abs_cart_file_path = self.cart_file_path(mycart, cart_file)
         path_created = self.create_download_path(
             cart_file, mycart, abs_cart_file_path)
         # Check size here and make sure enough space is available.
         enough_space = self.check_space_requirements(
             cart_file, mycart, size_needed, True)
+        if enough_space is None:
+            # not ready until carts are evicted
+            return False
         if path_created and enough_space:
-            return {'modtime': mod_time, 'filepath': abs_cart_file_path,
+            self.set_file_size(cart_file, mycart, size_needed)
+            return {'modtime': mod_time, 'filepath': abs_cart_file_path, 'filesize': size_needed,
                     'path_created': path_created, 'enough_space': enough_space}
         return -1
 
@@ -274,6 +537,8 @@ class Cartutils:
             pass
         except OSError:
             return False
+        self.release_store_files(cart.id)
+        SpaceReservation.delete().where(SpaceReservation.cart == cart.id).execute()
         dest = os.path.join(self._vol_path, 'cartuids', cart.cart_uid)
         # windows has issues with python 2.7 and symlinks
         # once we go to python 3 only we can probably handle this
@@ -285,27 +550,150 @@ class Cartutils:
 
         return True
 
-    def lru_cart_delete(self, mycart):
+    def evict_candidates(self):
+        """
+        Return the carts that can be evicted, least recently accessed first.
+
+        Only ready or failed carts not accessed for lru_buffer_time are
+        evicted, carts still being worked on are left alone.
+        """
+        lru_time = datetime.datetime.now() - datetime.timedelta(
+            seconds=int(self._lru_buff))
+        return (Cart
+                .select()
+                .where(
+                    (Cart.deleted_date.is_null(True)) &
+                    (Cart.status << ['ready', 'error']) &
+                    (Cart.accessed_date < lru_time))
+                .order_by(Cart.accessed_date))
+
+    def evict_space_needed(self, size_needed=0, evicting=False):
+        """
+        Return the bytes to free to get down to the low watermark.
+
+        Nothing needs freeing while the space used, the outstanding
+        reservations and size_needed are under the high watermark,
+        unless already evicting.
+        """
+        usage = psutil.disk_usage(self._vol_path)
+        used = usage.total - usage.free + self.reserved_space() + size_needed
+        if not evicting and used <= usage.total * get_config().getint('cartd', 'evict_high_watermark') // 100:
+            return 0
+        return used - usage.total * get_config().getint('cartd', 'evict_low_watermark') // 100
+
+    def cart_disk_size(self, cart):
+        """
+        Return the bytes deleting a cart would free on the volume.
+
+        With the content store on, files linked from another cart not
+        deleted stay on the volume, only the files no other cart links
+        are counted. Files bundled into the tar of the cart are its own
+        and their copies in the store are freed with it unless another
+        cart links them. Carts staged before sizes were kept have no
+        staged size and are measured on disk.
+        """
+        if not cart.staged_size:
+            return self._stat_cart_size(cart)
+        if not self._content_store:
+            return cart.staged_size
+        other = File.alias()
+        linked = other.select(other.id).join(Cart, on=other.cart == Cart.id).where(
+            (other.hash_type == File.hash_type) & (other.hash_value == File.hash_value) &
+            (other.cart != cart.id) & (other.status == 'staged') & Cart.deleted_date.is_null(True) &
+            (Cart.bundle.is_null(True) | (Cart.bundle == 0)))
+        size = (File
+                .select(fn.SUM(File.size))
+                .where((File.cart == cart.id) & (File.status == 'staged') & ~fn.EXISTS(linked))
+                .scalar()) or 0
+        return size + cart.staged_size if cart.bundle else size
+
+    def _stat_cart_size(self, cart):
+        """Return the bytes of the tar and the staged files of a cart on disk."""
+        size = 0
+        paths = ['{}.tar'.format(self.cart_bundle_path(cart))] + [
+            self.cart_file_path(cart, cart_file)
+            for cart_file in File.select().where((File.cart == cart.id) & (File.status == 'staged'))
+        ]
+        for path in paths:
+            try:
+                file_stat = os.stat(path)
+            except OSError:
+                continue
+            # a file in the store is linked from it and the cart
+            if not self._content_store or path == paths[0] or file_stat.st_nlink <= 2:
+                size += file_stat.st_size
+        return size
+
+    @contextmanager
+    def _lock_eviction(self):
+        """Hold the eviction lock of the volume, yield False if another eviction holds it."""
+        with open(os.path.join(self._vol_path, 'evict.lock'), 'a', encoding='utf-8') as lock_fd:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    yield False
+                    return
+            yield True
+
+    def _queue_eviction(self, size_needed):
         """
-        Delete the least recently used cart that isnt this one.
+        Start an eviction unless one is already queued for the volume.
 
-        Only delete one cart per call.
+        The evict.queued marker is created only if it doesn't exist and
+        removed when the eviction starts, so files that don't fit while
+        an eviction is queued don't queue more. A marker older than
+        evict_interval is from an eviction that never ran.
         """
+        marker = os.path.join(self._vol_path, 'evict.queued')
         try:
-            lru_time = datetime.datetime.now() - datetime.timedelta(
-                seconds=int(self._lru_buff))
-            del_cart = (Cart
-                        .select()
-                        .where(
-                            (Cart.id != mycart.id) &
-                            (Cart.deleted_date.is_null(True)) &
-                            (Cart.updated_date < lru_time))
-                        .order_by(Cart.creation_date)
-                        .get())
-            return self.delete_cart_bundle(del_cart)
-        except DoesNotExist:
-            # case if no cart exists that can be deleted
-            return False
+            os.close(os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            try:
+                if os.stat(marker).st_mtime + get_config().getint('cartd', 'evict_interval') > time.time():
+                    return
+                os.utime(marker)
+            except FileNotFoundError:
+                pass
+        self._evict_func(size_needed)
+
+    def evict_carts(self, size_needed=0):
+        """
+        Delete the least recently accessed carts until under the low watermark.
+
+        Carts are deleted in batches of up to evict_batch_size, each
+        batch only as many of the oldest carts as their size says are
+        needed. Only one eviction runs on the volume at a time, others
+        return right away. Returns the number of carts deleted.
+        """
+        if not self._lru_purge:
+            return 0
+        batch_size = get_config().getint('cartd', 'evict_batch_size')
+        deleted = 0
+        with self._lock_eviction() as locked:
+            if not locked:
+                return 0
+            try:
+                os.unlink(os.path.join(self._vol_path, 'evict.queued'))
+            except FileNotFoundError:
+                pass
+            to_free = self.evict_space_needed(size_needed)
+            while to_free > 0:
+                batch = []
+                for cart in self.evict_candidates().limit(batch_size):
+                    batch.append(cart)
+                    to_free -= self.cart_disk_size(cart)
+                    if to_free <= 0:
+                        break
+                batch_deleted = 0
+                for cart in batch:
+                    if self.delete_cart_bundle(cart):
+                        batch_deleted += 1
+                if not batch_deleted:
+                    break
+                deleted += batch_deleted
+                to_free = self.evict_space_needed(size_needed, True)
+        return deleted
 
     ###########################################################################
     #
@@ -332,7 +720,10 @@ class Cartutils:
 
         if mycart:
             # send the status and any available error text
+            # bundling is still staging as far as clients are concerned
             status = [mycart.status, mycart.error]
+            if mycart.status == 'bundling':
+                status[0] = 'staging'
 
         return status
 
@@ -342,6 +733,7 @@ class Cartutils:
         Check if the asked for cart tar is available.
 
         Returns the path to tar if yes, false if not. None if no cart.
+        The access time of a ready cart is updated.
         """
         cart_bundle_path = False
         try:
@@ -359,6 +751,8 @@ class Cartutils:
 
         if mycart and mycart.status == 'ready':
             cart_bundle_path = mycart.bundle_path
+            # downloads keep the cart from being evicted
+            Cart.update(accessed_date=datetime.datetime.now()).where(Cart.id == mycart.id).execute()
         return cart_bundle_path
 
     ###########################################################################
@@ -367,9 +761,27 @@ class Cartutils:
     #
     ###########################################################################
 
-    @staticmethod
-    def set_file_status(cart_file, cart, status, error):
-        """Set the status and/or error for a cart."""
+    @classmethod
+    def set_file_status(cls, cart_file, cart, status, error):
+        """
+        Set the status and/or error for a cart.
+
+        Staged or failed files release the space reserved for them,
+        the size of a staged file is added to the staged size of the
+        cart the first time it is staged.
+        """
+        if status in ('staged', 'error'):
+            cls.release_space(cart_file)
+        if status == 'staged' and cart_file.size:
+            staged = (File
+                      .update(status='staged')
+                      .where((File.id == cart_file.id) & (File.status != 'staged'))
+                      .execute())
+            if staged:
+                (Cart
+                 .update(staged_size=Cart.staged_size + cart_file.size)
+                 .where(Cart.id == cart.id)
+                 .execute())
         cart_file.status = str(status)
         if error:
             cart_file.error = str(error)
@@ -377,81 +789,245 @@ class Cartutils:
         cart.updated_date = datetime.datetime.now()
         cart.save()
 
+    @staticmethod
+    def set_files_status(cart_files, status):
+        """
+        Set the status of many files with one update of the files and their carts.
+
+        Only for the statuses set_file_status has nothing more to do
+        for, staged and error files still go through set_file_status.
+        """
+        if not cart_files:
+            return
+        now = datetime.datetime.now()
+        with Cart.atomic():
+            File.update(status=str(status)).where(File.id << [cart_file.id for cart_file in cart_files]).execute()
+            (Cart
+             .update(updated_date=now)
+             .where(Cart.id << list({cart_file.cart_id for cart_file in cart_files}))
+             .execute())
+        for cart_file in cart_files:
+            cart_file.status = str(status)
+            cart_file.cart.updated_date = now
+
+    @staticmethod
+    def set_file_size(cart_file, cart, size):
+        """
+        Save the archive size of a file and add it to the size of its cart.
+
+        The file is only updated if its size is still what was read,
+        so a file checked by two workers at once is counted once.
+        """
+        old_size = cart_file.size or 0
+        if old_size == size:
+            return
+        updated = (File
+                   .update(size=size)
+                   .where((File.id == cart_file.id) & (File.size == old_size))
+                   .execute())
+        cart_file.size = size
+        if updated:
+            Cart.update(size=Cart.size + size - old_size).where(Cart.id == cart.id).execute()
+
+    @staticmethod
+    def claim_file_pull(cart_file, cart):
+        """
+        Move a staging file to pulling if nobody else has yet.
+
+        Both the per file status task and the cart poller may find
+        the file ready, only the one that wins the update pulls it.
+        """
+        claimed = (File
+                   .update(status='pulling')
+                   .where(
+                       (File.id == cart_file.id) &
+                       (File.status == 'staging'))
+                   .execute())
+        if not claimed:
+            return False
+        cart_file.status = 'pulling'
+        cart.updated_date = datetime.datetime.now()
+        cart.save()
+        return True
+
     @classmethod
     def update_cart_files(cls, cart, file_ids):
-        """Update the files associated to a cart."""
+        """
+        Update the files associated to a cart.
+
+        All the file ids are checked before anything is written, the
+        rows are then inserted in chunks of insert_chunk_size.
+        """
+        try:
+            file_rows = [
+                {
+                    'cart': cart.id,
+                    'file_name': f_id['id'],
+                    'bundle_path': cls.fix_absolute_path(f_id['path']),
+                    'hash_type': f_id['hashtype'],
+                    'hash_value': f_id['hashsum']
+                }
+                for f_id in file_ids
+            ]
+        except (NameError, KeyError) as ex:
+            return ex  # return error so that the cart can be updated
         with Cart.atomic():
-            for f_id in file_ids:
-                try:
-                    filepath = cls.fix_absolute_path(f_id['path'])
-                    hashtype = f_id['hashtype']
-                    hashval = f_id['hashsum']
-                    File.create(cart=cart, file_name=f_id['id'], bundle_path=filepath,
-                                hash_type=hashtype, hash_value=hashval)
-                    cart.updated_date = datetime.datetime.now()
-                    cart.save()
-                except (NameError, KeyError) as ex:
-                    return ex  # return error so that the cart can be updated
+            for batch in chunked(file_rows, cls.insert_chunk_size):
+                # pylint: disable=no-value-for-parameter
+                File.insert_many(batch).execute()
+                # pylint: enable=no-value-for-parameter
+            cart.updated_date = datetime.datetime.now()
+            cart.save()
         return None
 
     def prepare_bundle(self, cartid):
         """
         Check to see if all the files are staged locally.
 
-        Before calling the bundling action.  If not will call
-        itself to continue the waiting process
+        Before calling the bundling action. The files are counted by
+        status and the cart is moved to bundling with a conditional
+        update so only the last file to finish bundles the cart.
         """
-        bundle_flag = True
-        for c_file in File.select().where(File.cart == cartid):
-            if c_file.status == 'error':
-                # error pulling file so set cart error and return
-                try:
-                    mycart = Cart.get(Cart.id == cartid)
-                    mycart.status = 'error'
-                    mycart.error = 'Failed to pull file({})'.format(
-                        c_file.error)
-                    mycart.updated_date = datetime.datetime.now()
-                    mycart.save()
-                    Cart.database_close()
-                    return
-                except DoesNotExist:  # pragma: no cover
-                    # case if record no longer exists
-                    # creating this case in unit testing requires deletion and creation
-                    # occuring nearly simultaneously, as such cant create unit test
-                    Cart.database_close()
-                    return
+        status_counts = dict(File
+                             .select(File.status, fn.COUNT(File.id))
+                             .where(File.cart == cartid)
+                             .group_by(File.status)
+                             .tuples())
+        if status_counts.get('error'):
+            # error pulling file so set cart error and return
+            try:
+                c_file = (File
+                          .select()
+                          .where(
+                              (File.cart == cartid) &
+                              (File.status == 'error'))
+                          .get())
+                mycart = Cart.get(Cart.id == cartid)
+                mycart.status = 'error'
+                mycart.error = 'Failed to pull file({})'.format(
+                    c_file.error)
+                mycart.updated_date = datetime.datetime.now()
+                mycart.save()
+                Cart.database_close()
+                return
+            except DoesNotExist:  # pragma: no cover
+                # case if record no longer exists
+                # creating this case in unit testing requires deletion and creation
+                # occuring nearly simultaneously, as such cant create unit test
+                Cart.database_close()
+                return
 
-            elif c_file.status != 'staged':
-                bundle_flag = False
-
-        if bundle_flag:
+        if set(status_counts) - set(['staged']):
+            return
+        claimed = (Cart
+                   .update(status='bundling', updated_date=datetime.datetime.now())
+                   .where(
+                       (Cart.id == cartid) &
+                       (Cart.status << ['waiting', 'staging']))
+                   .execute())
+        if claimed:
             self.create_symlink(cartid)
             self.tar_files(cartid)
 
+    @staticmethod
+    def _open_bundle_tar(bundle_tar):
+        """Open the tar of a cart to append to, locked from other workers."""
+        tar_fd = open(bundle_tar, 'ab')
+        if fcntl is not None:
+            fcntl.flock(tar_fd, fcntl.LOCK_EX)
+        # other workers may have appended while we waited for the lock
+        tar_fd.seek(0, os.SEEK_END)
+        return tar_fd
+
+    @classmethod
+    def append_to_tar(cls, bundle_tar, filepath, arcname):
+        """
+        Append a file to the end of a tar that is still being built.
+
+        The tar has no end of archive blocks until finish_tar is called
+        so every append is a plain write at the end of the file. Only
+        the size in the header is copied so the padding after it is
+        right. A failed append is cut off again.
+        """
+        mytar = tarfile.open(fileobj=io.BytesIO(), mode='w')
+        tarinfo = mytar.gettarinfo(filepath, arcname)
+        with cls._open_bundle_tar(bundle_tar) as tar_fd, open(filepath, 'rb') as myfile:
+            start = tar_fd.tell()
+            try:
+                tar_fd.write(tarinfo.tobuf(mytar.format, mytar.encoding, mytar.errors))
+                tarfile.copyfileobj(myfile, tar_fd, tarinfo.size)
+                tar_fd.write(bytes((tarfile.BLOCKSIZE - tarinfo.size % tarfile.BLOCKSIZE) % tarfile.BLOCKSIZE))
+            except OSError:
+                tar_fd.truncate(start)
+                raise
+
+    @classmethod
+    def finish_tar(cls, bundle_tar):
+        """Write the end of archive blocks filling out the last record."""
+        with cls._open_bundle_tar(bundle_tar) as tar_fd:
+            size = tar_fd.tell() + tarfile.BLOCKSIZE * 2
+            padding = (tarfile.RECORDSIZE - size % tarfile.RECORDSIZE) % tarfile.RECORDSIZE
+            tar_fd.write(bytes(tarfile.BLOCKSIZE * 2 + padding))
+
+    def reserve_tar_slot(self, mycart, cart_file, size, modtime):
+        """
+        Add the header of a file to the tar of a bundled cart with space after it.
+
+        The file can then be pulled straight into the tar without the
+        file tree. Returns the tar path and the (offset, size) of the
+        space for the data.
+        """
+        bundle_path = self.cart_bundle_path(mycart)
+        tarinfo = tarfile.TarInfo(os.path.join(
+            os.path.basename(bundle_path),
+            os.path.relpath(self.cart_file_path(mycart, cart_file), bundle_path)))
+        tarinfo.size = size
+        tarinfo.mtime = int(float(modtime))
+        tarinfo.mode = 0o644
+        header = tarinfo.tobuf(tarfile.DEFAULT_FORMAT, tarfile.ENCODING, 'surrogateescape')
+        bundle_tar = '{}.tar'.format(bundle_path)
+        with self._open_bundle_tar(bundle_tar) as tar_fd:
+            offset = tar_fd.tell() + len(header)
+            tar_fd.write(header)
+            # leave the data as a hole filled in by the pull
+            tar_fd.truncate(offset + size + (tarfile.BLOCKSIZE - size % tarfile.BLOCKSIZE) % tarfile.BLOCKSIZE)
+        return bundle_tar, (offset, size)
+
+    def bundle_file(self, mycart, filepath):
+        """
+        Move a staged file into the tar of a bundled cart.
+
+        Files are appended as they are staged so the data is only on
+        disk once and the tar is nearly done when the last file is.
+        """
+        if not mycart.bundle:
+            return
+        bundle_path = self.cart_bundle_path(mycart)
+        arcname = os.path.join(os.path.basename(bundle_path), os.path.relpath(filepath, bundle_path))
+        self.append_to_tar('{}.tar'.format(bundle_path), filepath, arcname)
+        os.unlink(filepath)
+
     def tar_files(self, cartid):
         """
         Start to bundle all the files together.
 
         The option to do streaming download or not is
-        based on a system configuration.
+        based on a system configuration. Bundled carts already have
+        their files in the tar, any left over are appended in sorted
+        order before the tar is finished.
         """
         try:
             mycart = Cart.get(Cart.id == cartid)
-            bundle_path = os.path.join(
-                self._vol_path,
-                str(mycart.id),
-                mycart.cart_uid
-            )
+            bundle_path = self.cart_bundle_path(mycart)
             if mycart.bundle:
                 bundle_tar = '{}.tar'.format(bundle_path)
-                cart_tar = tarfile.open(
-                    bundle_tar,
-                    mode='w'
-                )
-                cart_tar.add(
-                    bundle_path, arcname=os.path.basename(bundle_path))
-                cart_tar.close()
-                shutil.rmtree(bundle_path)
+                for dirpath, dirnames, filenames in os.walk(bundle_path):
+                    dirnames.sort()
+                    for name in sorted(filenames):
+                        self.bundle_file(mycart, os.path.join(dirpath, name))
+                self.finish_tar(bundle_tar)
+                shutil.rmtree(bundle_path, ignore_errors=True)
+                self.release_store_files(cartid)
                 bundle_path = bundle_tar
             mycart.status = 'ready'
             mycart.bundle_path = bundle_path
@@ -465,11 +1041,7 @@ class Cartutils:
         """Create a symlink to the data."""
         try:
             mycart = Cart.get(Cart.id == cartid)
-            bundle_path = os.path.join(
-                self._vol_path,
-                str(mycart.id),
-                mycart.cart_uid
-            )
+            bundle_path = self.cart_bundle_path(mycart)
             if mycart.bundle:
                 bundle_path = '{}.tar'.format(bundle_path)
             root_path = os.path.join(self._vol_path, 'cartuids')
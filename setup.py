@@ -36,5 +36,9 @@ setup(
         'requests',
         'setuptools',
         'tqdm',
-    ]
+    ],
+    extras_require={
+        'async': ['aiohttp'],
+        'zstd': ['zstandard'],
+    }
 )
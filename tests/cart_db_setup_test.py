@@ -3,13 +3,27 @@
 """Test cart database setup class."""
 import os
 from time import sleep
+from contextlib import contextmanager
 import threading
 from tempfile import mkdtemp
+import mock
 import requests
 import cherrypy
 from celery.bin.celery import main as celery_main
 from pacifica.cartd.rest import CartRoot, error_page_default
-from pacifica.cartd.orm import Cart, File, CartTasks
+from pacifica.cartd.orm import Cart, File, CartTasks, SpaceReservation
+from pacifica.cartd.config import reload_config
+
+
+@contextmanager
+def config_env(values):
+    """Set the environment variables and read the configuration with them."""
+    try:
+        with mock.patch.dict(os.environ, values):
+            reload_config()
+            yield
+    finally:
+        reload_config()
 
 
 class TestCartdBase:
@@ -32,6 +46,7 @@ class TestCartdBase:
         """Unset the VOLUME_PATH for future tests."""
         if 'VOLUME_PATH' in os.environ:
             del os.environ['VOLUME_PATH']
+        reload_config()
     # pylint: enable=invalid-name
 
     @classmethod
@@ -40,6 +55,7 @@ class TestCartdBase:
         os.environ['VOLUME_PATH'] = '{}{}'.format(mkdtemp(), os.path.sep)
         os.environ['CARTD_CPCONFIG'] = os.path.join(os.path.dirname(
             os.path.realpath(__file__)), '..', 'server.conf')
+        reload_config()
         cherrypy.config.update({'error_page.default': error_page_default})
         cherrypy.config.update(os.environ['CARTD_CPCONFIG'])
         cherrypy.tree.mount(CartRoot(), '/', os.environ['CARTD_CPCONFIG'])
@@ -68,8 +84,8 @@ class TestCartdBase:
         # pylint: disable=protected-access
         # pylint: disable=no-member
         if os.path.isfile('db.sqlite3'):
-            Cart._meta.database.drop_tables([Cart, File, CartTasks])
-        Cart._meta.database.create_tables([Cart, File, CartTasks])
+            Cart._meta.database.drop_tables([Cart, File, CartTasks, SpaceReservation])
+        Cart._meta.database.create_tables([Cart, File, CartTasks, SpaceReservation])
         # pylint: enable=no-member
 
         def run_celery_worker():
@@ -186,6 +186,20 @@ class TestCartEndToEnd(TestCartdBase, helper.CPWebCase):
         # pylint: enable=broad-except
         self.assertFalse(hit_exception)
 
+    def test_fixit_cart_jobs(self, cart_id='41'):
+        """Test fixing a cart with more than one file at a time."""
+        self.test_status_cart(cart_id)
+        Cart.database_connect()
+        for break_file in Cart.get(cart_uid=cart_id).files:
+            break_file.status = 'error'
+            break_file.save()
+        Cart.database_close()
+        fixit(Namespace(cartids=[cart_id], jobs=2))
+        Cart.database_connect()
+        statuses = [cart_file.status for cart_file in Cart.get(cart_uid=cart_id).files]
+        Cart.database_close()
+        self.assertEqual(statuses, ['staged', 'staged', 'staged'])
+
     def test_delete_invalid_cart(self, cart_id='393'):
         """Test the deletion of a invalid cart."""
         resp = self.session.delete('{}/{}'.format(self.url, cart_id))
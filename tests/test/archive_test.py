@@ -1,12 +1,60 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 """Add Unit Tests for archive interface."""
+import io
+import os
+import hashlib
 import unittest
+import threading
 from json import dumps, loads
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
 from tempfile import mkdtemp
 import httpretty
+import mock
 import requests
-from pacifica.cartd.archive_requests import ArchiveRequests
+import urllib3
+from pacifica.cartd.archive_requests import ArchiveRequests, BufferPool, get_session
+from ..cart_db_setup_test import config_env
+
+
+class TruncatingHandler(BaseHTTPRequestHandler):
+    """Send a body that is cut short unless a range is asked for."""
+
+    protocol_version = 'HTTP/1.1'
+    body = bytes(range(256)) * 782
+
+    # pylint: disable=invalid-name
+    def do_GET(self):
+        """Close the connection part way through the whole file, send ranges whole."""
+        self.server.ranges.append(self.headers.get('Range'))
+        if self.headers.get('Range'):
+            start = int(self.headers['Range'].split('=')[1].rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Length', str(len(self.body) - start))
+            self.end_headers()
+            self.wfile.write(self.body[start:])
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body[:150000])
+        self.close_connection = True
+    # pylint: enable=invalid-name
+
+    def log_message(self, *_args):
+        """Don't log the requests."""
+
+
+class TruncatingServer(ThreadingMixIn, HTTPServer):
+    """Threaded server keeping the Range header of every request."""
+
+    daemon_threads = True
+
+    def __init__(self, *args):
+        """Start with no requests."""
+        super().__init__(*args)
+        self.ranges = []
 
 
 class TestArchiveRequests(unittest.TestCase):
@@ -116,3 +164,267 @@ class TestArchiveRequests(unittest.TestCase):
         hashtype = 'md5'
         with self.assertRaises(ValueError):
             archreq.pull_file('1', '{}/1'.format(temp_dir), hashval, hashtype)
+
+    @httpretty.activate
+    def test_archive_get_resume(self):
+        """Test pulling a file resumes after the bytes already pulled."""
+        response_body = b'This is the body of the file in the archive.'
+
+        def range_callback(request, _uri, response_headers):
+            """Send the bytes asked for by the range header."""
+            start = int(request.headers['Range'].split('=')[1].rstrip('-'))
+            return [206, response_headers, response_body[start:]]
+        httpretty.register_uri(httpretty.GET, '{}/1'.format(self.endpoint_url), body=range_callback)
+        temp_dir = mkdtemp()
+        with open('{}/1'.format(temp_dir), 'wb') as testfd:
+            testfd.write(response_body[:10])
+        archreq = ArchiveRequests()
+        archreq.pull_file('1', '{}/1'.format(temp_dir), '5bf018b3c598df19b5f4363fc55f2f89', 'md5')
+        self.assertEqual(httpretty.last_request().headers['Range'], 'bytes=10-')
+        with open('{}/1'.format(temp_dir), 'rb') as testfd:
+            self.assertEqual(testfd.read(), response_body)
+
+    @httpretty.activate
+    def test_archive_get_resume_ignored(self):
+        """Test pulling a file starts over when the archive sends all of it."""
+        response_body = 'This is the body of the file in the archive.'
+        httpretty.register_uri(httpretty.GET, '{}/1'.format(self.endpoint_url),
+                               body=response_body,
+                               content_type='application/octet-stream')
+        temp_dir = mkdtemp()
+        with open('{}/1'.format(temp_dir), 'wb') as testfd:
+            testfd.write(b'This is')
+        archreq = ArchiveRequests()
+        archreq.pull_file('1', '{}/1'.format(temp_dir), '5bf018b3c598df19b5f4363fc55f2f89', 'md5')
+        with open('{}/1'.format(temp_dir), 'rb') as testfd:
+            self.assertEqual(testfd.read().decode('UTF-8'), response_body)
+
+    @httpretty.activate
+    def test_archive_get_linked(self):
+        """Test pulling into a file linked from the store leaves the store copy alone."""
+        response_body = 'This is the body of the file in the archive.'
+        httpretty.register_uri(httpretty.GET, '{}/1'.format(self.endpoint_url),
+                               body=response_body,
+                               content_type='application/octet-stream')
+        temp_dir = mkdtemp()
+        with open('{}/blob'.format(temp_dir), 'wb') as testfd:
+            testfd.write(b'This is')
+        os.link('{}/blob'.format(temp_dir), '{}/1'.format(temp_dir))
+        ArchiveRequests().pull_file('1', '{}/1'.format(temp_dir), '5bf018b3c598df19b5f4363fc55f2f89', 'md5')
+        with open('{}/1'.format(temp_dir), 'rb') as testfd:
+            self.assertEqual(testfd.read().decode('UTF-8'), response_body)
+        with open('{}/blob'.format(temp_dir), 'rb') as testfd:
+            self.assertEqual(testfd.read(), b'This is')
+        self.assertFalse('Range' in httpretty.last_request().headers)
+
+    @httpretty.activate
+    def test_archive_get_complete(self):
+        """Test pulling a file that is already all on disk."""
+        httpretty.register_uri(httpretty.GET, '{}/1'.format(self.endpoint_url), status=416)
+        temp_dir = mkdtemp()
+        with open('{}/1'.format(temp_dir), 'wb') as testfd:
+            testfd.write(b'This is the body of the file in the archive.')
+        archreq = ArchiveRequests()
+        archreq.pull_file('1', '{}/1'.format(temp_dir), '5bf018b3c598df19b5f4363fc55f2f89', 'md5', 1)
+        # a bad file on disk is removed so the next try starts over
+        with self.assertRaises(ValueError):
+            archreq.pull_file('1', '{}/1'.format(temp_dir), '5b', 'md5', 1)
+        self.assertFalse(os.path.isfile('{}/1'.format(temp_dir)))
+
+    def test_archive_get_broken_stream(self):
+        """Test a body cut short by the archive is resumed from where it stopped."""
+        server = TruncatingServer(('127.0.0.1', 0), TruncatingHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        temp_dir = mkdtemp()
+        filepath = '{}/1'.format(temp_dir)
+        hashval = hashlib.md5(TruncatingHandler.body).hexdigest()
+        with config_env({'ARCHIVE_INTERFACE_URL': 'http://127.0.0.1:{}/'.format(server.server_address[1])}):
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                ArchiveRequests().pull_file('1', filepath, hashval, 'md5', 1)
+            self.assertEqual(os.path.getsize(filepath), 150000)
+            ArchiveRequests().pull_file('1', filepath, hashval, 'md5', 1)
+        server.shutdown()
+        server.server_close()
+        self.assertEqual(server.ranges, [None, 'bytes=150000-'])
+        with open(filepath, 'rb') as testfd:
+            self.assertEqual(testfd.read(), TruncatingHandler.body)
+
+    @httpretty.activate
+    def test_archive_get_pipeline(self):
+        """Test the stats of each pipeline stage with and without threads."""
+        response_body = 'This is the body of the file in the archive.'
+        httpretty.register_uri(httpretty.GET, '{}/1'.format(self.endpoint_url),
+                               body=response_body,
+                               content_type='application/octet-stream')
+        temp_dir = mkdtemp()
+        for depth in ['4', '0']:
+            with config_env({'PULL_PIPELINE_DEPTH': depth}), \
+                    self.assertLogs('pacifica.cartd.archive_requests', 'DEBUG') as logs:
+                archreq = ArchiveRequests()
+                archreq.pull_file('1', '{}/1'.format(temp_dir), '5bf018b3c598df19b5f4363fc55f2f89', 'md5')
+            with open('{}/1'.format(temp_dir), 'rb') as testfd:
+                self.assertEqual(testfd.read().decode('UTF-8'), response_body)
+            self.assertEqual(sorted(archreq.pull_stats.keys()), ['hash', 'read', 'write'])
+            for stats in archreq.pull_stats.values():
+                self.assertEqual(stats['bytes'], len(response_body))
+                self.assertTrue('MBps' in stats)
+            self.assertTrue('Pulled 1 read 44 bytes' in logs.output[-1])
+
+    @httpretty.activate
+    def test_archive_get_small_buffers(self):
+        """Test a pull much larger than the reused buffers is not mixed up."""
+        response_body = bytes(range(256)) * 64
+        httpretty.register_uri(httpretty.GET, '{}/1'.format(self.endpoint_url),
+                               body=response_body,
+                               content_type='application/octet-stream')
+        temp_dir = mkdtemp()
+        for depth in ['2', '0']:
+            with config_env({'TRANSFER_SIZE': '100 B', 'PULL_PIPELINE_DEPTH': depth}):
+                ArchiveRequests().pull_file(
+                    '1', '{}/1'.format(temp_dir), hashlib.md5(response_body).hexdigest(), 'md5')
+            with open('{}/1'.format(temp_dir), 'rb') as testfd:
+                self.assertEqual(testfd.read(), response_body)
+
+    def test_buffer_pool(self):
+        """Test buffers are free again after every user released them."""
+        pool = BufferPool(1, 8, 2)
+        buf = pool.get()
+        view = memoryview(buf)[:4]
+        pool.release(view)
+        self.assertTrue(pool.free.empty())
+        pool.release(view)
+        self.assertTrue(pool.get() is buf)
+
+    @httpretty.activate
+    def test_archive_get_tar_slot(self):
+        """Test pulling a file into a slot of a tar."""
+        response_body = b'This is the body of the file in the archive.'
+        httpretty.register_uri(httpretty.GET, '{}/1'.format(self.endpoint_url),
+                               body=response_body,
+                               content_type='application/octet-stream')
+        tar_path = os.path.join(mkdtemp(), 'cart.tar')
+        with open(tar_path, 'wb') as tarfd:
+            tarfd.write(b'x' * 100)
+        archreq = ArchiveRequests()
+        archreq.pull_file('1', tar_path, '5bf018b3c598df19b5f4363fc55f2f89', 'md5', tar_slot=(10, len(response_body)))
+        with open(tar_path, 'rb') as tarfd:
+            self.assertEqual(tarfd.read(), b'x' * 10 + response_body + b'x' * (90 - len(response_body)))
+        for size in [len(response_body) - 1, len(response_body) + 1]:
+            with self.assertRaises(ValueError):
+                archreq.pull_file('1', tar_path, '5bf018b3c598df19b5f4363fc55f2f89', 'md5', 1, (10, size))
+        with self.assertRaises(ValueError):
+            archreq.pull_file('1', tar_path, '5b', 'md5', 1, (10, len(response_body)))
+        httpretty.register_uri(httpretty.GET, '{}/1'.format(self.endpoint_url), status=500)
+        with self.assertRaises(requests.exceptions.RequestException):
+            archreq.pull_file('1', tar_path, '5b', 'md5', 1, (10, len(response_body)))
+
+    @httpretty.activate
+    def test_archive_get_readinto(self):
+        """Test the body is read into the buffers without the urllib3 copy."""
+        response_body = 'This is the body of the file in the archive.'
+        httpretty.register_uri(httpretty.GET, '{}/1'.format(self.endpoint_url),
+                               body=response_body,
+                               content_type='application/octet-stream')
+        temp_dir = mkdtemp()
+        with mock.patch.object(urllib3.response.HTTPResponse, 'readinto') as mock_readinto:
+            ArchiveRequests().pull_file('1', '{}/1'.format(temp_dir), '5bf018b3c598df19b5f4363fc55f2f89', 'md5')
+        mock_readinto.assert_not_called()
+        with open('{}/1'.format(temp_dir), 'rb') as testfd:
+            self.assertEqual(testfd.read().decode('UTF-8'), response_body)
+
+    def test_archive_readinto_error(self):
+        """Test errors reading the http.client response are urllib3 errors."""
+        stream = mock.Mock(headers={})
+        stream._fp.readinto.side_effect = OSError('Connection reset')  # pylint: disable=protected-access
+        readinto = ArchiveRequests._stream_readinto(stream)  # pylint: disable=protected-access
+        with self.assertRaises(urllib3.exceptions.ProtocolError):
+            readinto(bytearray(4))
+        stream.headers['content-encoding'] = 'gzip'
+        self.assertTrue(ArchiveRequests._stream_readinto(stream) is stream.readinto)  # pylint: disable=protected-access
+
+    def test_archive_pipeline_error(self):
+        """Test an error in a pipeline stage is raised by the pull."""
+        myfile = mock.Mock()
+        myfile.write.side_effect = OSError('No space left on device')
+        archreq = ArchiveRequests()
+        with self.assertRaises(OSError), config_env({'PULL_PIPELINE_DEPTH': '4'}):
+            archreq._copy_stream(  # pylint: disable=protected-access
+                io.BytesIO(b'x' * 64), myfile, hashlib.md5(), 4)
+        self.assertEqual(archreq.pull_stats['write']['bytes'], 0)
+
+    @httpretty.activate
+    def test_archive_get_parallel(self):
+        """Test pulling a file as byte ranges at the same time."""
+        response_body = b'This is the body of the file in the archive.'
+
+        def range_callback(request, _uri, response_headers):
+            """Send the bytes asked for by the range header."""
+            start, end = request.headers['Range'].split('=')[1].split('-')
+            return [206, response_headers, response_body[int(start):int(end) + 1]]
+        httpretty.register_uri(httpretty.HEAD, '{}/1'.format(self.endpoint_url),
+                               adding_headers={'x-content-length': str(len(response_body))})
+        httpretty.register_uri(httpretty.GET, '{}/1'.format(self.endpoint_url), body=range_callback)
+        temp_dir = mkdtemp()
+        with config_env({'PARALLEL_PULL_STREAMS': '3', 'PARALLEL_PULL_THRESHOLD': '1 B'}):
+            archreq = ArchiveRequests()
+            archreq.pull_file('1', '{}/1'.format(temp_dir), '5bf018b3c598df19b5f4363fc55f2f89', 'md5')
+            with open('{}/1'.format(temp_dir), 'rb') as testfd:
+                self.assertEqual(testfd.read(), response_body)
+            self.assertEqual(
+                sorted(req.headers['Range'] for req in httpretty.latest_requests() if req.method == 'GET'),
+                ['bytes=0-14', 'bytes=15-29', 'bytes=30-43']
+            )
+            with self.assertRaises(ValueError):
+                archreq.pull_file('1', '{}/1'.format(temp_dir), '5b', 'md5', 1)
+
+    @httpretty.activate
+    def test_archive_get_parallel_no_ranges(self):
+        """Test pulling a file as ranges from an archive without range support."""
+        response_body = 'This is the body of the file in the archive.'
+        httpretty.register_uri(httpretty.HEAD, '{}/1'.format(self.endpoint_url),
+                               adding_headers={'x-content-length': str(len(response_body))})
+        httpretty.register_uri(httpretty.GET, '{}/1'.format(self.endpoint_url),
+                               body=response_body,
+                               content_type='application/octet-stream')
+        temp_dir = mkdtemp()
+        with config_env({'PARALLEL_PULL_STREAMS': '2', 'PARALLEL_PULL_THRESHOLD': '1 B'}):
+            archreq = ArchiveRequests()
+            archreq.pull_file('1', '{}/1'.format(temp_dir), '5bf018b3c598df19b5f4363fc55f2f89', 'md5')
+            with open('{}/1'.format(temp_dir), 'rb') as testfd:
+                self.assertEqual(testfd.read().decode('UTF-8'), response_body)
+            httpretty.register_uri(httpretty.GET, '{}/1'.format(self.endpoint_url), status=500)
+            with self.assertRaises(requests.exceptions.RequestException):
+                archreq.pull_file('1', '{}/1'.format(temp_dir), '5bf018b3c598df19b5f4363fc55f2f89', 'md5', 1)
+            httpretty.register_uri(httpretty.HEAD, '{}/1'.format(self.endpoint_url), status=500)
+            with self.assertRaises(requests.exceptions.RequestException):
+                archreq.pull_file('1', '{}/1'.format(temp_dir), '5bf018b3c598df19b5f4363fc55f2f89', 'md5', 1)
+
+    @httpretty.activate
+    def test_archive_get_parallel_single(self):
+        """Test files without a size or too small for ranges are pulled as a single stream."""
+        httpretty.register_uri(httpretty.HEAD, '{}/1'.format(self.endpoint_url))
+        httpretty.register_uri(httpretty.HEAD, '{}/2'.format(self.endpoint_url),
+                               adding_headers={'x-content-length': '0'})
+        httpretty.register_uri(httpretty.HEAD, '{}/3'.format(self.endpoint_url),
+                               adding_headers={'x-content-length': '1'})
+        for name, body in [('1', b'no size'), ('2', b''), ('3', b'1')]:
+            httpretty.register_uri(httpretty.GET, '{}/{}'.format(self.endpoint_url, name), body=body)
+        temp_dir = mkdtemp()
+        with config_env({'PARALLEL_PULL_STREAMS': '2', 'PARALLEL_PULL_THRESHOLD': '0 B'}):
+            archreq = ArchiveRequests()
+            for name, body in [('1', b'no size'), ('2', b''), ('3', b'1')]:
+                archreq.pull_file(name, os.path.join(temp_dir, name), hashlib.md5(body).hexdigest(), 'md5', 1)
+                with open(os.path.join(temp_dir, name), 'rb') as testfd:
+                    self.assertEqual(testfd.read(), body)
+        self.assertFalse(any('Range' in req.headers for req in httpretty.latest_requests()))
+
+    def test_archive_session(self):
+        """Test the session is shared in a process but not across processes."""
+        session = get_session()
+        self.assertTrue(ArchiveRequests()._session is session)  # pylint: disable=protected-access
+        self.assertTrue(get_session() is session)
+        with mock.patch('pacifica.cartd.archive_requests.getpid') as mock_getpid:
+            mock_getpid.return_value = -1
+            self.assertFalse(get_session() is session)
+        adapter = get_session().get_adapter(self.endpoint_url)
+        self.assertEqual(adapter.max_retries.total, 3)
@@ -0,0 +1,267 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Add Unit Tests for the asyncio archive interface client."""
+import os
+import asyncio
+import hashlib
+import threading
+from tempfile import mkdtemp
+import mock
+import requests
+from aiohttp import web
+from cherrypy.test import helper
+from pacifica.cartd.async_archive_requests import AsyncArchiveRequests
+from pacifica.cartd.tasks import async_cart_task
+from pacifica.cartd.orm import Cart, File
+from pacifica.cartd.utils import Cartutils
+from ..cart_db_setup_test import TestCartdBase, config_env
+
+
+def run_loop(coro):
+    """Run the coroutine in a new event loop."""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class StandInArchive:
+    """
+    Local stand in for the archive interface.
+
+    Files are on tape until they have been staged and asked for
+    status once more, tape.txt stays on tape. Asking for the status of
+    fail.txt or staging fail.csv errors and slow.txt takes two seconds
+    to send. The Range header of every pull is kept in ranges.
+    """
+
+    def __init__(self, files):
+        """Save the files the archive has."""
+        self.files = files
+        self.staged = {}
+        self.ranges = []
+        self.url = None
+        self._loop = asyncio.new_event_loop()
+        self._runner = None
+
+    async def _head(self, request):
+        """Return the status headers of a file."""
+        name = request.match_info['name']
+        if name == 'fail.txt':
+            raise web.HTTPInternalServerError()
+        polls = self.staged.get(name, 0)
+        if polls:
+            self.staged[name] += 1
+        return web.Response(headers={
+            'x-pacifica-messsage': 'File was found',
+            'x-pacifica-ctime': '1444938166',
+            'x-pacifica-bytes-per-level': '(0L, 0L)',
+            'x-pacifica-file-storage-media': 'disk' if polls > 1 and name != 'tape.txt' else 'tape',
+            'x-content-length': str(len(self.files[name])),
+            'last-modified': '1444938166'
+        })
+
+    async def _post(self, request):
+        """Stage the file."""
+        name = request.match_info['name']
+        if name == 'fail.csv':
+            raise web.HTTPInternalServerError()
+        self.staged[name] = 1
+        return web.json_response({'message': 'File was staged', 'file': name})
+
+    async def _get(self, request):
+        """Return the file contents or the bytes from the start of the range."""
+        if request.match_info['name'] == 'slow.txt':
+            await asyncio.sleep(2)
+        body = self.files[request.match_info['name']]
+        self.ranges.append(request.headers.get('Range'))
+        if request.headers.get('Range'):
+            start = int(request.headers['Range'].split('=')[1].rstrip('-'))
+            return web.Response(status=206, body=body[start:])
+        return web.Response(body=body)
+
+    async def _start(self):
+        """Start the web application."""
+        app = web.Application()
+        app.router.add_route('HEAD', '/{name}', self._head)
+        app.router.add_route('POST', '/{name}', self._post)
+        app.router.add_route('GET', '/{name}', self._get)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        # pylint: disable=protected-access
+        port = site._server.sockets[0].getsockname()[1]
+        # pylint: enable=protected-access
+        self.url = 'http://127.0.0.1:{}/'.format(port)
+
+    def __enter__(self):
+        """Run the archive in a thread."""
+        self._loop.run_until_complete(self._start())
+        threading.Thread(target=self._loop.run_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        """Stop the archive thread."""
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+class TestAsyncArchiveRequests(TestCartdBase, helper.CPWebCase):
+    """Test the asyncio archive requests class."""
+
+    files = {
+        'foo.txt': b'Writing content for first file',
+        'bar.csv': b'Writing,content,for,second,file'
+    }
+
+    @staticmethod
+    def hash_content(data):
+        """Hash the data."""
+        return hashlib.md5(data).hexdigest()
+
+    def test_async_archive_requests(self):
+        """Test stage, status and pull with the async client."""
+        temp_dir = mkdtemp()
+
+        async def run_requests():
+            """Use the client to get foo.txt."""
+            async with AsyncArchiveRequests(2) as archreq:
+                await archreq.stage_file('foo.txt')
+                await archreq.status_file('foo.txt')
+                status = await archreq.status_file('foo.txt')
+                await archreq.pull_file(
+                    'foo.txt', os.path.join(temp_dir, 'foo.txt'),
+                    self.hash_content(self.files['foo.txt']), 'md5')
+                with self.assertRaises(ValueError):
+                    await archreq.pull_file('bar.csv', os.path.join(temp_dir, 'bar.csv'), '5b', 'md5', 1)
+                with self.assertRaises(requests.exceptions.RequestException):
+                    await archreq.status_file('fail.txt')
+                with self.assertRaises(requests.exceptions.RequestException):
+                    await archreq.stage_file('fail.csv')
+                return status
+        with StandInArchive(self.files) as archive:
+            with config_env({'ARCHIVE_INTERFACE_URL': archive.url}):
+                status = run_loop(run_requests())
+        self.assertTrue('"file_storage_media": "disk"' in status)
+        with open(os.path.join(temp_dir, 'foo.txt'), 'rb') as testfd:
+            self.assertEqual(testfd.read(), self.files['foo.txt'])
+
+    def test_async_archive_resume(self):
+        """Test a pull asks only for the bytes after those already on disk."""
+        temp_dir = mkdtemp()
+        filepath = os.path.join(temp_dir, 'foo.txt')
+        with open(filepath, 'wb') as testfd:
+            testfd.write(self.files['foo.txt'][:10])
+
+        async def run_requests():
+            """Pull the rest of foo.txt."""
+            async with AsyncArchiveRequests() as archreq:
+                await archreq.pull_file('foo.txt', filepath, self.hash_content(self.files['foo.txt']), 'md5')
+        with StandInArchive(self.files) as archive:
+            with config_env({'ARCHIVE_INTERFACE_URL': archive.url}):
+                run_loop(run_requests())
+        self.assertEqual(archive.ranges, ['bytes=10-'])
+        with open(filepath, 'rb') as testfd:
+            self.assertEqual(testfd.read(), self.files['foo.txt'])
+
+    def test_async_archive_down(self):
+        """Test the async client raises request errors when the archive is down."""
+        async def run_requests():
+            """Try each request against nothing."""
+            async with AsyncArchiveRequests() as archreq:
+                with self.assertRaises(requests.exceptions.RequestException):
+                    await archreq.stage_file('foo.txt')
+                with self.assertRaises(requests.exceptions.RequestException):
+                    await archreq.status_file('foo.txt')
+                with self.assertRaises(requests.exceptions.RequestException):
+                    await archreq.pull_file('foo.txt', os.path.join(mkdtemp(), 'foo.txt'), '5b', 'md5', 1)
+        with config_env({'ARCHIVE_INTERFACE_URL': 'http://127.0.0.1:1/'}):
+            run_loop(run_requests())
+
+    def test_async_archive_timeout(self):
+        """Test a read timing out raises a request error."""
+        async def run_requests():
+            """Pull the slow file."""
+            async with AsyncArchiveRequests() as archreq:
+                with self.assertRaises(requests.exceptions.RequestException):
+                    await archreq.pull_file('slow.txt', os.path.join(mkdtemp(), 'slow.txt'), '5b', 'md5', 1)
+        with StandInArchive({'slow.txt': b'slow'}) as archive:
+            with config_env({
+                    'ARCHIVE_INTERFACE_URL': archive.url, 'ARCHIVE_INTERFACE_ASYNC_READ_TIMEOUT': '1'}):
+                run_loop(run_requests())
+
+    def test_async_cart_task(self):
+        """Test the async task pulls all the files of a cart."""
+        test_cart = self.create_sample_cart()
+        for name, content in self.files.items():
+            File.create(
+                cart=test_cart, file_name=name, bundle_path=name,
+                hash_type='md5', hash_value=self.hash_content(content)
+            )
+        with StandInArchive(self.files) as archive:
+            with config_env({'ARCHIVE_INTERFACE_URL': archive.url, 'STATUS_POLL_INTERVAL': '0'}):
+                async_cart_task(test_cart.id)
+        statuses = [cart_file.status for cart_file in File.select().where(File.cart == test_cart.id)]
+        self.assertEqual(statuses, ['staged', 'staged'])
+        self.assertEqual(Cart.get(Cart.id == test_cart.id).status, 'ready')
+
+    def test_async_cart_task_error(self):
+        """Test the async task records file errors on the cart."""
+        test_cart = self.create_sample_cart()
+        File.create(cart=test_cart, file_name='fail.txt', bundle_path='fail.txt')
+        with StandInArchive(self.files) as archive:
+            with config_env({'ARCHIVE_INTERFACE_URL': archive.url}):
+                async_cart_task(test_cart.id)
+        self.assertEqual(Cart.get(Cart.id == test_cart.id).status, 'error')
+
+    def test_async_cart_task_timeout(self):
+        """Test files the archive never stages are set to error after status_poll_timeout."""
+        test_cart = self.create_sample_cart()
+        test_file = File.create(cart=test_cart, file_name='tape.txt', bundle_path='tape.txt')
+        with StandInArchive({'tape.txt': b'on tape'}) as archive:
+            with config_env({
+                    'ARCHIVE_INTERFACE_URL': archive.url, 'STATUS_POLL_INTERVAL': '0', 'STATUS_POLL_TIMEOUT': '0'}):
+                async_cart_task(test_cart.id)
+        test_file = File.get(File.id == test_file.id)
+        self.assertEqual((test_file.status, test_file.error), ('error', 'Timed out waiting for the archive'))
+        self.assertEqual(Cart.get(Cart.id == test_cart.id).status, 'error')
+
+    def test_async_cart_task_unexpected(self):
+        """Test an unexpected error of one file doesn't stop the others."""
+        test_cart = self.create_sample_cart()
+        for name, content in self.files.items():
+            File.create(
+                cart=test_cart, file_name=name, bundle_path=name,
+                hash_type='md5', hash_value=self.hash_content(content)
+            )
+        real_ready = Cartutils.check_file_ready_pull
+
+        def check_file_ready_pull(cart_utils, response, cart_file, mycart):
+            """Fail for bar.csv."""
+            if cart_file.file_name == 'bar.csv':
+                raise KeyError('filesize')
+            return real_ready(cart_utils, response, cart_file, mycart)
+        with StandInArchive(self.files) as archive:
+            with config_env({'ARCHIVE_INTERFACE_URL': archive.url, 'STATUS_POLL_INTERVAL': '0'}), \
+                    mock.patch.object(Cartutils, 'check_file_ready_pull', autospec=True,
+                                      side_effect=check_file_ready_pull):
+                async_cart_task(test_cart.id)
+        statuses = {
+            cart_file.file_name: cart_file.status
+            for cart_file in File.select().where(File.cart == test_cart.id)
+        }
+        self.assertEqual(statuses, {'foo.txt': 'staged', 'bar.csv': 'error'})
+
+    def test_async_cart_task_deleted(self):
+        """Test the async task leaves deleted or missing carts alone."""
+        test_cart = Cart.create(
+            cart_uid='1',
+            status='staging',
+            deleted_date='2017-05-03 00:00:00'
+        )
+        test_file = self.create_sample_file(test_cart)
+        async_cart_task(test_cart.id)
+        async_cart_task(9999999)
+        self.assertEqual(File.get(File.id == test_file.id).status, 'waiting')
@@ -29,7 +29,7 @@ except ImportError:
 import peewee
 from pacifica.cartd.orm import DB
 from pacifica.cartd.__main__ import cmd, main
-from ..cart_db_setup_test import TestCartdBase
+from ..cart_db_setup_test import TestCartdBase, config_env
 
 
 class TestAdminCmdBase(TestCase):
@@ -79,29 +79,29 @@ class TestAdminCmd(TestAdminCmdBase):
 
     def test_dump(self):
         """test that the dump command works."""
-        os.environ['VOLUME_PATH'] = '{}{}'.format(mkdtemp(), os.path.sep)
-        tcb = TestCartdBase()
-        tcb.setUp()
-        cart = TestCartdBase.create_sample_cart('EFEFEFE')
-        TestCartdBase.create_sample_file(cart)
-        self.assertEqual(cmd('dump'), 0)
-        self.assertEqual(cmd('dump', '--json'), 0)
-        tcb.tearDown()
+        with config_env({'VOLUME_PATH': '{}{}'.format(mkdtemp(), os.path.sep)}):
+            tcb = TestCartdBase()
+            tcb.setUp()
+            cart = TestCartdBase.create_sample_cart('EFEFEFE')
+            TestCartdBase.create_sample_file(cart)
+            self.assertEqual(cmd('dump'), 0)
+            self.assertEqual(cmd('dump', '--json'), 0)
+            tcb.tearDown()
 
     def test_purge(self):
         """test the purge command."""
-        os.environ['VOLUME_PATH'] = '{}{}'.format(mkdtemp(), os.path.sep)
-        tcb = TestCartdBase()
-        tcb.setUp()
-        cart = TestCartdBase.create_sample_cart('EFEFEFE')
-        cart.created_date = datetime.now()-timedelta(days=70)
-        cart.updated_date = datetime.now()-timedelta(days=70)
-        cart.save()
-        TestCartdBase.create_sample_file(cart)
-        self.assertEqual(cmd('purge', '--time-ago=60 days ago'), 0)
-        cart.reload()
-        self.assertEqual(cart.status, 'deleted')
-        tcb.tearDown()
+        with config_env({'VOLUME_PATH': '{}{}'.format(mkdtemp(), os.path.sep)}):
+            tcb = TestCartdBase()
+            tcb.setUp()
+            cart = TestCartdBase.create_sample_cart('EFEFEFE')
+            cart.created_date = datetime.now()-timedelta(days=70)
+            cart.updated_date = datetime.now()-timedelta(days=70)
+            cart.save()
+            TestCartdBase.create_sample_file(cart)
+            self.assertEqual(cmd('purge', '--time-ago=60 days ago'), 0)
+            cart.reload()
+            self.assertEqual(cart.status, 'deleted')
+            tcb.tearDown()
 
 
 class TestAdminCmdSync(TestAdminCmdBase):
@@ -0,0 +1,100 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Unit test the compressed cart downloads."""
+import io
+import os
+import gzip
+import tarfile
+import zipfile
+import unittest
+from tempfile import mkdtemp
+import zstandard
+from pacifica.cartd import compress
+from pacifica.cartd.compress import compress_cart, gzip_stream
+
+
+class TestCompress(unittest.TestCase):
+    """Test the compress module."""
+
+    contents = {
+        'a.txt': b'Writing content for first file',
+        os.path.join('sub', 'b.bin'): os.urandom(3000) * 3
+    }
+
+    def make_cart_dir(self):
+        """Make a directory of files to compress."""
+        cart_path = mkdtemp()
+        os.makedirs(os.path.join(cart_path, 'sub'))
+        for name, content in self.contents.items():
+            with open(os.path.join(cart_path, name), 'wb') as myfile:
+                myfile.write(content)
+        return cart_path
+
+    def check_tar(self, data):
+        """Check the tar has the contents."""
+        with tarfile.open(fileobj=io.BytesIO(data)) as mytar:
+            for name, content in self.contents.items():
+                self.assertEqual(mytar.extractfile(os.path.join('data', name)).read(), content)
+
+    def check_zip(self, data, prefix):
+        """Check the zip has the contents."""
+        with zipfile.ZipFile(io.BytesIO(data)) as myzip:
+            self.assertEqual(myzip.testzip(), None)
+            for name, content in self.contents.items():
+                self.assertEqual(myzip.read(os.path.join(prefix, name)), content)
+
+    def test_gzip_blocks(self):
+        """Test blocks compressed apart join into one gzip stream."""
+        compress.GZIP_BLOCK_SIZE = 1000
+        data = os.urandom(500) * 20
+        compressed = b''.join(gzip_stream([data[:3333], data[3333:], b''], 3))
+        compress.GZIP_BLOCK_SIZE = 1024 * 1024
+        self.assertEqual(gzip.decompress(compressed), data)
+        self.assertEqual(gzip.decompress(b''.join(gzip_stream([], 2))), b'')
+
+    def test_compress_dir(self):
+        """Test compressing a streamed cart directory in every format."""
+        cart_path = self.make_cart_dir()
+        self.check_tar(gzip.decompress(b''.join(compress_cart('tar.gz', cart_path, 'data', 100, 2))))
+        self.check_tar(zstandard.ZstdDecompressor().decompressobj().decompress(
+            b''.join(compress_cart('tar.zst', cart_path, 'data', 100, 2))))
+        for fmt in ['zip', 'zip-stored']:
+            self.check_zip(b''.join(compress_cart(fmt, cart_path, 'data', 100, 2)), 'data')
+
+    def test_compress_bundle(self):
+        """Test compressing a bundled cart tar."""
+        cart_path = self.make_cart_dir()
+        bundle_tar = os.path.join(mkdtemp(), 'cart.tar')
+        with tarfile.open(bundle_tar, 'w') as mytar:
+            mytar.add(cart_path, arcname='data')
+        self.check_tar(gzip.decompress(b''.join(compress_cart('tar.gz', bundle_tar, 'ignored', 100, 2))))
+        self.check_zip(b''.join(compress_cart('zip', bundle_tar, 'mycart', 100, 2)), 'mycart')
+
+    def test_compress_bundle_links(self):
+        """Test hard linked files of a bundled cart tar are in the zip."""
+        cart_path = self.make_cart_dir()
+        os.link(os.path.join(cart_path, 'a.txt'), os.path.join(cart_path, 'c.txt'))
+        bundle_tar = os.path.join(mkdtemp(), 'cart.tar')
+        with tarfile.open(bundle_tar, 'w') as mytar:
+            mytar.add(cart_path, arcname='data')
+            self.assertTrue(mytar.getmember('data/c.txt').islnk())
+        with zipfile.ZipFile(io.BytesIO(b''.join(compress_cart('zip', bundle_tar, 'mycart', 100, 2)))) as myzip:
+            self.assertEqual(myzip.testzip(), None)
+            self.assertEqual(myzip.read('mycart/c.txt'), self.contents['a.txt'])
+
+    def test_zip_blocks(self):
+        """Test zip members deflated in blocks apart read back."""
+        compress.GZIP_BLOCK_SIZE = 1000
+        cart_path = self.make_cart_dir()
+        data = b''.join(compress_cart('zip', cart_path, 'data', 100, 3))
+        compress.GZIP_BLOCK_SIZE = 1024 * 1024
+        self.check_zip(data, 'data')
+
+    def test_zip64(self):
+        """Test zip64 records are written past the zip64 limit."""
+        cart_path = self.make_cart_dir()
+        compress.ZIP64_LIMIT = 100
+        data = b''.join(compress_cart('zip', cart_path, 'data', 100, 2))
+        compress.ZIP64_LIMIT = zipfile.ZIP64_LIMIT
+        self.assertTrue(b'PK\x06\x06' in data)
+        self.check_zip(data, 'data')
@@ -0,0 +1,72 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Test the cached configuration."""
+import os
+import unittest
+from tempfile import mkstemp
+import mock
+import cherrypy
+from pacifica.cartd.config import get_config, reload_config, parse_size
+from pacifica.cartd.orm import OrmSync, CartSystem
+from pacifica.cartd.__main__ import main
+from ..cart_db_setup_test import config_env
+
+
+class TestConfig(unittest.TestCase):
+    """Test the configuration is read again only when it changes."""
+
+    def test_config_cached(self):
+        """Test the same object is returned until reload_config."""
+        config = get_config()
+        self.assertTrue(get_config() is config)
+        reload_config()
+        self.assertFalse(get_config() is config)
+
+    def test_config_env_change(self):
+        """Test environment variables are read with the configuration."""
+        config = get_config()
+        with mock.patch.dict(os.environ, {'TRANSFER_SIZE': '1 Kb'}):
+            self.assertTrue(get_config() is config)
+        with config_env({'TRANSFER_SIZE': '1 Kb'}):
+            self.assertEqual(get_config().getsize('cartd', 'transfer_size'), 1024)
+        self.assertEqual(get_config().getsize('cartd', 'transfer_size'), 4 * 1024**2)
+
+    @mock.patch('pacifica.cartd.config.monotonic')
+    def test_config_file_change(self, mock_monotonic):
+        """Test changing the config file reads it again once it is checked."""
+        mock_monotonic.return_value = 1000
+        fd, path = mkstemp(suffix='.ini')
+        with os.fdopen(fd, 'w') as config_fd:
+            config_fd.write('[cartd]\nvolume_path = /first/\n')
+        with mock.patch('pacifica.cartd.config.CONFIG_FILE', path):
+            reload_config()
+            config = get_config()
+            self.assertEqual(config.get('cartd', 'volume_path'), '/first/')
+            with open(path, 'w') as config_fd:
+                config_fd.write('[cartd]\nvolume_path = /second/\n')
+            os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 10**9))
+            mock_monotonic.return_value = 1004
+            self.assertTrue(get_config() is config)
+            mock_monotonic.return_value = 1005
+            self.assertEqual(get_config().get('cartd', 'volume_path'), '/second/')
+        os.unlink(path)
+        reload_config()
+
+    def test_config_size_parsed_once(self):
+        """Test each size is only parsed once for a configuration."""
+        with mock.patch('pacifica.cartd.config.parse_size', wraps=parse_size) as mock_parse_size:
+            reload_config()
+            for _i in range(3):
+                self.assertEqual(get_config().getsize('cartd', 'transfer_size'), 4 * 1024**2)
+        self.assertEqual(mock_parse_size.call_count, 1)
+        reload_config()
+
+    @mock.patch('cherrypy.quickstart')
+    @mock.patch('cherrypy.config.update')
+    @mock.patch.object(CartSystem, 'is_safe', return_value=True)
+    @mock.patch.object(OrmSync, 'dbconn_blocking')
+    def test_main_sighup(self, *_mocks):
+        """Test the server reads the configuration again on SIGHUP."""
+        with mock.patch.dict(cherrypy.engine.signal_handler.handlers):
+            main('--port', '8081')
+            self.assertTrue(cherrypy.engine.signal_handler.handlers['SIGHUP'] is reload_config)
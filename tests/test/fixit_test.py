@@ -0,0 +1,84 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Test fixing broken carts with the admin command."""
+import json
+import threading
+from time import sleep
+from argparse import Namespace
+import mock
+import requests
+from cherrypy.test import helper
+from pacifica.cartd.orm import Cart, File
+from pacifica.cartd.fixit import fixit, thread_session
+from ..cart_db_setup_test import TestCartdBase
+
+
+def status_response(media):
+    """Return the archive status of a ten byte file on the media."""
+    return json.dumps({
+        'file_storage_media': media,
+        'filesize': '10',
+        'mtime': '1444937154'
+    })
+
+
+def write_file(_file_name, filepath, _hashval, _hashtype):
+    """Write the pulled file."""
+    with open(filepath, 'wb') as myfile:
+        myfile.write(b'0123456789')
+
+
+class TestFixit(TestCartdBase, helper.CPWebCase):
+    """Test the fixit admin command."""
+
+    @mock.patch('pacifica.cartd.fixit.sleep')
+    @mock.patch('pacifica.cartd.fixit.ArchiveRequests')
+    def test_fixit_polls(self, mock_archive_requests, mock_sleep):
+        """Test each file has its own archive client and waits between polls."""
+        test_cart = self.create_sample_cart(bundle_path='fixit')
+        for name in ['1.txt', '2.txt']:
+            test_file = self.create_sample_file(test_cart, name, 'fixit')
+            test_file.status = 'error'
+            test_file.save()
+        archive_request = mock_archive_requests.return_value
+        archive_request.status_file.side_effect = [status_response('tape'), status_response('disk')] * 2
+        archive_request.pull_file.side_effect = write_file
+        fixit(Namespace(cartids=['1'], jobs=2))
+        self.assertEqual(mock_archive_requests.call_count, 2)
+        for call in mock_archive_requests.call_args_list:
+            self.assertTrue(isinstance(call[0][0], requests.Session))
+        self.assertEqual(archive_request.stage_file.call_count, 2)
+        self.assertEqual(mock_sleep.call_args_list, [mock.call(10), mock.call(10)])
+        statuses = [cart_file.status for cart_file in File.select().where(File.cart == test_cart.id)]
+        self.assertEqual(statuses, ['staged', 'staged'])
+        self.assertEqual(Cart.get(Cart.id == test_cart.id).status, 'ready')
+
+    @mock.patch('pacifica.cartd.fixit.ArchiveRequests')
+    def test_fixit_error(self, mock_archive_requests):
+        """Test the files not started are dropped after a file fails."""
+        test_cart = self.create_sample_cart(bundle_path='fixit')
+        for index in range(3):
+            self.create_sample_file(test_cart, '{}.txt'.format(index), 'fixit')
+        started = threading.Event()
+
+        def stage_file(_file_name):
+            """Fail the first file, the second waits for the failure to be seen."""
+            if started.is_set():
+                sleep(1)
+            started.set()
+            raise requests.exceptions.RequestException('Error')
+        archive_request = mock_archive_requests.return_value
+        archive_request.stage_file.side_effect = stage_file
+        with self.assertRaises(requests.exceptions.RequestException):
+            fixit(Namespace(cartids=['1'], jobs=1))
+        self.assertEqual(archive_request.stage_file.call_count, 2)
+
+    def test_thread_session(self):
+        """Test each thread gets its own archive session and keeps it."""
+        sessions = []
+        session = thread_session()
+        self.assertTrue(thread_session() is session)
+        thread = threading.Thread(target=lambda: sessions.append(thread_session()))
+        thread.start()
+        thread.join()
+        self.assertFalse(sessions[0] is session)
@@ -1,13 +1,12 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 """This tests some of the cart orm class."""
-import os
 import mock
 from cherrypy.test import helper
 from peewee import OperationalError
 from pacifica.cartd.__main__ import dbsync
 from pacifica.cartd.orm import Cart, File, OrmSync
-from ..cart_db_setup_test import TestCartdBase
+from ..cart_db_setup_test import TestCartdBase, config_env
 
 
 class TestOrm(TestCartdBase, helper.CPWebCase):
@@ -26,10 +25,9 @@ class TestOrm(TestCartdBase, helper.CPWebCase):
         mock_cart_dbcon.side_effect = OperationalError('Failing')
         mock_file_dbcon.side_effect = OperationalError('Failing')
         hit_exception = False
-        os.environ['DATABASE_CONNECT_ATTEMPTS'] = '3'
-        try:
-            OrmSync.dbconn_blocking()
-        except OperationalError:
-            hit_exception = True
+        with config_env({'DATABASE_CONNECT_ATTEMPTS': '3'}):
+            try:
+                OrmSync.dbconn_blocking()
+            except OperationalError:
+                hit_exception = True
         self.assertTrue(hit_exception)
-        del os.environ['DATABASE_CONNECT_ATTEMPTS']
@@ -1,12 +1,14 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 """File used to unit test the pacifica_cart."""
+import io
 import os
+import tarfile
 from tempfile import mkdtemp
 import requests
 from cherrypy.test import helper
 from pacifica.cartd.orm import Cart
-from ..cart_db_setup_test import TestCartdBase
+from ..cart_db_setup_test import TestCartdBase, config_env
 
 
 class TestRest(TestCartdBase, helper.CPWebCase):
@@ -22,6 +24,72 @@ class TestRest(TestCartdBase, helper.CPWebCase):
         req = requests.get('{}/123'.format(self.url))
         self.assertEqual(req.status_code, 200)
 
+    def test_cart_int_get_stream(self):
+        """Testing the cart interface get streams the files as a tar."""
+        sample_cart = Cart()
+        sample_cart.cart_uid = 123
+        sample_cart.bundle_path = mkdtemp('', os.environ['VOLUME_PATH'])
+        sample_cart.status = 'ready'
+        sample_cart.save(force_insert=True)
+        with open(os.path.join(sample_cart.bundle_path, 'foo.txt'), 'w') as testfd:
+            testfd.write('Writing content for first file')
+        req = requests.get('{}/123?filename=cart.tar'.format(self.url))
+        self.assertEqual(req.status_code, 200)
+        self.assertEqual(int(req.headers['Content-Length']), len(req.content))
+        with tarfile.open(fileobj=io.BytesIO(req.content)) as mytar:
+            self.assertEqual(mytar.extractfile('cart/foo.txt').read(), b'Writing content for first file')
+        size = len(req.content)
+        for byte_range, content in [('1000-', req.content[1000:]), ('10-19', req.content[10:20]),
+                                    ('-5', req.content[-5:]), ('0-{}'.format(size * 2), req.content)]:
+            req = requests.get('{}/123?filename=cart.tar'.format(self.url), headers={'Range': 'bytes=' + byte_range})
+            self.assertEqual(req.status_code, 206)
+            self.assertEqual(req.content, content)
+            self.assertEqual(req.headers['Content-Range'].split('/')[1], str(size))
+        req = requests.get('{}/123'.format(self.url), headers={'Range': 'bytes={}-'.format(size)})
+        self.assertEqual(req.status_code, 416)
+        req = requests.get('{}/123'.format(self.url), headers={'Range': 'bytes=0-1,5-6'})
+        self.assertEqual(req.status_code, 200)
+        self.assertEqual(len(req.content), size)
+
+    def test_cart_int_get_format(self):
+        """Testing the cart interface get compresses the cart."""
+        sample_cart = Cart()
+        sample_cart.cart_uid = 123
+        sample_cart.bundle_path = mkdtemp('', os.environ['VOLUME_PATH'])
+        sample_cart.status = 'ready'
+        sample_cart.save(force_insert=True)
+        with open(os.path.join(sample_cart.bundle_path, 'foo.txt'), 'w') as testfd:
+            testfd.write('Writing content for first file')
+        req = requests.get('{}/123?format=tar.gz'.format(self.url), stream=True)
+        self.assertEqual(req.status_code, 200)
+        self.assertTrue(req.headers['Content-Disposition'].endswith('.tar.gz'))
+        with tarfile.open(fileobj=io.BytesIO(req.raw.read())) as mytar:
+            name = [name for name in mytar.getnames() if name.endswith('foo.txt')][0]
+            self.assertEqual(mytar.extractfile(name).read(), b'Writing content for first file')
+        req = requests.get('{}/123?format=rar'.format(self.url))
+        self.assertEqual(req.status_code, 400)
+
+    def test_cart_int_get_offload(self):
+        """Testing bundled carts are sent by the front web server."""
+        sample_cart = Cart()
+        sample_cart.cart_uid = 123
+        sample_cart.bundle_path = os.path.join(os.environ['VOLUME_PATH'], '1', '123.tar')
+        sample_cart.status = 'ready'
+        sample_cart.save(force_insert=True)
+        os.makedirs(os.path.dirname(sample_cart.bundle_path), exist_ok=True)
+        with open(sample_cart.bundle_path, 'w') as testfd:
+            testfd.write('Writing content for first file')
+        with config_env({'BUNDLE_OFFLOAD': 'x-sendfile'}):
+            req = requests.get('{}/123?filename=cart.tar'.format(self.url))
+        self.assertEqual(req.headers['X-Sendfile'], sample_cart.bundle_path)
+        self.assertEqual(req.content, b'')
+        with config_env({'BUNDLE_OFFLOAD': 'x-accel-redirect'}):
+            req = requests.get('{}/123?filename=cart.tar'.format(self.url))
+        self.assertEqual(req.headers['X-Accel-Redirect'], '/cartd-bundles/1/123.tar')
+        self.assertEqual(req.headers['Content-Disposition'], 'attachment; filename="cart.tar"')
+        req = requests.get('{}/123?filename=cart.tar'.format(self.url))
+        self.assertEqual(req.content, b'Writing content for first file')
+
     def test_invalid_cart_uid(self):
         """Testing the cart interface get against not valid cart uid."""
         req = requests.get('{}/123'.format(self.url))
@@ -0,0 +1,59 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Unit test the streamed tar files."""
+import io
+import os
+import tarfile
+import unittest
+from tempfile import mkdtemp
+from pacifica.cartd.tar_stream import TarStream
+
+
+class TestTarStream(unittest.TestCase):
+    """Test the tar stream class."""
+
+    @staticmethod
+    def make_cart_dir():
+        """Make a directory with files, subdirectories and a long name."""
+        cart_path = mkdtemp()
+        os.makedirs(os.path.join(cart_path, 'sub', 'dir'))
+        files = {
+            'a.txt': b'Writing content for first file',
+            'empty.txt': b'',
+            os.path.join('sub', 'b.bin'): bytes(range(256)) * 5,
+            os.path.join('sub', 'dir', 'l' * 120 + 'é.txt'): b'long name'
+        }
+        for name, content in files.items():
+            with open(os.path.join(cart_path, name), 'wb') as myfile:
+                myfile.write(content)
+        os.link(os.path.join(cart_path, 'a.txt'), os.path.join(cart_path, 'sub', 'a.txt'))
+        return cart_path
+
+    def test_tar_stream(self):
+        """Test the stream is the same as the tar file module makes."""
+        cart_path = self.make_cart_dir()
+        expected = io.BytesIO()
+        mytar = tarfile.open(fileobj=expected, mode='w|')
+        mytar.add(cart_path, arcname='data')
+        mytar.close()
+        tar_stream = TarStream(cart_path, 'data', 100)
+        streamed = b''.join(tar_stream)
+        self.assertEqual(streamed, expected.getvalue())
+        self.assertEqual(tar_stream.size, len(streamed))
+
+    def test_tar_stream_range(self):
+        """Test every range of the stream is the same slice of the whole tar."""
+        tar_stream = TarStream(self.make_cart_dir(), 'data', 100)
+        streamed = b''.join(tar_stream)
+        for start in range(0, tar_stream.size, 97):
+            for stop in [start, start + 1, start + 511, start + 2000, tar_stream.size]:
+                self.assertEqual(b''.join(tar_stream.iter_range(start, stop)), streamed[start:stop])
+
+    def test_tar_stream_changed(self):
+        """Test a file shrinking after the headers were made is an error."""
+        cart_path = self.make_cart_dir()
+        tar_stream = TarStream(cart_path, 'data', 100)
+        with open(os.path.join(cart_path, 'sub', 'b.bin'), 'wb') as myfile:
+            myfile.write(b'short')
+        with self.assertRaises(OSError):
+            b''.join(tar_stream)
@@ -3,16 +3,20 @@
 """File used to unit test the pacifica_cart tasks."""
 import os
 import datetime
+import tarfile
 import json
+from time import time
 import mock
 import requests
 from cherrypy.test import helper
-from pacifica.cartd.orm import Cart, File
+from pacifica.cartd.orm import Cart, File, CartTasks
 from pacifica.cartd.tasks import stage_file_task, stage_files, status_file_task, pull_file
+from pacifica.cartd.tasks import status_cart_task, get_files_locally, stage_file_chunk_task, async_cart_task
+from pacifica.cartd.tasks import evict_task
 from pacifica.cartd.archive_requests import ArchiveRequests
 from pacifica.cartd.utils import Cartutils
 from pacifica.cartd.tasks import CART_APP
-from ..cart_db_setup_test import TestCartdBase
+from ..cart_db_setup_test import TestCartdBase, config_env
 
 CART_APP.conf.CELERY_ALWAYS_EAGER = True
 
@@ -191,6 +195,59 @@ class TestTasks(TestCartdBase, helper.CPWebCase):
         status = cart_after.status
         self.assertEqual(status, 'error')
 
+    @mock.patch.object(pull_file, 'apply_async')
+    @mock.patch.object(ArchiveRequests, 'pull_file')
+    def test_pull_file_leased(self, mock_pull, mock_apply_async):
+        """Test a pull of a file another worker is pulling waits for its copy."""
+        with config_env({'CONTENT_STORE': 'on'}):
+            cart_utils = Cartutils()
+            test_cart = self.create_sample_cart()
+            cart_files = [
+                File.create(cart=test_cart, file_name=name, bundle_path=name, status='pulling',
+                            hash_type='md5', hash_value='ac59bb32dbc32b3c0c6a1d57a3e5c1bd')
+                for name in ['1.txt', '2.txt']
+            ]
+            lease = cart_utils.acquire_pull_lease(cart_files[0])
+            filepath = cart_utils.cart_file_path(test_cart, cart_files[1])
+            pull_file(cart_files[1].id, filepath, '9999999', False)
+            mock_pull.assert_not_called()
+            mock_apply_async.assert_called_once_with(
+                (cart_files[1].id, filepath, '9999999', False, None, 1), countdown=10)
+            pulled_path = cart_utils.cart_file_path(test_cart, cart_files[0])
+            cart_utils.create_download_path(cart_files[0], test_cart, pulled_path)
+            with open(pulled_path, 'w') as testfd:
+                testfd.write('Writing content for first file')
+            cart_utils.add_to_store(cart_files[0], pulled_path)
+            cart_utils.set_file_status(cart_files[0], test_cart, 'staged', False)
+            pull_file(cart_files[1].id, filepath, '9999999', False)
+            cart_utils.release_pull_lease(lease)
+        mock_pull.assert_not_called()
+        self.assertEqual(File.get(File.id == cart_files[1].id).status, 'staged')
+        self.assertEqual(Cart.get(Cart.id == test_cart.id).status, 'ready')
+
+    @mock.patch.object(pull_file, 'apply_async')
+    @mock.patch.object(ArchiveRequests, 'pull_file')
+    def test_pull_file_lease_waits(self, mock_pull, mock_apply_async):
+        """Test a pull waiting on a lease longer than the lease time pulls anyway."""
+        cart_utils = Cartutils()
+        test_cart = self.create_sample_cart()
+        test_file = self.create_sample_file(test_cart)
+        test_file.status = 'pulling'
+        test_file.save()
+        lease = cart_utils.acquire_pull_lease(test_file)
+        filepath = cart_utils.cart_file_path(test_cart, test_file)
+        cart_utils.create_download_path(test_file, test_cart, filepath)
+        with config_env({'PULL_LEASE_TIME': '20'}):
+            pull_file(test_file.id, filepath, '9999999', False, None, 2)
+            mock_apply_async.assert_called_once_with(
+                (test_file.id, filepath, '9999999', False, None, 3), countdown=10)
+            mock_pull.assert_not_called()
+            mock_pull.side_effect = lambda *_args, **_kwargs: open(filepath, 'w').close()
+            pull_file(test_file.id, filepath, '9999999', False, None, 3)
+        mock_pull.assert_called_once()
+        self.assertTrue(os.path.isfile(lease))
+        cart_utils.release_pull_lease(lease)
+
     @mock.patch.object(ArchiveRequests, 'pull_file')
     def test_bad_deleted_cart(self, mock_pull):
         """Test a error return from a file not ready to pull."""
@@ -200,3 +257,249 @@ class TestTasks(TestCartdBase, helper.CPWebCase):
         test_cart.save()
         pull_file(test_file.id, os.path.join(os.getenv('VOLUME_PATH'), '1', '1.txt'), '9999999', False)
         mock_pull.assert_not_called()
+
+    @mock.patch('pacifica.cartd.tasks.time')
+    @mock.patch.object(status_cart_task, 'apply_async')
+    @mock.patch.object(ArchiveRequests, 'status_file')
+    def test_status_cart_backoff(self, mock_status_file, mock_apply_async, mock_time):
+        """Test the cart poller only checks files that are due, each with its own backoff."""
+        test_cart = self.create_sample_cart()
+        first, second, third = [self.create_sample_file(test_cart, name) for name in ['1.txt', '2.txt', '3.txt']]
+        File.update(status='staging').where(File.id << [first.id, second.id]).execute()
+        File.update(status='waiting').where(File.id == third.id).execute()
+        mock_status_file.return_value = json.dumps({
+            'bytes_per_level': '(0L, 10L)',
+            'ctime': '1444629567',
+            'file': '1.txt',
+            'file_storage_media': 'tape',
+            'filesize': '10',
+            'message': 'File was found',
+            'mtime': '1444937154'
+        })
+        mock_apply_async.return_value = 'fake-task-id'
+        mock_time.return_value = 1000
+        status_cart_task(test_cart.id)
+        args, kwargs = mock_apply_async.call_args
+        self.assertEqual(args[0], (test_cart.id, {str(first.id): (1, 1010), str(second.id): (1, 1010)}, 1000))
+        self.assertEqual(kwargs['countdown'], 10)
+        self.assertEqual(mock_status_file.call_count, 2)
+        # nothing is due yet
+        mock_time.return_value = 1005
+        status_cart_task(*args[0])
+        args, kwargs = mock_apply_async.call_args
+        self.assertEqual(mock_status_file.call_count, 2)
+        self.assertEqual(kwargs['countdown'], 5)
+        # the third file is staged now and is checked right away
+        File.update(status='staging').where(File.id == third.id).execute()
+        mock_time.return_value = 1010
+        status_cart_task(*args[0])
+        args, kwargs = mock_apply_async.call_args
+        self.assertEqual(mock_status_file.call_count, 5)
+        self.assertEqual(args[0][1], {
+            str(first.id): (2, 1030), str(second.id): (2, 1030), str(third.id): (1, 1020)
+        })
+        self.assertEqual(kwargs['countdown'], 10)
+        self.assertEqual(File.get(File.id == first.id).status, 'staging')
+
+    @mock.patch.object(status_cart_task, 'apply_async')
+    @mock.patch.object(ArchiveRequests, 'status_file')
+    def test_status_cart_timeout(self, mock_status_file, mock_apply_async):
+        """Test the cart poller gives up on files after status_poll_timeout."""
+        test_cart = self.create_sample_cart()
+        test_file = self.create_sample_file(test_cart)
+        test_file.status = 'waiting'
+        test_file.save()
+        status_cart_task(test_cart.id, {}, time() - 604801)
+        mock_status_file.assert_not_called()
+        mock_apply_async.assert_not_called()
+        self.assertEqual(File.get(File.id == test_file.id).status, 'error')
+        self.assertEqual(Cart.get(Cart.id == test_cart.id).status, 'error')
+
+    @mock.patch('pacifica.cartd.tasks.utime')
+    @mock.patch.object(ArchiveRequests, 'pull_file')
+    @mock.patch.object(ArchiveRequests, 'status_file')
+    def test_status_cart_ready(self, mock_status_file, mock_pull_file, mock_utime):
+        """Test the cart poller pulls the ready files and stops polling."""
+        test_cart = self.create_sample_cart()
+        test_file = self.create_sample_file(test_cart)
+        test_file.status = 'staging'
+        test_file.save()
+        mock_status_file.return_value = json.dumps({
+            'bytes_per_level': '(10L, 0L)',
+            'ctime': '1444629567',
+            'file': '1.txt',
+            'file_storage_media': 'disk',
+            'filesize': '10',
+            'message': 'File was found',
+            'mtime': '1444937154'
+        })
+        mock_pull_file.return_value = True
+        mock_utime.return_value = True
+        status_cart_task(test_cart.id)
+        self.assertEqual(File.get(File.id == test_file.id).status, 'staged')
+
+    @mock.patch.object(ArchiveRequests, 'status_file')
+    def test_status_cart_error(self, mock_status_file):
+        """Test the cart poller marks the cart error on a failed status."""
+        test_cart = self.create_sample_cart()
+        test_file = self.create_sample_file(test_cart)
+        test_file.status = 'staging'
+        test_file.save()
+        mock_status_file.side_effect = requests.exceptions.RequestException(
+            mock.Mock(status=500),
+            'Error'
+        )
+        status_cart_task(test_cart.id)
+        self.assertEqual(File.get(File.id == test_file.id).status, 'error')
+        self.assertEqual(Cart.get(Cart.id == test_cart.id).status, 'error')
+
+    def test_status_cart_poll_deleted(self):
+        """Test the cart poller stops on deleted or missing carts."""
+        test_cart = Cart.create(
+            cart_uid='1',
+            status='staging',
+            deleted_date='2017-05-03 00:00:00'
+        )
+        status_cart_task(test_cart.id)
+        status_cart_task(9999999)
+        self.assertEqual(True, True)
+
+    @mock.patch.object(status_cart_task, 'apply_async')
+    @mock.patch.object(stage_file_chunk_task, 'delay')
+    def test_get_files_chunked(self, mock_chunk_delay, mock_apply_async):
+        """Test the files of a cart are staged in chunks."""
+        test_cart = self.create_sample_cart()
+        file_ids = [self.create_sample_file(test_cart, '{}.txt'.format(index)).id for index in range(5)]
+        mock_chunk_delay.side_effect = ['chunk-{}'.format(index) for index in range(3)]
+        mock_apply_async.return_value = 'status-cart'
+        with config_env({'STAGE_CHUNK_SIZE': '2'}):
+            get_files_locally(test_cart.id)
+        self.assertEqual(
+            [call_args[0][0] for call_args in mock_chunk_delay.call_args_list],
+            [file_ids[0:2], file_ids[2:4], file_ids[4:5]]
+        )
+        task_ids = [
+            cart_task.celery_task_id
+            for cart_task in CartTasks.select().where(CartTasks.cart_id == test_cart.id)
+        ]
+        self.assertEqual(sorted(task_ids), ['chunk-0', 'chunk-1', 'chunk-2', 'status-cart'])
+
+    @mock.patch.object(ArchiveRequests, 'stage_file')
+    def test_stage_file_chunk(self, mock_stage_file):
+        """Test staging a chunk of files with one failure."""
+        test_cart = self.create_sample_cart()
+        good_file = self.create_sample_file(test_cart, '1.txt')
+        bad_file = self.create_sample_file(test_cart, '2.txt')
+
+        def fake_stage_file(file_name):
+            """Fail to stage the second file."""
+            if file_name == '2.txt':
+                raise requests.exceptions.RequestException(mock.Mock(status=500), 'Error')
+        mock_stage_file.side_effect = fake_stage_file
+        stage_file_chunk_task([good_file.id, bad_file.id])
+        self.assertEqual(File.get(File.id == good_file.id).status, 'staging')
+        self.assertEqual(File.get(File.id == bad_file.id).status, 'error')
+        self.assertEqual(Cart.get(Cart.id == test_cart.id).status, 'error')
+
+    @mock.patch.object(Cartutils, 'set_file_status')
+    @mock.patch.object(ArchiveRequests, 'stage_file')
+    def test_stage_file_chunk_batched(self, mock_stage_file, mock_set_file_status):
+        """Test a chunk of files is set staging without a save per file."""
+        test_cart = self.create_sample_cart()
+        file_ids = [self.create_sample_file(test_cart, '{}.txt'.format(index)).id for index in range(3)]
+        updated_date = Cart.get(Cart.id == test_cart.id).updated_date
+        stage_file_chunk_task(file_ids)
+        mock_set_file_status.assert_not_called()
+        self.assertEqual(mock_stage_file.call_count, 3)
+        self.assertEqual(
+            [cart_file.status for cart_file in File.select().where(File.id << file_ids)],
+            ['staging'] * 3
+        )
+        self.assertTrue(Cart.get(Cart.id == test_cart.id).updated_date > updated_date)
+
+    @mock.patch.object(ArchiveRequests, 'stage_file')
+    def test_stage_file_chunk_deleted(self, mock_stage_file):
+        """Test staging a chunk of files in a deleted cart."""
+        test_cart = Cart.create(
+            cart_uid='1',
+            status='staging',
+            deleted_date='2017-05-03 00:00:00'
+        )
+        test_file = self.create_sample_file(test_cart)
+        stage_file_chunk_task([test_file.id])
+        mock_stage_file.assert_not_called()
+
+    @mock.patch.object(ArchiveRequests, 'pull_file')
+    @mock.patch.object(ArchiveRequests, 'status_file')
+    def test_pull_direct_to_tar(self, mock_status_file, mock_pull_file):
+        """Test files of bundled carts are pulled into slots of the tar."""
+        with config_env({'BUNDLE_DIRECT': 'on'}):
+            test_cart = Cart.create(cart_uid='1', status='staging', bundle=True)
+            contents = {'1.txt': b'first file', 'sub/2.txt': b'the second file'}
+            for name, content in contents.items():
+                File.create(cart=test_cart, file_name=name, bundle_path=name, status='staging',
+                            hash_type='md5', hash_value='5b')
+
+            def status_file(file_name):
+                """Return the status with the size of the file."""
+                return json.dumps({
+                    'file_storage_media': 'disk', 'filesize': str(len(contents[file_name])), 'mtime': '1444937154'
+                })
+
+            def pull_file(file_name, tar_path, _hashval, _hashtype, tar_slot=None, progress=None):
+                """Write the file into its slot."""
+                with open(tar_path, 'r+b') as myfile:
+                    myfile.seek(tar_slot[0])
+                    myfile.write(contents[file_name])
+            mock_status_file.side_effect = status_file
+            mock_pull_file.side_effect = pull_file
+            status_cart_task(test_cart.id)
+        test_cart = Cart.get(Cart.id == test_cart.id)
+        self.assertEqual(test_cart.status, 'ready')
+        self.assertFalse(os.path.exists(Cartutils().cart_bundle_path(test_cart)))
+        with tarfile.open(test_cart.bundle_path) as mytar:
+            for name, content in contents.items():
+                member = mytar.getmember('1/' + name)
+                self.assertEqual(member.mtime, 1444937154)
+                self.assertEqual(mytar.extractfile(member).read(), content)
+
+    @mock.patch.object(ArchiveRequests, 'stage_file')
+    def test_stage_file_from_store(self, mock_stage_file):
+        """Test files already in the store are linked instead of staged."""
+        with config_env({'CONTENT_STORE': 'on'}):
+            cart_utils = Cartutils()
+            test_cart = self.create_sample_cart()
+            cart_files = [
+                File.create(cart=test_cart, file_name=name, bundle_path=name,
+                            hash_type='md5', hash_value='ac59bb32dbc32b3c0c6a1d57a3e5c1bd')
+                for name in ['1.txt', '2.txt', '3.txt']
+            ]
+            filepath = cart_utils.cart_file_path(test_cart, cart_files[0])
+            cart_utils.create_download_path(cart_files[0], test_cart, filepath)
+            with open(filepath, 'w') as testfd:
+                testfd.write('Writing content for first file')
+            cart_utils.add_to_store(cart_files[0], filepath)
+            cart_utils.set_file_status(cart_files[0], test_cart, 'staged', False)
+            stage_file_task(cart_files[1].id)
+            stage_file_chunk_task([cart_files[2].id])
+        mock_stage_file.assert_not_called()
+        self.assertEqual(Cart.get(Cart.id == test_cart.id).status, 'ready')
+
+    @mock.patch.object(async_cart_task, 'delay')
+    def test_get_files_async(self, mock_delay):
+        """Test the files of a cart are handed to one async task."""
+        test_cart = self.create_sample_cart()
+        self.create_sample_file(test_cart)
+        mock_delay.return_value = 'async-cart'
+        with config_env({'ASYNC_MODE': 'on'}):
+            get_files_locally(test_cart.id)
+        mock_delay.assert_called_once_with(test_cart.id)
+        cart_task = CartTasks.get(CartTasks.cart_id == test_cart.id)
+        self.assertEqual(cart_task.celery_task_id, 'async-cart')
+
+    @mock.patch.object(Cartutils, 'evict_carts')
+    def test_evict_task(self, mock_evict_carts):
+        """Test the eviction task evicts carts for the space asked for."""
+        evict_task(100)
+        mock_evict_carts.assert_called_once_with(100)
+        self.assertEqual(CART_APP.conf.beat_schedule['evict-carts']['task'], evict_task.name)
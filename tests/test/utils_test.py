@@ -5,14 +5,20 @@ import os
 import json
 from types import MethodType
 import tempfile
+import tarfile
 import shutil
+from unittest import skipIf
+try:
+    import fcntl
+except ImportError:  # pragma: no cover windows has no fcntl
+    fcntl = None
 import mock
 import psutil
 from cherrypy.test import helper
-from pacifica.cartd.orm import Cart
+from pacifica.cartd.orm import Cart, File, SpaceReservation
 from pacifica.cartd.utils import Cartutils
 import pacifica.cartd.orm
-from ..cart_db_setup_test import TestCartdBase
+from ..cart_db_setup_test import TestCartdBase, config_env
 
 # pylint: disable=too-many-public-methods
 
@@ -157,23 +163,61 @@ class TestUtils(TestCartdBase, helper.CPWebCase):
         """Test that the error when a bad path."""
         test_cart = self.create_sample_cart()
         test_file = self.create_sample_file(test_cart)
-        os.environ['LRU_PURGE'] = 'off'
-        cart_utils = Cartutils()
-        rtn = cart_utils.check_space_requirements(
-            test_file,
-            test_cart,
-            10,
-            False
-        )
+        with config_env({'LRU_PURGE': 'off'}):
+            cart_utils = Cartutils()
+            rtn = cart_utils.check_space_requirements(
+                test_file,
+                test_cart,
+                10,
+                False
+            )
         self.assertEqual(rtn, True)
-        del os.environ['LRU_PURGE']
 
-    def test_get_path_size(self):
-        """Test to see if the path size of a directory is returned."""
+    @mock.patch.object(psutil, 'disk_usage')
+    def test_space_reservation(self, mock_disk_usage):
+        """Test files reserve space until they are staged or fail."""
+        mock_disk_usage.return_value = mock.Mock(free=100)
+        test_cart = self.create_sample_cart()
+        first_file = self.create_sample_file(test_cart, '1.txt')
+        second_file = self.create_sample_file(test_cart, '2.txt')
+        cart_utils = Cartutils()
+        self.assertTrue(cart_utils.check_space_requirements(first_file, test_cart, 60, False))
+        # checking again replaces the reservation of the file
+        self.assertTrue(cart_utils.check_space_requirements(first_file, test_cart, 60, False))
+        self.assertFalse(cart_utils.check_space_requirements(second_file, test_cart, 60, False))
+        self.assertEqual(second_file.status, 'error')
+        self.assertEqual([res.size for res in SpaceReservation.select()], [60])
+        cart_utils.set_file_status(first_file, test_cart, 'staged', False)
+        self.assertEqual(SpaceReservation.select().count(), 0)
+        self.assertTrue(cart_utils.check_space_requirements(second_file, test_cart, 60, False))
+        # reservations left by a crashed worker are stale
+        SpaceReservation.update(reserved_date='2017-05-03 00:00:00').execute()
+        self.assertTrue(cart_utils.check_space_requirements(first_file, test_cart, 60, False))
+        cart_utils.delete_cart_bundle(test_cart)
+        self.assertEqual(SpaceReservation.select().count(), 0)
+
+    @mock.patch.object(psutil, 'disk_usage')
+    def test_space_reservation_partial(self, mock_disk_usage):
+        """Test a partial pull reserves the bytes it has left and keeps the reservation up to date."""
+        mock_disk_usage.return_value = mock.Mock(free=30, total=1000)
+        test_cart = self.create_sample_cart()
+        test_file = self.create_sample_file(test_cart, '1.txt')
         cart_utils = Cartutils()
-        path = os.path.dirname(os.path.realpath(__file__))
-        rtn = cart_utils.get_path_size(path + '/../')
-        self.assertNotEqual(rtn, 0)
+        filepath = cart_utils.cart_file_path(test_cart, test_file)
+        cart_utils.create_download_path(test_file, test_cart, filepath)
+        with open(filepath, 'wb') as myfile:
+            myfile.write(bytes(40))
+        self.assertTrue(cart_utils.check_space_requirements(test_file, test_cart, 60, False))
+        self.assertEqual([res.size for res in SpaceReservation.select()], [20])
+        cart_utils.set_file_size(test_file, test_cart, 60)
+        with open(filepath, 'ab') as myfile:
+            myfile.write(bytes(15))
+        SpaceReservation.update(reserved_date='2017-05-03 00:00:00').execute()
+        with config_env({'PULL_LEASE_TIME': '0'}):
+            keep = Cartutils().pull_lease_keeper(None, test_file, test_cart, filepath)
+            keep()
+            self.assertEqual(cart_utils.reserved_space(), 5)
+        cart_utils.delete_cart_bundle(test_cart)
 
     def test_check_file_not_ready_pull(self):
         """Test that checks to see if a file is not ready to pull by checking the archive response."""
@@ -304,25 +348,102 @@ class TestUtils(TestCartdBase, helper.CPWebCase):
         file_ids = data['fileids']
         retval = cart_utils.update_cart_files(test_cart, file_ids)
         self.assertNotEqual(retval, None)
+        self.assertEqual(File.select().where(File.cart == test_cart.id).count(), 0)
 
-    def test_lru_cart_delete(self):
-        """Test that trys to delete a cart."""
+    def test_update_cart_files_chunked(self):
+        """Test adding more files to a cart than fit in one insert."""
         test_cart = self.create_sample_cart()
-        test_cart2 = Cart.create(
-            cart_uid='2',
-            status='staging',
-            bundle_path=os.path.join(os.getenv('VOLUME_PATH'), '2/'),
-            updated_date=1
-        )
         cart_utils = Cartutils()
-        os.makedirs(test_cart2.bundle_path, 0o777)
-        retval = cart_utils.lru_cart_delete(test_cart)
-        self.assertEqual(retval, True)
-        test_c2 = Cart.get(Cart.id == test_cart2.id)
-        self.assertEqual(test_c2.status, 'deleted')
-        # also hit error block when nothing to delete
-        retval = cart_utils.lru_cart_delete(test_cart)
-        self.assertEqual(retval, False)
+        file_ids = [
+            {'id': str(index), 'path': '/1/2/{}.txt'.format(index), 'hashtype': 'md5', 'hashsum': 'abcd'}
+            for index in range(cart_utils.insert_chunk_size * 2 + 1)
+        ]
+        retval = cart_utils.update_cart_files(test_cart, file_ids)
+        self.assertEqual(retval, None)
+        cart_files = File.select().where(File.cart == test_cart.id)
+        self.assertEqual(cart_files.count(), len(file_ids))
+        self.assertEqual(cart_files.order_by(File.id).first().bundle_path, '1/2/0.txt')
+
+    @mock.patch.object(psutil, 'disk_usage')
+    def test_evict_carts(self, mock_disk_usage):
+        """Test the least recently accessed carts are evicted down to the low watermark."""
+        carts = [
+            Cart.create(cart_uid=str(index), status='ready', staged_size=100000,
+                        accessed_date='2017-01-0{}'.format(index + 1))
+            for index in range(4)
+        ]
+        # carts still being worked on are not evicted
+        Cart.update(status='staging').where(Cart.id == carts[0].id).execute()
+        cart_utils = Cartutils()
+
+        def disk_usage(_path):
+            """Use the staged size of the carts as the volume."""
+            used = sum(cart.staged_size for cart in Cart.select().where(Cart.deleted_date.is_null(True)))
+            return mock.Mock(total=10**6, free=10**6 - used)
+        mock_disk_usage.side_effect = disk_usage
+        with config_env({'EVICT_BATCH_SIZE': '1', 'EVICT_LOW_WATERMARK': '25'}):
+            self.assertEqual(cart_utils.evict_carts(), 0)
+            with config_env({'EVICT_HIGH_WATERMARK': '35'}):
+                # another eviction is running
+                with cart_utils._lock_eviction():  # pylint: disable=protected-access
+                    self.assertEqual(cart_utils.evict_carts(), 0)
+                self.assertEqual(cart_utils.evict_carts(), 2)
+        statuses = [Cart.get(Cart.id == cart.id).status for cart in carts]
+        self.assertEqual(statuses, ['staging', 'deleted', 'deleted', 'ready'])
+
+    def test_cart_sizes(self):
+        """Test the file sizes add up to the cart sizes as files are checked and staged."""
+        test_cart = self.create_sample_cart()
+        first_file = self.create_sample_file(test_cart, '1.txt')
+        second_file = self.create_sample_file(test_cart, '2.txt')
+        cart_utils = Cartutils()
+        self.assertTrue(cart_utils.check_status_details(test_cart, first_file, 10, 1))
+        # a second check of the same file counts once
+        cart_utils.check_status_details(test_cart, File.get(File.id == first_file.id), 10, 1)
+        cart_utils.check_status_details(test_cart, second_file, 20, 1)
+        test_cart.reload()
+        self.assertEqual((test_cart.size, test_cart.staged_size), (30, 0))
+        cart_utils.set_file_status(first_file, test_cart, 'staged', False)
+        cart_utils.set_file_status(first_file, test_cart, 'staged', False)
+        # saving the cart doesn't write back the sizes it read
+        test_cart.save()
+        test_cart.reload()
+        self.assertEqual((test_cart.size, test_cart.staged_size), (30, 10))
+        self.assertEqual(File.get(File.id == second_file.id).size, 20)
+
+    @mock.patch.object(psutil, 'disk_usage')
+    def test_check_space_evicting(self, mock_disk_usage):
+        """Test files that don't fit wait for carts to be evicted."""
+        mock_disk_usage.return_value = mock.Mock(total=1000, free=100)
+        test_cart = self.create_sample_cart()
+        test_file = self.create_sample_file(test_cart)
+        evict_func = mock.Mock()
+        cart_utils = Cartutils(evict_func)
+        self.assertEqual(cart_utils.check_status_details(test_cart, test_file, 200, 1), -1)
+        test_file.status = 'staging'
+        Cart.create(cart_uid='2', status='ready', accessed_date='2017-01-01')
+        self.assertEqual(cart_utils.check_status_details(test_cart, test_file, 200, 1), False)
+        self.assertEqual(test_file.status, 'staging')
+        evict_func.assert_called_once_with(200)
+        # the eviction is queued already
+        self.assertEqual(cart_utils.check_space_requirements(test_file, test_cart, 300, True), None)
+        evict_func.assert_called_once_with(200)
+        marker = os.path.join(os.getenv('VOLUME_PATH'), 'evict.queued')
+        os.utime(marker, (0, 0))
+        self.assertEqual(cart_utils.check_space_requirements(test_file, test_cart, 300, True), None)
+        evict_func.assert_called_with(300)
+        with mock.patch.object(cart_utils, 'evict_space_needed', return_value=0):
+            self.assertEqual(cart_utils.evict_carts(), 0)
+        self.assertFalse(os.path.exists(marker))
+        # never fits however many carts are evicted
+        self.assertEqual(cart_utils.check_space_requirements(test_file, test_cart, 2000, True), False)
+
+    def test_available_cart_accessed(self):
+        """Test asking for a ready cart updates its access time."""
+        test_cart = self.create_sample_cart(status='ready')
+        Cart.update(accessed_date='2017-01-01').where(Cart.id == test_cart.id).execute()
+        Cartutils.available_cart(test_cart.cart_uid)
+        self.assertTrue(Cart.get(Cart.id == test_cart.id).accessed_date.year > 2017)
 
     def test_bad_cart_status(self):
         """Test getting a status of a cart that doesnt exist."""
@@ -371,3 +492,273 @@ class TestUtils(TestCartdBase, helper.CPWebCase):
 
         self.assertEqual(len(data), 2)
         self.assertEqual(data[0].id, 3)
+
+    @mock.patch.object(Cartutils, 'tar_files')
+    @mock.patch.object(Cartutils, 'create_symlink')
+    def test_prepare_bundle_once(self, mock_symlink, mock_tar_files):
+        """Test the cart is only bundled once all files are staged."""
+        test_cart = self.create_sample_cart()
+        first_file = self.create_sample_file(test_cart, '1.txt')
+        second_file = self.create_sample_file(test_cart, '2.txt')
+        cart_utils = Cartutils()
+        cart_utils.set_file_status(first_file, test_cart, 'staged', False)
+        cart_utils.prepare_bundle(test_cart.id)
+        mock_tar_files.assert_not_called()
+        cart_utils.set_file_status(second_file, test_cart, 'staged', False)
+        cart_utils.prepare_bundle(test_cart.id)
+        cart_utils.prepare_bundle(test_cart.id)
+        mock_symlink.assert_called_once_with(test_cart.id)
+        mock_tar_files.assert_called_once_with(test_cart.id)
+        self.assertEqual(cart_utils.cart_status(test_cart.cart_uid), ['staging', ''])
+
+    def test_prepare_bundle_error(self):
+        """Test the cart gets the error of a failed file."""
+        test_cart = self.create_sample_cart()
+        self.create_sample_file(test_cart, '1.txt')
+        test_file = self.create_sample_file(test_cart, '2.txt')
+        cart_utils = Cartutils()
+        cart_utils.set_file_status(test_file, test_cart, 'error', 'fake error')
+        cart_utils.prepare_bundle(test_cart.id)
+        test_cart.reload()
+        self.assertEqual(test_cart.status, 'error')
+        self.assertEqual(test_cart.error, 'Failed to pull file(fake error)')
+
+    def test_content_store(self):
+        """Test files in the store are shared by carts until no cart has them."""
+        with config_env({'CONTENT_STORE': 'on'}):
+            cart_utils = Cartutils()
+            carts = [self.create_sample_cart(str(uid)) for uid in [1, 2]]
+            cart_files = [
+                File.create(cart=cart, file_name='1', bundle_path='data/1.txt', size=30,
+                            hash_type='md5', hash_value='ac59bb32dbc32b3c0c6a1d57a3e5c1bd')
+                for cart in carts
+            ]
+            self.assertFalse(cart_utils.link_from_store(cart_files[0], carts[0]))
+            filepath = cart_utils.cart_file_path(carts[0], cart_files[0])
+            cart_utils.create_download_path(cart_files[0], carts[0], filepath)
+            with open(filepath, 'w') as testfd:
+                testfd.write('Writing content for first file')
+            cart_utils.add_to_store(cart_files[0], filepath)
+            cart_utils.add_to_store(cart_files[0], filepath)
+            cart_utils.set_file_status(cart_files[0], carts[0], 'staged', False)
+            self.assertEqual(cart_utils.cart_disk_size(Cart.get(Cart.id == carts[0].id)), 30)
+            self.assertTrue(cart_utils.link_from_store(cart_files[1], carts[1]))
+            self.assertEqual(File.get(File.id == cart_files[1].id).status, 'staged')
+            blob = cart_utils.store_path('md5', 'ac59bb32dbc32b3c0c6a1d57a3e5c1bd')
+            self.assertTrue(os.path.samefile(blob, cart_utils.cart_file_path(carts[1], cart_files[1])))
+            # deleting either cart frees nothing while the other has the file
+            self.assertEqual([cart_utils.cart_disk_size(Cart.get(Cart.id == cart.id)) for cart in carts], [0, 0])
+            cart_utils.delete_cart_bundle(carts[0])
+            self.assertTrue(os.path.isfile(blob))
+            self.assertEqual(cart_utils.cart_disk_size(Cart.get(Cart.id == carts[1].id)), 30)
+            cart_utils.delete_cart_bundle(carts[1])
+            self.assertFalse(os.path.isfile(blob))
+            self.assertEqual(cart_utils.store_path('md5', '../../etc'), None)
+            self.assertEqual(cart_utils.store_path('nohash', 'ac59'), None)
+        self.assertEqual(Cartutils().store_path('md5', 'ac59'), None)
+
+    @mock.patch.object(psutil, 'disk_usage')
+    def test_content_store_bundle(self, mock_disk_usage):
+        """Test bundled carts reserve and count the copy in the store along with the tar."""
+        mock_disk_usage.return_value = mock.Mock(free=100, total=1000)
+        with config_env({'CONTENT_STORE': 'on'}):
+            cart_utils = Cartutils()
+            carts = [self.create_sample_cart(uid) for uid in ['bundled', 'linked']]
+            carts[0].bundle = True
+            carts[0].save()
+            cart_files = [
+                File.create(cart=cart, file_name='1', bundle_path='data/1.txt',
+                            hash_type='md5', hash_value='ac59bb32dbc32b3c0c6a1d57a3e5c1bd')
+                for cart in carts
+            ]
+            self.assertTrue(cart_utils.check_space_requirements(cart_files[0], carts[0], 40, False))
+            self.assertEqual([res.size for res in SpaceReservation.select()], [80])
+            self.assertFalse(cart_utils.check_space_requirements(cart_files[0], carts[0], 60, False))
+            cart_files[0].status = 'staging'
+            filepath = cart_utils.cart_file_path(carts[0], cart_files[0])
+            cart_utils.create_download_path(cart_files[0], carts[0], filepath)
+            with open(filepath, 'w') as testfd:
+                testfd.write('Writing content for first file')
+            cart_utils.set_file_size(cart_files[0], carts[0], 30)
+            cart_utils.add_to_store(cart_files[0], filepath)
+            cart_utils.bundle_file(carts[0], filepath)
+            cart_utils.set_file_status(cart_files[0], carts[0], 'staged', False)
+            self.assertEqual(cart_utils.cart_disk_size(Cart.get(Cart.id == carts[0].id)), 60)
+            # the store copy stays while a cart links it
+            self.assertTrue(cart_utils.link_from_store(cart_files[1], carts[1]))
+            self.assertEqual(cart_utils.cart_disk_size(Cart.get(Cart.id == carts[0].id)), 30)
+            for cart in carts:
+                cart_utils.delete_cart_bundle(cart)
+
+    def test_cart_disk_size_unsized(self):
+        """Test carts staged before sizes were kept are measured on disk."""
+        test_cart = self.create_sample_cart('unsized')
+        test_file = self.create_sample_file(test_cart, '1.txt')
+        cart_utils = Cartutils()
+        filepath = cart_utils.cart_file_path(test_cart, test_file)
+        cart_utils.create_download_path(test_file, test_cart, filepath)
+        with open(filepath, 'wb') as myfile:
+            myfile.write(bytes(30))
+        File.update(status='staged').execute()
+        self.assertEqual(cart_utils.cart_disk_size(test_cart), 30)
+        with open('{}.tar'.format(cart_utils.cart_bundle_path(test_cart)), 'wb') as myfile:
+            myfile.write(bytes(20))
+        self.assertEqual(cart_utils.cart_disk_size(test_cart), 50)
+        test_cart.staged_size = 10
+        self.assertEqual(cart_utils.cart_disk_size(test_cart), 10)
+        cart_utils.delete_cart_bundle(test_cart)
+
+    def test_pull_lease(self):
+        """Test only one pull of a file holds the lease until it is stale."""
+        test_cart = self.create_sample_cart()
+        test_file = File.create(cart=test_cart, file_name='1', bundle_path='1.txt',
+                                hash_type='md5', hash_value='ac59bb32dbc32b3c0c6a1d57a3e5c1bd')
+        # without the store the lease is only for the cart file
+        lease = Cartutils().acquire_pull_lease(test_file)
+        self.assertTrue(lease.endswith(os.path.join('leases', '{}.pull'.format(test_file.id))))
+        self.assertFalse(Cartutils().acquire_pull_lease(test_file))
+        Cartutils.release_pull_lease(lease)
+        with config_env({'CONTENT_STORE': 'on'}):
+            cart_utils = Cartutils()
+            lease = cart_utils.acquire_pull_lease(test_file)
+            self.assertTrue(os.path.isfile(lease))
+            self.assertFalse(cart_utils.acquire_pull_lease(test_file))
+            os.utime(lease, (0, 0))
+            self.assertEqual(cart_utils.acquire_pull_lease(test_file), lease)
+            cart_utils.release_pull_lease(lease)
+            cart_utils.release_pull_lease(lease)
+            self.assertFalse(os.path.isfile(lease))
+
+    def test_pull_lease_takeover(self):
+        """Test a stale lease is taken over by one worker and kept fresh."""
+        test_cart = self.create_sample_cart()
+        test_file = self.create_sample_file(test_cart)
+        cart_utils = Cartutils()
+        lease = cart_utils.acquire_pull_lease(test_file)
+        os.utime(lease, (0, 0))
+        stale = os.stat(lease)
+        # another worker saw the same stale lease and is taking it over
+        marker = '{}.{}-{}'.format(lease, stale.st_ino, stale.st_mtime_ns)
+        with open(marker, 'w'):
+            pass
+        self.assertFalse(cart_utils.acquire_pull_lease(test_file))
+        os.unlink(marker)
+        self.assertEqual(cart_utils.acquire_pull_lease(test_file), lease)
+        self.assertFalse(os.path.exists(marker))
+        # a worker that saw the old lease doesn't remove the new one
+        with mock.patch('os.stat', side_effect=[stale, os.stat(lease)]):
+            self.assertFalse(cart_utils._remove_stale_lease(lease))  # pylint: disable=protected-access
+        self.assertTrue(os.path.isfile(lease))
+        os.utime(lease, (0, 0))
+        with config_env({'PULL_LEASE_TIME': '0'}):
+            keep = Cartutils().pull_lease_keeper(lease)
+        keep()
+        self.assertTrue(os.path.getmtime(lease) > 0)
+        self.assertEqual(cart_utils.pull_lease_keeper(None), None)
+        cart_utils.release_pull_lease(lease)
+
+    def test_bundle_incremental(self):
+        """Test files are moved into the tar as they are staged."""
+        cart_utils = Cartutils()
+        test_cart = Cart.create(cart_uid='1', status='staging', bundle=True)
+        contents = {'b/2.txt': b'second file', 'a/1.txt': b'first file', 'c.txt': b'third file'}
+        cart_files = {}
+        for name, content in contents.items():
+            cart_files[name] = File.create(cart=test_cart, file_name=name, bundle_path=name)
+            filepath = cart_utils.cart_file_path(test_cart, cart_files[name])
+            cart_utils.create_download_path(cart_files[name], test_cart, filepath)
+            with open(filepath, 'wb') as testfd:
+                testfd.write(content)
+        first_path = cart_utils.cart_file_path(test_cart, cart_files['b/2.txt'])
+        cart_utils.bundle_file(test_cart, first_path)
+        self.assertFalse(os.path.exists(first_path))
+        bundle_tar = '{}.tar'.format(cart_utils.cart_bundle_path(test_cart))
+        size = os.path.getsize(bundle_tar)
+        with mock.patch('tarfile.copyfileobj') as mock_copy:
+            mock_copy.side_effect = OSError('No space left on device')
+            with self.assertRaises(OSError):
+                cart_utils.bundle_file(test_cart, cart_utils.cart_file_path(test_cart, cart_files['c.txt']))
+        self.assertEqual(os.path.getsize(bundle_tar), size)
+        cart_utils.tar_files(test_cart.id)
+        test_cart.reload()
+        self.assertEqual(test_cart.status, 'ready')
+        self.assertEqual(test_cart.bundle_path, bundle_tar)
+        self.assertFalse(os.path.exists(cart_utils.cart_bundle_path(test_cart)))
+        self.assertEqual(os.path.getsize(bundle_tar) % 10240, 0)
+        with tarfile.open(bundle_tar) as mytar:
+            self.assertEqual(mytar.getnames(), ['1/b/2.txt', '1/c.txt', '1/a/1.txt'])
+            for name, content in contents.items():
+                self.assertEqual(mytar.extractfile('1/' + name).read(), content)
+
+    @staticmethod
+    def other_writer_first(append):
+        """Patch flock to run another append before the lock is taken."""
+        real_flock = fcntl.flock
+        pending = [append]
+
+        def flock(tar_fd, operation):
+            """Let the other writer in while this one waits for the lock."""
+            if pending:
+                pending.pop()()
+            real_flock(tar_fd, operation)
+        return mock.patch('fcntl.flock', side_effect=flock)
+
+    @skipIf(fcntl is None, 'the tar is only locked with fcntl')
+    def test_bundle_interleaved(self):
+        """Test appends and the end of the tar land after other writers."""
+        tmp_dir = tempfile.mkdtemp()
+        contents = {'1.txt': b'first file', '2.txt': b'second file', '3.txt': b'third file'}
+        paths = {}
+        for name, content in contents.items():
+            paths[name] = os.path.join(tmp_dir, name)
+            with open(paths[name], 'wb') as testfd:
+                testfd.write(content)
+        bundle_tar = os.path.join(tmp_dir, 'bundle.tar')
+        real_copy = tarfile.copyfileobj
+
+        def copyfileobj(src, dst, length):
+            """Fail the copy of the third file."""
+            if src.name == paths['3.txt']:
+                raise OSError('No space left on device')
+            real_copy(src, dst, length)
+        with self.other_writer_first(lambda: Cartutils.append_to_tar(bundle_tar, paths['1.txt'], '1/1.txt')), \
+                mock.patch('tarfile.copyfileobj', side_effect=copyfileobj):
+            with self.assertRaises(OSError):
+                Cartutils.append_to_tar(bundle_tar, paths['3.txt'], '1/3.txt')
+        with self.other_writer_first(lambda: Cartutils.append_to_tar(bundle_tar, paths['2.txt'], '1/2.txt')):
+            Cartutils.finish_tar(bundle_tar)
+        self.assertEqual(os.path.getsize(bundle_tar) % tarfile.RECORDSIZE, 0)
+        with tarfile.open(bundle_tar) as mytar:
+            self.assertEqual(mytar.getnames(), ['1/1.txt', '1/2.txt'])
+            for name in ['1.txt', '2.txt']:
+                self.assertEqual(mytar.extractfile('1/' + name).read(), contents[name])
+        shutil.rmtree(tmp_dir)
+
+    @skipIf(fcntl is None, 'the tar is only locked with fcntl')
+    def test_reserve_tar_slot_interleaved(self):
+        """Test a slot reserved after another worker's is after its slot."""
+        cart_utils = Cartutils()
+        test_cart = Cart.create(cart_uid='slots', status='staging', bundle=True)
+        contents = {'1.txt': b'first file', '2.txt': b'the second file'}
+        cart_files = {
+            name: File.create(cart=test_cart, file_name=name, bundle_path=name) for name in contents
+        }
+        os.makedirs(cart_utils.cart_bundle_path(test_cart))
+        slots = {}
+
+        def reserve(name):
+            """Reserve the slot of the file and keep where it is."""
+            slots[name] = cart_utils.reserve_tar_slot(test_cart, cart_files[name], len(contents[name]), '1444937154')
+        with self.other_writer_first(lambda: reserve('2.txt')):
+            reserve('1.txt')
+        for name, (bundle_tar, (offset, size)) in slots.items():
+            with open(bundle_tar, 'r+b') as tar_fd:
+                tar_fd.seek(offset)
+                tar_fd.write(contents[name])
+            self.assertEqual(size, len(contents[name]))
+        Cartutils.finish_tar(bundle_tar)
+        with tarfile.open(bundle_tar) as mytar:
+            self.assertEqual(mytar.getnames(), ['slots/2.txt', 'slots/1.txt'])
+            for name, content in contents.items():
+                self.assertEqual(mytar.extractfile('slots/' + name).read(), content)
+        shutil.rmtree(os.path.dirname(bundle_tar))